@@ -0,0 +1,155 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+from concurrent import futures
+from WallHaven import WallHaven, WallHavenPicture, Category
+from ThumbnailCache import ThumbnailCache
+from PictureStore import PictureStore
+from DownloadTuner import TuningStore
+from TagIndex import TagIndex
+from HttpCache import HttpCache
+from FetchScheduler import FetchScheduler, Priority
+from FakeServer import FakeWallHavenServer
+from NetStats import NetStats
+from Transport import TransportConfig
+
+
+def create_wallhaven(server, cache_dir, stats=None, transport=None):
+    return WallHaven(thumb_cache=ThumbnailCache(os.path.join(cache_dir, 'thumb')),
+                     picture_store=PictureStore(os.path.join(cache_dir, 'picture.db')),
+                     index_url=server.url, stats=stats, transport=transport,
+                     tuning_store=TuningStore(os.path.join(cache_dir, 'download_tuning.json')),
+                     tag_index=TagIndex(os.path.join(cache_dir, 'tags.db')),
+                     http_cache=HttpCache(os.path.join(cache_dir, 'http.db')))
+
+
+def bench_listing(server, pages, workers, stats=None, transport=None):
+    '''
+    按页加载列表和缩略图，统计首个缩略图耗时和每页缩略图速度
+    第一轮为冷缓存，第二轮为磁盘缓存命中
+    '''
+    results = []
+    scheduler = FetchScheduler(workers)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        wh = create_wallhaven(server, cache_dir, stats, transport)
+        for cache in ('cold', 'warm'):
+            for page in pages:
+                start = time.perf_counter()
+                ids = list(wh.get_category_picture(Category.LATEST, page))
+                listing_time = time.perf_counter() - start
+                fus = [scheduler.submit('benchmark', wh.get_preview_data, id, priority=Priority.VISIBLE)
+                       for id in ids]
+                first = None
+                errors = 0
+                for future in futures.as_completed(fus):
+                    try:
+                        future.result()
+                    except Exception:
+                        errors += 1
+                    if first is None:
+                        first = time.perf_counter() - start
+                total = time.perf_counter() - start
+                results.append({'cache': cache,
+                                'page': page,
+                                'thumbnails': len(ids),
+                                'errors': errors,
+                                'listing_seconds': listing_time,
+                                'first_thumbnail_seconds': first,
+                                'page_seconds': total,
+                                'thumbnails_per_second': len(ids) / total if total else 0.0})
+        results.append({'thumb_cache': wh.thumb_cache.stats()})
+        wh.picture_store.close()
+    scheduler.shutdown()
+    return results
+
+
+def bench_download(server, threads, part_sizes, repeat=1, stats=None, transport=None, adaptive_runs=3):
+    '''
+    不同分段线程数和分段大小下的原图下载速度
+    最后连续几次使用自适应模式下载，观察按主机记住的参数是否收敛
+    '''
+    results = []
+    url = server.url + '/wallpapers/full/wallhaven-1.jpg'
+    with tempfile.TemporaryDirectory() as cache_dir:
+        wh = create_wallhaven(server, cache_dir, stats, transport)
+        picture = WallHavenPicture('1', (4096, 2304), '', url)
+
+        def download(**config):
+            path = os.path.join(cache_dir, 'wallhaven-1.jpg')
+            if os.path.exists(path):
+                os.remove(path)
+            start = time.perf_counter()
+            error = None
+            try:
+                wh.download_picture(picture, cache_dir)
+            except Exception as e:
+                error = str(e)
+            elapsed = time.perf_counter() - start
+            size = len(server.origin)
+            config.update({'bytes': size,
+                           'seconds': elapsed,
+                           'mb_per_second': size / 1024 / 1024 / elapsed,
+                           'error': error})
+            results.append(config)
+
+        wh.download_adaptive = False
+        for thread in threads:
+            for part_size in part_sizes:
+                wh._download_max_thread = thread
+                wh._download_part_size = part_size
+                for i in range(repeat):
+                    download(download_max_thread=thread, download_part_size=part_size)
+        wh.download_adaptive = True
+        wh._download_max_thread, wh._download_part_size = 4, 512 * 1024
+        for i in range(adaptive_runs):
+            download(adaptive=True, run=i, tuning=wh.tuning_store.get(server.host))
+        wh.picture_store.close()
+    return results
+
+
+def parse_list(text, scale=1):
+    return [int(s) * scale for s in text.split(',') if s]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='基于本地模拟服务器的性能测试')
+    parser.add_argument('--latency', type=float, default=0.02, help='每个请求的延迟（秒）')
+    parser.add_argument('--bandwidth', type=int, default=0, help='单连接带宽上限（KB/s），0为不限制')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回503的请求比例')
+    parser.add_argument('--pages', type=int, default=3, help='列表测试的页数')
+    parser.add_argument('--workers', type=int, default=6, help='缩略图线程数')
+    parser.add_argument('--threads', default='1,2,4,8', help='download_max_thread取值')
+    parser.add_argument('--part-sizes', default='256,512,1024', help='download_part_size取值（KB）')
+    parser.add_argument('--origin-size', type=int, default=8, help='原图大小（MB）')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--adaptive-runs', type=int, default=3, help='自适应模式连续下载的次数')
+    parser.add_argument('--pool-size', type=int, default=TransportConfig().pool_maxsize, help='每个主机保持的连接数')
+    parser.add_argument('--retries', type=int, default=TransportConfig().retries, help='连接失败和5xx时的重试次数')
+    parser.add_argument('--output', help='结果写入的JSON文件，默认输出到标准输出')
+    args = parser.parse_args(argv)
+
+    server = FakeWallHavenServer(latency=args.latency, bandwidth=args.bandwidth * 1024,
+                                 error_rate=args.error_rate, origin_size=args.origin_size * 1024 * 1024)
+    listing_stats, download_stats = NetStats(), NetStats()
+    transport = TransportConfig(pool_maxsize=args.pool_size, retries=args.retries)
+    with server:
+        report = {'config': vars(args),
+                  'listing': bench_listing(server, range(1, args.pages + 1), args.workers, listing_stats, transport),
+                  'download': bench_download(server, parse_list(args.threads), parse_list(args.part_sizes, 1024),
+                                             args.repeat, download_stats, transport, args.adaptive_runs),
+                  'requests': dict(server.requests)}
+    report['net_stats'] = {'listing': listing_stats.summary()['operations'],
+                           'download': download_stats.summary()['operations']}
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
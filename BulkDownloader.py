@@ -0,0 +1,338 @@
+import io
+import os
+import sys
+import time
+import logging
+import argparse
+import threading
+import unittest
+import tempfile
+import subprocess
+from concurrent import futures
+from WallHaven import WallHaven, Category
+from Transport import TransportConfig
+from PerceptualHash import HashIndex, duplicate_of
+from LibraryIndex import LibraryIndex
+from PostProcess import PostProcessor, PostResult
+
+log = logging.getLogger('BulkDownloaderLog')
+log.setLevel(logging.INFO)
+console_handler = logging.StreamHandler(sys.stdout)
+formatter = logging.Formatter('%(asctime)s %(levelname)-4s: %(message)s')
+console_handler.setFormatter(formatter)
+log.addHandler(console_handler)
+
+
+class BulkDownloader:
+    '''
+    BulkDownloader
+    无界面批量下载
+    按分类和页码范围（或id列表）并行下载原图，本地壁纸库中已有的壁纸直接跳过
+    未完成的文件保留.part和进度记录，重新运行时继续下载
+    duplicates为'flag'或'skip'时，下载前用缩略图的感知哈希与下载目录中已有的壁纸比较，
+    相似的壁纸只记录（flag）或不下载（skip）
+    post_processor不为None时，下载完成的文件交给后处理进程校验、生成屏幕壁纸和计算哈希，
+    损坏的文件会被删除，下次运行时重新下载
+    '''
+
+    def __init__(self, path, wh=None, max_thread=4, report_interval=5.0, duplicates='off', hash_index=None,
+                 radius=None, library=None, post_processor=None):
+        self.path = path
+        self.wh = wh if wh is not None else WallHaven()
+        self.max_thread = max_thread
+        self.report_interval = report_interval
+        self.duplicates = duplicates
+        self.hash_index = hash_index if hash_index is not None or duplicates == 'off' else HashIndex.shared()
+        self.radius = radius
+        os.makedirs(path, exist_ok=True)
+        self.library = library if library is not None else LibraryIndex.shared(path)
+        self.post_processor = post_processor
+        self.downloaded = 0
+        self.skipped = 0
+        # [(id, 相似的已有壁纸id)]
+        self.similar = []
+        self.failed = []
+        self.damaged = []
+        self.bytes = 0
+        # 后处理结果处理完（损坏的文件已删除、壁纸库已更新）时完成的Future
+        self._post_handled = []
+        self._start_time = 0.0
+        self._last_report = 0.0
+        self._lock = threading.Lock()
+
+    def collect_ids(self, category, pages):
+        ids = []
+        seen = set()
+        for page in pages:
+            if category == Category.MAIN:
+                page_ids = list(self.wh.get_main_web_pictures())
+            else:
+                page_ids = list(self.wh.get_category_picture(category, page))
+            log.info('{} page {}: {} wallpapers'.format(category.value, page, len(page_ids)))
+            ids.extend(id for id in page_ids if id not in seen)
+            seen.update(page_ids)
+            if category == Category.MAIN:
+                break
+        return ids
+
+    def exists(self, id):
+        return self.library.has(id)
+
+    def run(self, ids):
+        # 增量扫描，只有新增或修改过的文件需要读取
+        self.library.scan()
+        if self.hash_index is not None:
+            count = 0
+            for id, file, hashes in self.library.hashes():
+                if id not in self.hash_index:
+                    self.hash_index.add(id, hashes, file)
+                    count += 1
+            log.info('indexed {} existing wallpapers for duplicate detection'.format(count))
+        self._start_time = self._last_report = time.monotonic()
+        with futures.ThreadPoolExecutor(self.max_thread) as executor:
+            to_do_map = {executor.submit(self._download_one, id): id for id in ids}
+            for future in futures.as_completed(to_do_map):
+                id = to_do_map[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    log.error('download {} failed: {}'.format(id, e))
+                    with self._lock:
+                        self.failed.append(id)
+                self._report()
+        if self.post_processor is not None:
+            # PostProcessor.join在结果的回调执行前就会返回，这里等待回调处理完
+            with self._lock:
+                handled = list(self._post_handled)
+            while futures.wait(handled, self.report_interval).not_done:
+                self._report(force=True)
+        self._report(force=True)
+        return self.stats()
+
+    def _download_one(self, id):
+        if self.exists(id):
+            with self._lock:
+                self.skipped += 1
+            return
+        hashes = None
+        if self.hash_index is not None:
+            match, hashes = duplicate_of(self.wh, self.hash_index, id, self.radius)
+            if match is not None:
+                with self._lock:
+                    self.similar.append((id, match))
+                log.warning('{} looks like {} which is already downloaded'.format(id, match))
+                if self.duplicates == 'skip':
+                    with self._lock:
+                        self.skipped += 1
+                    return
+        path = self.wh.download_picture(id, self.path)
+        # 损坏的文件会在后处理的回调中删除，提交之前取得大小
+        size = os.path.getsize(path)
+        self.library.add_file(path, id, analyze=self.post_processor is None)
+        if hashes is not None:
+            self.hash_index.add(id, hashes, path)
+        if self.post_processor is not None:
+            handled = futures.Future()
+            with self._lock:
+                self._post_handled.append(handled)
+            self.post_processor.submit(path, id).add_done_callback(lambda f: self._post_handled_done(f, handled))
+        with self._lock:
+            self.downloaded += 1
+            self.bytes += size
+        log.info('downloaded {} ({:.1f}KB)'.format(path, size / 1024))
+
+    def _post_handled_done(self, future, handled):
+        try:
+            self._post_processed(future)
+        except Exception as e:
+            log.error('handle post process result failed: {}'.format(e))
+        finally:
+            handled.set_result(None)
+
+    def _post_processed(self, future):
+        result = future.result()
+        if result.damaged:
+            log.error('{} is damaged, {}'.format(result.path, result.error))
+            with self._lock:
+                self.damaged.append(result.id)
+            os.remove(result.path)
+            return
+        if result.error:
+            # 后处理本身出错（例如工作进程异常退出）时文件保留，只登记已经得到的信息
+            log.error('post process {} failed, {}'.format(result.path, result.error))
+        self.library.add_file(result.path, result.id, result.resolution, result.hashes, analyze=False)
+
+    def stats(self):
+        with self._lock:
+            elapsed = max(time.monotonic() - self._start_time, 1e-6)
+            return {'downloaded': self.downloaded,
+                    'skipped': self.skipped,
+                    'similar': list(self.similar),
+                    'failed': list(self.failed),
+                    'damaged': list(self.damaged),
+                    'bytes': self.bytes,
+                    'elapsed': elapsed,
+                    'mb_per_second': self.bytes / 1024 / 1024 / elapsed,
+                    'items_per_second': self.downloaded / elapsed}
+
+    def _report(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_report < self.report_interval:
+            return
+        self._last_report = now
+        stats = self.stats()
+        log.info('downloaded {downloaded}, skipped {skipped}, failed {failed_count}, '
+                 '{mb_per_second:.2f}MB/s, {items_per_second:.2f} items/s'.format(
+                     failed_count=len(stats['failed']), **stats))
+        if self.post_processor is not None:
+            log.info('post process ' + ', '.join(
+                '{} {} queued {} done {:.2f}/s'.format(stage, item['queued'], item['done'], item['items_per_second'])
+                for stage, item in self.post_processor.stats().items()))
+
+
+def parse_pages(text):
+    if '-' in text:
+        start, end = text.split('-', 1)
+        return range(int(start), int(end) + 1)
+    return range(int(text), int(text) + 1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='批量下载wallhaven壁纸')
+    parser.add_argument('path', help='下载目录')
+    parser.add_argument('-c', '--category', choices=[c.value for c in Category], default=Category.LATEST.value)
+    parser.add_argument('-p', '--pages', default='1', help='页码或页码范围，如 1-5')
+    parser.add_argument('-i', '--ids', nargs='*', help='直接指定壁纸id，忽略分类和页码')
+    parser.add_argument('-t', '--tags', help='在本地标签索引中查找壁纸，如 "landscape clouds | mountains"，忽略分类和页码')
+    parser.add_argument('--limit', type=int, default=50, help='按标签查找时最多下载的壁纸数')
+    parser.add_argument('-w', '--workers', type=int, default=4, help='同时下载的壁纸数')
+    parser.add_argument('--stats', help='结束后把网络统计写入该JSON文件')
+    default = TransportConfig()
+    parser.add_argument('--pool-size', type=int, default=default.pool_maxsize, help='每个主机保持的连接数')
+    parser.add_argument('--no-keep-alive', action='store_true', help='每个请求后关闭连接')
+    parser.add_argument('--connect-timeout', type=float, default=default.connect_timeout,
+                        help='连接超时（秒），0为不限制')
+    parser.add_argument('--read-timeout', type=float, default=default.read_timeout, help='读取超时（秒），0为不限制')
+    parser.add_argument('--retries', type=int, default=default.retries, help='连接失败和5xx时的重试次数')
+    parser.add_argument('--no-adaptive', action='store_true', help='不自动调整原图分段数和分段大小')
+    parser.add_argument('--duplicates', choices=['off', 'flag', 'skip'], default='off',
+                        help='与已下载壁纸相似时的处理：不检查、只记录、跳过')
+    parser.add_argument('--duplicate-radius', type=int, default=8, help='感知哈希允许的最大汉明距离（0-64）')
+    parser.add_argument('--no-post-process', action='store_true', help='下载后不校验文件、不生成屏幕壁纸')
+    parser.add_argument('--variants', default='',
+                        help='为这些屏幕尺寸生成铺满屏幕的壁纸（保存在cache/variants），如 1920x1080,2560x1440')
+    parser.add_argument('--post-workers', type=int, default=None, help='后处理进程数，默认为CPU核数减一（最多4个）')
+    args = parser.parse_args(argv)
+
+    transport = default._replace(pool_maxsize=args.pool_size, keep_alive=not args.no_keep_alive,
+                                 connect_timeout=args.connect_timeout, read_timeout=args.read_timeout,
+                                 retries=args.retries)
+    wh = WallHaven(transport=transport)
+    wh.download_adaptive = not args.no_adaptive
+    post_processor = None
+    if not args.no_post_process:
+        sizes = [tuple(int(n) for n in size.lower().split('x')) for size in args.variants.split(',') if size]
+        post_processor = PostProcessor(args.post_workers, sizes)
+    downloader = BulkDownloader(args.path, wh=wh, max_thread=args.workers, duplicates=args.duplicates,
+                                radius=args.duplicate_radius, post_processor=post_processor)
+    if args.ids:
+        ids = args.ids
+    elif args.tags:
+        ids = wh.search_tags(args.tags, args.limit)
+    else:
+        ids = downloader.collect_ids(Category(args.category), parse_pages(args.pages))
+    stats = downloader.run(ids)
+    if post_processor is not None:
+        post_processor.shutdown()
+    if args.stats:
+        downloader.wh.stats.dump(args.stats)
+    return 1 if stats['failed'] or stats['damaged'] else 0
+
+
+QT_MODULES = ('PyQt5', 'PyQt5.QtCore', 'PyQt5.QtGui', 'PyQt5.QtWidgets')
+
+
+class BulkDownloaderTest(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            from PIL import Image
+        except ImportError:
+            self.skipTest('Pillow is not installed')
+        from FakeServer import FakeWallHavenServer
+        from Benchmark import create_wallhaven
+        # 批量下载不能依赖PyQt，测试过程中导入PyQt5会失败
+        saved = {name: sys.modules.get(name) for name in QT_MODULES}
+        sys.modules.update(dict.fromkeys(QT_MODULES))
+        self.addCleanup(self.restore_modules, saved)
+        buffer = io.BytesIO()
+        Image.new('RGB', (160, 90), (30, 90, 150)).save(buffer, 'JPEG')
+        self.jpeg = buffer.getvalue()
+        self.server = FakeWallHavenServer(per_page=4).start()
+        self.server.origin = self.jpeg
+        self.addCleanup(self.server.stop)
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.wh = create_wallhaven(self.server, self.dir.name)
+        self.addCleanup(self.wh.picture_store.close)
+        self.addCleanup(self.wh.http_cache.close)
+        self.path = os.path.join(self.dir.name, 'wallpapers')
+
+    @staticmethod
+    def restore_modules(saved):
+        for name, module in saved.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+    def create(self, post_processor=None):
+        library = LibraryIndex(self.path, os.path.join(self.dir.name, 'library.db'), self.wh.picture_store)
+        self.addCleanup(library.close)
+        return BulkDownloader(self.path, wh=self.wh, max_thread=2, library=library, post_processor=post_processor)
+
+    def test_import_without_qt(self):
+        code = "import sys; sys.modules['PyQt5'] = None; import BulkDownloader"
+        subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+
+    def test_download_and_resume(self):
+        downloader = self.create()
+        ids = downloader.collect_ids(Category.LATEST, parse_pages('1-2'))
+        self.assertEqual(ids, self.server.page_ids(1) + self.server.page_ids(2))
+        # 只下载了一部分后中断，重新运行时跳过本地壁纸库中已有的
+        stats = downloader.run(ids[:3])
+        self.assertEqual((stats['downloaded'], stats['failed']), (3, []))
+        stats = self.create().run(ids)
+        self.assertEqual((stats['downloaded'], stats['skipped'], stats['failed']), (5, 3, []))
+        self.assertGreater(stats['mb_per_second'], 0)
+        for id in ids:
+            with open(os.path.join(self.path, 'wallhaven-{}.jpg'.format(id)), 'rb') as f:
+                self.assertEqual(f.read(), self.jpeg)
+        library = self.create().library
+        self.assertEqual(library.get(ids[0]).resolution, (160, 90))
+
+    def test_damaged(self):
+        ids = self.server.page_ids(1)[:2]
+        self.server.origin = self.jpeg[:len(self.jpeg) // 2]
+        processor = PostProcessor(max_workers=1)
+        self.addCleanup(processor.shutdown)
+        stats = self.create(processor).run(ids)
+        self.assertEqual(sorted(stats['damaged']), ids)
+        self.assertEqual(os.listdir(self.path), [])
+        # 损坏的文件已删除，下次运行时重新下载
+        stats = self.create(processor).run(ids)
+        self.assertEqual(stats['downloaded'], 2)
+
+    def test_post_process_error_keeps_file(self):
+        downloader = self.create()
+        path = self.wh.download_picture('1001', self.path)
+        future = futures.Future()
+        future.set_result(PostResult('1001', path, len(self.jpeg), None, None, [], 'hash: worker crashed', False))
+        downloader._post_processed(future)
+        self.assertTrue(os.path.exists(path))
+        self.assertTrue(downloader.library.has('1001'))
+        self.assertEqual(downloader.stats()['damaged'], [])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
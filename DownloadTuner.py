@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import pathlib
+import threading
+import unittest
+import tempfile
+
+
+class DownloadTuner:
+    '''
+    DownloadTuner
+    分段下载自适应调节
+    按AIMD调节并行分段数：每轮（完成的分段数达到当前并行数）用单段平均速度乘以并行数估计总吞吐量，
+    比上一轮明显提高则加一，明显下降或分段失败则减半，持平时回到目前最好的并行数
+    分段大小按单段耗时调节，使每段耗时接近target_seconds
+    '''
+
+    def __init__(self, max_thread=4, part_size=512 * 1024, thread_limit=16, min_part_size=128 * 1024,
+                 max_part_size=8 * 1024 * 1024, target_seconds=1.0):
+        self.thread_limit = max(thread_limit, 1)
+        self.min_part_size = min_part_size
+        self.max_part_size = max_part_size
+        self.max_thread = min(max(max_thread, 1), self.thread_limit)
+        self.part_size = min(max(part_size, min_part_size), max_part_size)
+        self.target_seconds = target_seconds
+        self.best_rate = 0.0
+        self.best_thread = self.max_thread
+        self.best_part_size = self.part_size
+        self._last_rate = None
+        self._window_bytes = 0
+        self._window_seconds = 0.0
+        self._window_segments = 0
+        self._lock = threading.Lock()
+
+    def segment_done(self, size, seconds):
+        with self._lock:
+            if seconds < self.target_seconds / 2:
+                self.part_size = min(self.part_size * 2, self.max_part_size)
+            elif seconds > self.target_seconds * 2:
+                self.part_size = max(self.part_size // 2, self.min_part_size)
+            self._window_bytes += size
+            self._window_seconds += seconds
+            self._window_segments += 1
+            if self._window_segments >= self.max_thread:
+                self._adjust()
+
+    def segment_failed(self):
+        with self._lock:
+            self.max_thread = max(self.max_thread // 2, 1)
+            self._reset_window()
+
+    def _adjust(self):
+        # 各段的耗时互相重叠，不能直接用墙上时间
+        rate = self._window_bytes / max(self._window_seconds, 1e-6) * self.max_thread
+        if rate > self.best_rate:
+            self.best_rate, self.best_thread, self.best_part_size = rate, self.max_thread, self.part_size
+        if self._last_rate is None or rate > self._last_rate * 1.05:
+            # 加性增
+            self.max_thread = min(self.max_thread + 1, self.thread_limit)
+        elif rate < self._last_rate * 0.8:
+            # 乘性减
+            self.max_thread = max(self.max_thread // 2, 1)
+        else:
+            self.max_thread = self.best_thread
+        self._last_rate = rate
+        self._reset_window()
+
+    def _reset_window(self):
+        self._window_bytes = 0
+        self._window_seconds = 0.0
+        self._window_segments = 0
+
+    def best(self):
+        with self._lock:
+            return {'max_thread': self.best_thread,
+                    'part_size': self.best_part_size,
+                    'bytes_per_second': self.best_rate}
+
+
+class TuningStore:
+    '''
+    TuningStore
+    按主机保存分段下载的最佳参数
+    保存在JSON文件中，下次下载同一主机的原图时以此作为初始值
+    '''
+
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, path=None):
+        if path is None:
+            path = pathlib.Path.cwd().joinpath('cache', 'download_tuning.json')
+        os.makedirs(str(pathlib.Path(path).parent), exist_ok=True)
+        self.path = str(path)
+        self._lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                self._hosts = json.load(f)
+        except (OSError, ValueError):
+            self._hosts = {}
+
+    @classmethod
+    def shared(cls, path=None):
+        key = str(pathlib.Path(path).resolve()) if path else None
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(path)
+            return cls._shared[key]
+
+    def get(self, host):
+        with self._lock:
+            item = self._hosts.get(host)
+            return dict(item) if item else None
+
+    def create_tuner(self, host, max_thread=4, part_size=512 * 1024, thread_limit=16):
+        '''以保存的参数（没有时使用max_thread和part_size）创建DownloadTuner'''
+        item = self.get(host)
+        if item is not None:
+            max_thread, part_size = item['max_thread'], item['part_size']
+        return DownloadTuner(max_thread, part_size, thread_limit)
+
+    def put(self, host, tuner):
+        best = tuner.best()
+        if not best['bytes_per_second']:
+            return
+        best['updated'] = time.time()
+        with self._lock:
+            self._hosts[host] = best
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(self._hosts, f, indent=2)
+            os.replace(self.path + '.tmp', self.path)
+
+
+class DownloadTunerTest(unittest.TestCase):
+
+    def test_additive_increase(self):
+        tuner = DownloadTuner(max_thread=2, part_size=512 * 1024)
+        for i in range(2):
+            tuner.segment_done(512 * 1024, 1.0)
+        self.assertEqual(tuner.max_thread, 3)
+        self.assertEqual(tuner.part_size, 512 * 1024)
+
+    def test_multiplicative_decrease(self):
+        tuner = DownloadTuner(max_thread=8)
+        tuner.segment_failed()
+        self.assertEqual(tuner.max_thread, 4)
+        tuner.segment_failed()
+        tuner.segment_failed()
+        tuner.segment_failed()
+        self.assertEqual(tuner.max_thread, 1)
+
+    def test_part_size(self):
+        tuner = DownloadTuner(part_size=512 * 1024, max_part_size=1024 * 1024)
+        tuner.segment_done(512 * 1024, 0.1)
+        tuner.segment_done(512 * 1024, 0.1)
+        self.assertEqual(tuner.part_size, 1024 * 1024)
+        tuner.segment_done(1024 * 1024, 5.0)
+        self.assertEqual(tuner.part_size, 512 * 1024)
+
+    def test_store(self):
+        with tempfile.TemporaryDirectory() as path:
+            store = TuningStore(os.path.join(path, 'tuning.json'))
+            tuner = DownloadTuner(max_thread=6, part_size=1024 * 1024)
+            for i in range(6):
+                tuner.segment_done(1024 * 1024, 1.0)
+            store.put('example.com', tuner)
+            tuner = TuningStore(store.path).create_tuner('example.com')
+            self.assertEqual(tuner.max_thread, 6)
+            self.assertEqual(tuner.part_size, 1024 * 1024)
+            self.assertEqual(store.create_tuner('other.com').max_thread, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,384 @@
+import os
+import re
+import json
+import time
+import threading
+import unittest
+import tempfile
+import http.server
+import contextlib
+from concurrent import futures
+import requests
+from DownloadTuner import DownloadTuner
+
+
+class DownloadError(Exception):
+    pass
+
+
+class SegmentedDownloader:
+    '''
+    SegmentedDownloader
+    分段下载器
+    每段通过Range请求下载后直接写入预分配的.part文件
+    已完成的区间记录在.part.json中，中断后可以继续下载
+    传入tuner时由DownloadTuner在下载过程中调节并行分段数和分段大小
+    连接失败和5xx由session的Transport重试，这里只重试读取过程中断开的分段，从断开的位置继续；
+    slots为多个下载共用的信号量，限制同时进行的分段请求数不超过连接池大小
+    '''
+
+    def __init__(self, session=None, max_thread=4, part_size=512 * 1024, retry=3, stats=None,
+                 timeout=None, tuner=None, slots=None):
+        self._session = session if session is not None else requests.session()
+        self.stats = stats
+        self.timeout = timeout
+        self.tuner = tuner
+        self.max_thread = max_thread
+        self.part_size = part_size
+        self.retry = retry
+        self.slots = slots
+        self._chunk_size = 64 * 1024
+        self._lock = threading.Lock()
+
+    def _request(self, method, url, operation, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        if self.stats is None:
+            return self._session.request(method, url, **kwargs)
+        return self.stats.request(self._session, method, url, operation, **kwargs)
+
+    def content_length(self, url):
+        rsp = self._request('HEAD', url, 'head', allow_redirects=True)
+        rsp.raise_for_status()
+        if 'Content-Length' not in rsp.headers:
+            raise DownloadError('no Content-Length for {}'.format(url))
+        return int(rsp.headers['Content-Length'])
+
+    def download(self, url, path, progress=None, size=None):
+        '''
+        下载url到path，progress(downloaded, total)在每段完成后回调
+        已知文件大小时可以传入size，省去一次HEAD请求
+        返回path
+        '''
+        part_path = path + '.part'
+        state_path = part_path + '.json'
+        if size is None:
+            size = self.content_length(url)
+        done = self._prepare(url, part_path, state_path, size)
+        gaps = self._gaps(size, done)
+        downloaded = size - sum(end - start for start, end in gaps)
+        if progress:
+            progress(downloaded, size)
+
+        fd = os.open(part_path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+        try:
+            thread_limit = self.tuner.thread_limit if self.tuner is not None else self.max_thread
+            with futures.ThreadPoolExecutor(thread_limit) as executor:
+                running = set()
+                try:
+                    while gaps or running:
+                        # 每完成一段后按当前的并行数和分段大小补充新的分段
+                        while gaps and len(running) < self._max_thread():
+                            start, end = self._take(gaps)
+                            running.add(executor.submit(self._download_part, url, fd, start, end))
+                        finished, running = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+                        for future in finished:
+                            start, end = future.result()
+                            done = self._merge(done + [[start, end]])
+                            downloaded += end - start
+                            self._save_state(state_path, url, size, done)
+                            if progress:
+                                progress(downloaded, size)
+                except BaseException:
+                    for future in running:
+                        future.cancel()
+                    raise
+        finally:
+            os.close(fd)
+
+        if done != ([[0, size]] if size else []) or os.path.getsize(part_path) != size:
+            raise DownloadError('size mismatch for {}: expect {}'.format(url, size))
+        os.replace(part_path, path)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        return path
+
+    def seed(self, url, path, size, data):
+        '''
+        把已经取得的开头部分data写入.part文件并记为已完成，之后的download只下载剩余部分
+        data已经是完整文件时download不再发出请求
+        '''
+        part_path = path + '.part'
+        state_path = part_path + '.json'
+        data = data[:size]
+        done = self._prepare(url, part_path, state_path, size)
+        if data:
+            with open(part_path, 'r+b') as f:
+                f.write(data)
+            done = self._merge(done + [[0, len(data)]])
+        self._save_state(state_path, url, size, done)
+
+    def _prepare(self, url, part_path, state_path, size):
+        '''读取已完成的区间，.part文件不匹配时重新预分配'''
+        done = self._load_state(state_path, url, size)
+        if not done or not os.path.exists(part_path) or os.path.getsize(part_path) != size:
+            done = []
+            with open(part_path, 'wb') as f:
+                f.truncate(size)
+        return done
+
+    def _max_thread(self):
+        return self.tuner.max_thread if self.tuner is not None else self.max_thread
+
+    @staticmethod
+    def _gaps(size, done):
+        '''未完成的[start, end)空隙'''
+        gaps = []
+        cursor = 0
+        for start, end in done + [[size, size]]:
+            if cursor < start:
+                gaps.append([cursor, start])
+            cursor = max(cursor, end)
+        return gaps
+
+    def _take(self, gaps):
+        '''从第一个空隙的开头切出一段'''
+        if self.tuner is None:
+            part_size = self.part_size
+        else:
+            # 剩余不多时把分段切小，让每个连接都有事做
+            remain = sum(end - start for start, end in gaps)
+            part_size = max(min(self.tuner.part_size, -(-remain // self.tuner.max_thread)),
+                            self.tuner.min_part_size)
+        start, end = gaps[0]
+        end = min(start + part_size, end)
+        if end == gaps[0][1]:
+            gaps.pop(0)
+        else:
+            gaps[0][0] = end
+        return start, end
+
+    def _download_part(self, url, fd, start: int, end: int):
+        state = {'offset': start}
+        for attempt in range(self.retry + 1):
+            state['reading'] = False
+            segment_start = state['offset']
+            try:
+                with self.slots if self.slots is not None else contextlib.nullcontext():
+                    # 等待共享连接数的时间不计入传输耗时，否则竞争时调整器会误以为吞吐量低
+                    begin = time.monotonic()
+                    self._read_part(url, fd, state, end)
+            except (requests.RequestException, DownloadError):
+                if self.tuner is not None:
+                    self.tuner.segment_failed()
+                # 连接失败和5xx已经由Transport重试过；这里只重试读取过程中断开的分段，从断开的位置继续
+                if not state['reading'] or attempt == self.retry:
+                    raise
+                time.sleep(0.5 * 2 ** attempt)
+                continue
+            if self.tuner is not None:
+                self.tuner.segment_done(end - segment_start, time.monotonic() - begin)
+            return start, end
+
+    def _read_part(self, url, fd, state, end):
+        offset = state['offset']
+        # Range的结束位置是包含在内的
+        headers = {'Range': 'bytes=%d-%d' % (offset, end - 1)}
+        with self._request('GET', url, 'range-part', headers=headers, stream=True) as rsp:
+            if rsp.status_code != 206 and not (rsp.status_code == 200 and offset == 0 and
+                                               int(rsp.headers.get('Content-Length', -1)) == end):
+                raise DownloadError('unexpected status {} for range {}-{}'.format(rsp.status_code, offset, end))
+            state['reading'] = True
+            for block in rsp.iter_content(self._chunk_size):
+                block = block[:end - state['offset']]
+                self._pwrite(fd, block, state['offset'])
+                state['offset'] += len(block)
+        if state['offset'] != end:
+            raise DownloadError('short read for range {}-{}: got {}'.format(offset, end, state['offset'] - offset))
+
+    def _pwrite(self, fd, data, offset):
+        if hasattr(os, 'pwrite'):
+            os.pwrite(fd, data, offset)
+        else:
+            with self._lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                os.write(fd, data)
+
+    @staticmethod
+    def _merge(ranges):
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return merged
+
+    @staticmethod
+    def _load_state(state_path, url, size):
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return []
+        if state.get('url') != url or state.get('size') != size:
+            return []
+        return state.get('done', [])
+
+    def _save_state(self, state_path, url, size, done):
+        with self._lock:
+            with open(state_path + '.tmp', 'w') as f:
+                json.dump({'url': url, 'size': size, 'done': done}, f)
+            os.replace(state_path + '.tmp', state_path)
+
+
+class _RangeHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    data = b''
+    # 还要中途断开的响应数
+    broken = 0
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.data)))
+        self.end_headers()
+
+    def do_GET(self):
+        start, end = re.match(r'bytes=(\d+)-(\d+)', self.headers['Range']).groups()
+        body = self.data[int(start):int(end) + 1]
+        cls = type(self)
+        with cls.lock:
+            broken = cls.broken > 0
+            cls.broken -= broken
+        time.sleep(0.01)
+        self.send_response(206)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if broken:
+            # 只发送一半就断开连接
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+class SegmentedDownloaderTest(unittest.TestCase):
+
+    def setUp(self):
+        _RangeHandler.data = os.urandom(300 * 1024 + 17)
+        _RangeHandler.broken = 0
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _RangeHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:{}/wallhaven-1.jpg'.format(self.server.server_port)
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'wallhaven-1.jpg')
+        self.downloader = SegmentedDownloader(part_size=64 * 1024)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.dir.cleanup()
+
+    def test_download(self):
+        self.downloader.download(self.url, self.path)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), _RangeHandler.data)
+        self.assertFalse(os.path.exists(self.path + '.part.json'))
+
+    def test_interrupted_part(self):
+        _RangeHandler.broken = 2
+        self.downloader.download(self.url, self.path)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), _RangeHandler.data)
+
+    def test_shared_slots(self):
+        active = [0, 0]
+        lock = threading.Lock()
+
+        class Session(requests.Session):
+            # 记录客户端同时进行的分段请求数（包括读取响应内容）
+            def request(self, method, *args, **kwargs):
+                if method != 'GET':
+                    return super().request(method, *args, **kwargs)
+                with lock:
+                    active[0] += 1
+                    active[1] = max(active)
+                rsp = super().request(method, *args, **kwargs)
+                close = rsp.close
+
+                def closed():
+                    close()
+                    with lock:
+                        active[0] -= 1
+                rsp.close = closed
+                return rsp
+
+        slots = threading.BoundedSemaphore(2)
+        paths = [self.path + str(i) for i in range(3)]
+        with futures.ThreadPoolExecutor(3) as executor:
+            for path in paths:
+                downloader = SegmentedDownloader(Session(), max_thread=4, part_size=16 * 1024, slots=slots)
+                executor.submit(downloader.download, self.url, path)
+        for path in paths:
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), _RangeHandler.data)
+        self.assertLessEqual(active[1], 2)
+
+    def test_slot_wait_not_timed(self):
+        durations = []
+
+        class Tuner(DownloadTuner):
+            def segment_done(self, size, seconds):
+                durations.append(seconds)
+                super().segment_done(size, seconds)
+
+        slots = threading.BoundedSemaphore(1)
+        slots.acquire()
+        threading.Timer(0.5, slots.release).start()
+        tuner = Tuner(max_thread=2, part_size=64 * 1024, thread_limit=2, min_part_size=64 * 1024)
+        SegmentedDownloader(tuner=tuner, slots=slots).download(self.url, self.path)
+        self.assertTrue(durations)
+        self.assertLess(max(durations), 0.4)
+
+    def test_adaptive(self):
+        tuner = DownloadTuner(max_thread=2, part_size=16 * 1024, thread_limit=4, min_part_size=16 * 1024)
+        SegmentedDownloader(tuner=tuner).download(self.url, self.path)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), _RangeHandler.data)
+        self.assertGreater(tuner.best()['bytes_per_second'], 0)
+
+    def test_seed(self):
+        size = len(_RangeHandler.data)
+        self.downloader.seed(self.url, self.path, size, _RangeHandler.data[:100 * 1024])
+        requested = []
+        self.downloader.download(self.url, self.path, lambda done, total: requested.append(done), size)
+        self.assertEqual(requested[0], 100 * 1024)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), _RangeHandler.data)
+        self.server.shutdown()
+        # 数据完整时不再请求服务器
+        os.remove(self.path)
+        self.downloader.seed(self.url, self.path, size, _RangeHandler.data)
+        self.downloader.download(self.url, self.path, size=size)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), _RangeHandler.data)
+
+    def test_resume(self):
+        size = len(_RangeHandler.data)
+        with open(self.path + '.part', 'wb') as f:
+            f.write(_RangeHandler.data[:128 * 1024])
+            f.truncate(size)
+        self.downloader._save_state(self.path + '.part.json', self.url, size, [[0, 128 * 1024]])
+        requested = []
+        self.downloader.download(self.url, self.path, lambda done, total: requested.append(done))
+        self.assertEqual(requested[0], 128 * 1024)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), _RangeHandler.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
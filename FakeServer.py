@@ -0,0 +1,178 @@
+import re
+import os
+import sys
+import time
+import zlib
+import random
+import threading
+import http.server
+from collections import Counter
+from urllib.parse import urlparse, parse_qs
+
+
+class FakeWallHavenServer:
+    '''
+    FakeWallHavenServer
+    本地模拟的wallhaven服务器，用于基准测试
+    提供首页、分类列表页、壁纸页面、缩略图和支持Range的原图
+    HTML页面带ETag，If-None-Match相同时返回304
+    可以设置延迟、单连接带宽上限和错误注入比例
+    '''
+
+    def __init__(self, latency=0.0, bandwidth=0, error_rate=0.0, thumbnail=None, origin_size=4 * 1024 * 1024,
+                 per_page=24, seed=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.per_page = per_page
+        self.thumbnail = thumbnail if thumbnail is not None else os.urandom(30 * 1024)
+        self.origin = os.urandom(origin_size)
+        self.requests = Counter()
+        self.not_modified = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self._server.daemon_threads = True
+        self._server.handle_error = self._handle_error
+        self._thread = None
+
+    def _handle_error(self, request, client_address):
+        # 客户端提前断开连接（例如只读取了页面开头，或者测试进程直接退出）时不输出错误
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            http.server.ThreadingHTTPServer.handle_error(self._server, request, client_address)
+
+    @property
+    def port(self):
+        return self._server.server_port
+
+    @property
+    def host(self):
+        return '127.0.0.1:{}'.format(self.port)
+
+    @property
+    def url(self):
+        return 'http://' + self.host
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def page_ids(self, page):
+        return [str(page * 1000 + i) for i in range(self.per_page)]
+
+    def main_page(self):
+        return ''.join('<img src="//{}/wallpapers/thumb/small/th-{}.jpg" />'.format(self.host, id)
+                       for id in self.page_ids(0)[:19])
+
+    def listing_page(self, page):
+        figures = []
+        for id in self.page_ids(page):
+            figures.append('<li><figure class="thumb thumb-sfw thumb-general" data-wallpaper-id="{id}">'
+                           '<img data-src="//{host}/wallpapers/thumb/small/th-{id}.jpg">'
+                           '<div class="thumb-info"><span class="wall-res">4096 x 2304</span></div>'
+                           '</figure></li>'.format(id=id, host=self.host))
+        return '<section class="thumb-listing-page"><ul>{}</ul></section>'.format(''.join(figures))
+
+    def wallpaper_page(self, id):
+        return ('<main><img id="wallpaper" src="//{}/wallpapers/full/wallhaven-{}.jpg" '
+                'alt="General 4096x2304 landscape mountains clouds" /></main>').format(self.host, id)
+
+    def _should_fail(self):
+        with self._lock:
+            return self.error_rate and self._random.random() < self.error_rate
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def route(self):
+                url = urlparse(self.path)
+                page = int(parse_qs(url.query).get('page', ['1'])[0])
+                if url.path in ('', '/'):
+                    return 'main', server.main_page().encode(), 'text/html'
+                if url.path in ('/latest', '/toplist', '/random'):
+                    return 'listing', server.listing_page(page).encode(), 'text/html'
+                match = re.match(r'/wallpaper/(\d+)$', url.path)
+                if match:
+                    return 'info', server.wallpaper_page(match.group(1)).encode(), 'text/html'
+                if url.path.startswith('/wallpapers/thumb/'):
+                    return 'thumb', server.thumbnail, 'image/jpeg'
+                if url.path.startswith('/wallpapers/full/'):
+                    return 'origin', server.origin, 'image/jpeg'
+                return None, None, None
+
+            def do_HEAD(self):
+                self.respond(head=True)
+
+            def do_GET(self):
+                self.respond()
+
+            def respond(self, head=False):
+                name, body, content_type = self.route()
+                with server._lock:
+                    server.requests[name or 'unknown'] += 1
+                if server.latency:
+                    time.sleep(server.latency)
+                if name is None:
+                    self.send_error(404)
+                    return
+                if server._should_fail():
+                    self.send_error(503)
+                    return
+                if content_type == 'text/html':
+                    etag = '"{:08x}"'.format(zlib.crc32(body))
+                    if self.headers.get('If-None-Match') == etag:
+                        with server._lock:
+                            server.not_modified[name] += 1
+                        self.send_response(304)
+                        self.send_header('ETag', etag)
+                        self.end_headers()
+                        return
+                status = 200
+                range_header = self.headers.get('Range')
+                if range_header and name == 'origin':
+                    start, end = re.match(r'bytes=(\d+)-(\d*)', range_header).groups()
+                    start = int(start)
+                    end = min(int(end) if end else len(body) - 1, len(body) - 1)
+                    self.send_response(206)
+                    self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(body)))
+                    body = body[start:end + 1]
+                    status = 206
+                if status == 200:
+                    self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                if content_type == 'text/html':
+                    self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('Accept-Ranges', 'bytes')
+                self.end_headers()
+                if not head:
+                    self.send_body(body)
+
+            def send_body(self, body):
+                if not server.bandwidth:
+                    self.wfile.write(body)
+                    return
+                chunk = max(server.bandwidth // 20, 1024)
+                for start in range(0, len(body), chunk):
+                    self.wfile.write(body[start:start + chunk])
+                    time.sleep(len(body[start:start + chunk]) / server.bandwidth)
+
+        return Handler
@@ -0,0 +1,160 @@
+import time
+import heapq
+import itertools
+import threading
+import unittest
+from enum import IntEnum
+from concurrent import futures
+
+
+class Priority(IntEnum):
+    VISIBLE = 0
+    PREFETCH = 1
+    HIDDEN = 2
+    # 推测性的原图预取，低于所有用户触发的任务
+    SPECULATIVE = 3
+
+
+class FetchScheduler:
+    '''
+    FetchScheduler
+    全局抓取调度器
+    所有标签页共用最多max_thread个工作线程（有任务排队时才启动），任务按分组的优先级排队
+    分组（例如某个标签页）的优先级改变时，已排队的任务会重新排序
+    '''
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, max_thread=6):
+        self.max_thread = max_thread
+        self._heap = []
+        self._counter = itertools.count()
+        self._group_priority = {}
+        self._cond = threading.Condition()
+        self._running = True
+        self._threads = []
+        # 正在等待任务的线程数
+        self._idle = 0
+
+    @classmethod
+    def shared(cls, max_thread=6):
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls(max_thread)
+            return cls._shared
+
+    def submit(self, group, fn, *args, priority=None):
+        '''提交任务，priority为空时使用分组当前的优先级，返回Future'''
+        future = futures.Future()
+        with self._cond:
+            if priority is None:
+                priority = self._group_priority.get(group, Priority.HIDDEN)
+            heapq.heappush(self._heap, [priority, next(self._counter), group, future, fn, args])
+            if len(self._heap) > self._idle and len(self._threads) < self.max_thread:
+                thread = threading.Thread(target=self._worker, name='FetchScheduler-{}'.format(len(self._threads)),
+                                          daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._cond.notify()
+        return future
+
+    def set_priority(self, group, priority):
+        with self._cond:
+            self._group_priority[group] = priority
+            changed = False
+            for entry in self._heap:
+                if entry[2] == group and entry[0] != priority:
+                    entry[0] = priority
+                    changed = True
+            if changed:
+                heapq.heapify(self._heap)
+
+    def cancel(self, group):
+        '''取消分组中尚未开始的任务'''
+        with self._cond:
+            remain = []
+            for entry in self._heap:
+                if entry[2] == group:
+                    entry[3].cancel()
+                else:
+                    remain.append(entry)
+            heapq.heapify(remain)
+            self._heap = remain
+
+    def pending(self):
+        with self._cond:
+            return len(self._heap)
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while self._running and not self._heap:
+                    self._idle += 1
+                    self._cond.wait()
+                    self._idle -= 1
+                if not self._running:
+                    return
+                _, _, _, future, fn, args = heapq.heappop(self._heap)
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def shutdown(self, wait=True):
+        with self._cond:
+            self._running = False
+            for entry in self._heap:
+                entry[3].cancel()
+            self._heap = []
+            self._cond.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+class FetchSchedulerTest(unittest.TestCase):
+
+    def test_reprioritise_and_cancel(self):
+        scheduler = FetchScheduler(1)
+        gate = threading.Event()
+        order = []
+        scheduler.submit('block', gate.wait, priority=Priority.VISIBLE)
+        tab_a, tab_b = object(), object()
+        scheduler.set_priority(tab_a, Priority.HIDDEN)
+        scheduler.set_priority(tab_b, Priority.VISIBLE)
+        fa = scheduler.submit(tab_a, order.append, 'a')
+        fb = scheduler.submit(tab_b, order.append, 'b')
+        fc = scheduler.submit('prefetch', order.append, 'c', priority=Priority.PREFETCH)
+        scheduler.set_priority(tab_a, Priority.VISIBLE)
+        scheduler.set_priority(tab_b, Priority.HIDDEN)
+        gate.set()
+        futures.wait([fa, fb, fc])
+        self.assertEqual(order, ['a', 'c', 'b'])
+
+        gate.clear()
+        scheduler.submit('block', gate.wait, priority=Priority.VISIBLE)
+        fd = scheduler.submit(tab_a, order.append, 'd')
+        scheduler.cancel(tab_a)
+        gate.set()
+        self.assertTrue(fd.cancelled())
+        scheduler.shutdown()
+
+    def test_lazy_threads(self):
+        scheduler = FetchScheduler(4)
+        self.assertEqual(len(scheduler._threads), 0)
+        scheduler.submit('a', int).result()
+        # 等待线程回到空闲状态
+        while scheduler._idle == 0:
+            time.sleep(0.01)
+        scheduler.submit('a', int).result()
+        self.assertEqual(len(scheduler._threads), 1)
+        scheduler.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,240 @@
+import os
+import time
+import sqlite3
+import pathlib
+import threading
+import unittest
+import tempfile
+from collections import namedtuple
+
+CachedResponse = namedtuple('CachedResponse', 'url text etag last_modified stored')
+
+# 各类页面在多少秒内直接使用缓存，超过后用条件请求验证；0为每次都验证，None为不缓存
+PAGE_FRESHNESS = {'main': 60,
+                  'latest': 60,
+                  'toplist': 3600,
+                  'random': None,
+                  'wallpaper': 7 * 24 * 3600}
+
+
+class HttpCache:
+    '''
+    HttpCache
+    HTML页面缓存
+    保存页面文本和ETag、Last-Modified，由WallHaven按页面类型决定新鲜期；
+    过期后用If-None-Match/If-Modified-Since验证，服务器返回304时继续使用缓存的文本
+    持久化到SQLite，总大小超过上限时删除最久未使用的页面
+    '''
+
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, path=None, max_size=64 * 1024 * 1024):
+        if path is None:
+            path = pathlib.Path.cwd().joinpath('cache', 'http.db')
+        os.makedirs(str(pathlib.Path(path).parent), exist_ok=True)
+        self.path = str(path)
+        self.max_size = max_size
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, text TEXT, etag TEXT, '
+                           'last_modified TEXT, stored REAL, used REAL, size INTEGER)')
+        self._conn.commit()
+        self._size = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    @classmethod
+    def shared(cls, path=None):
+        key = str(pathlib.Path(path).resolve()) if path else None
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(path)
+            return cls._shared[key]
+
+    def get(self, url):
+        with self._lock:
+            row = self._conn.execute('SELECT text, etag, last_modified, stored FROM responses WHERE url = ?',
+                                     (url,)).fetchone()
+        return CachedResponse(url, *row) if row else None
+
+    def lookup(self, url, max_age):
+        '''
+        返回(缓存, 是否新鲜)，新鲜的缓存直接使用，不新鲜的用于生成条件请求头
+        '''
+        entry = self.get(url)
+        fresh = entry is not None and time.time() - entry.stored < max_age
+        with self._lock:
+            if fresh:
+                self.hits += 1
+                self._conn.execute('UPDATE responses SET used = ? WHERE url = ?', (time.time(), url))
+                self._conn.commit()
+            elif entry is None:
+                self.misses += 1
+        return entry, fresh
+
+    @staticmethod
+    def conditional_headers(entry):
+        headers = {}
+        if entry is not None and entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry is not None and entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def put(self, url, text, etag=None, last_modified=None):
+        size = len(text.encode('utf-8'))
+        if size > self.max_size:
+            return
+        now = time.time()
+        with self._lock:
+            old = self._conn.execute('SELECT size FROM responses WHERE url = ?', (url,)).fetchone()
+            self._size += size - (old[0] if old else 0)
+            self._conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (url, text, etag, last_modified, now, now, size))
+            self._evict()
+            self._conn.commit()
+
+    def refresh(self, url):
+        '''服务器返回304，页面没有变化，重新开始计算新鲜期'''
+        now = time.time()
+        with self._lock:
+            self.revalidated += 1
+            self._conn.execute('UPDATE responses SET stored = ?, used = ? WHERE url = ?', (now, now, url))
+            self._conn.commit()
+
+    def delete(self, url):
+        with self._lock:
+            row = self._conn.execute('SELECT size FROM responses WHERE url = ?', (url,)).fetchone()
+            if row is not None:
+                self._size -= row[0]
+                self._conn.execute('DELETE FROM responses WHERE url = ?', (url,))
+                self._conn.commit()
+
+    def _evict(self):
+        while self._size > self.max_size:
+            row = self._conn.execute('SELECT url, size FROM responses ORDER BY used LIMIT 1').fetchone()
+            if row is None:
+                break
+            self._conn.execute('DELETE FROM responses WHERE url = ?', (row[0],))
+            self._size -= row[1]
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.revalidated + self.misses
+            count = self._conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+            return {'hits': self.hits,
+                    'revalidated': self.revalidated,
+                    'misses': self.misses,
+                    'hit_ratio': (self.hits + self.revalidated) / total if total else 0.0,
+                    'count': count,
+                    'size': self._size}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class HttpCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.cache = HttpCache(os.path.join(self.dir.name, 'http.db'), max_size=100)
+
+    def tearDown(self):
+        self.cache.close()
+        self.dir.cleanup()
+
+    def test_fresh_and_stale(self):
+        self.assertEqual(self.cache.lookup('a', 60), (None, False))
+        self.cache.put('a', '<html>', '"1"', 'Mon, 01 Jan 2018 00:00:00 GMT')
+        entry, fresh = self.cache.lookup('a', 60)
+        self.assertTrue(fresh)
+        self.assertEqual(entry.text, '<html>')
+        entry, fresh = self.cache.lookup('a', 0)
+        self.assertFalse(fresh)
+        self.assertEqual(HttpCache.conditional_headers(entry),
+                         {'If-None-Match': '"1"', 'If-Modified-Since': 'Mon, 01 Jan 2018 00:00:00 GMT'})
+        self.cache.refresh('a')
+        self.assertEqual(self.cache.stats()['revalidated'], 1)
+
+    def test_evict(self):
+        self.cache.put('a', 'x' * 40)
+        self.cache.put('b', 'x' * 40)
+        self.cache.lookup('a', 60)
+        self.cache.put('c', 'x' * 40)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertIsNotNone(self.cache.get('a'))
+        self.assertEqual(HttpCache(self.cache.path).stats()['size'], 80)
+
+    def test_wallhaven_pages(self):
+        # WallHaven导入本模块，在这里再导入以避免循环导入
+        from FakeServer import FakeWallHavenServer
+        from Benchmark import create_wallhaven
+        from WallHaven import Category
+        with FakeWallHavenServer() as server, tempfile.TemporaryDirectory() as cache_dir:
+            wh = create_wallhaven(server, cache_dir)
+            wh.page_freshness['latest'] = 0
+            first = list(wh.get_category_picture(Category.LATEST, 2))
+            self.assertEqual(list(wh.get_category_picture(Category.LATEST, 2)), first)
+            self.assertEqual(server.not_modified['listing'], 1)
+            list(wh.get_category_picture(Category.TOPLIST, 2))
+            list(wh.get_category_picture(Category.TOPLIST, 2))
+            list(wh.get_category_picture(Category.RANDOM, 2))
+            list(wh.get_category_picture(Category.RANDOM, 2))
+            self.assertEqual(server.requests['listing'], 5)
+            # 壁纸页面只读取到原图地址为止，保存的部分也能解析
+            wh.picture_store.ttl = -1
+            origin_url = wh.get_picture_info('1001')[0]
+            self.assertEqual(wh.get_picture_info('1001')[0], origin_url)
+            self.assertEqual(server.requests['info'], 1)
+            wh.http_cache.close()
+            wh.picture_store.close()
+
+    def test_incomplete_page_not_cached(self):
+        import requests
+        from Benchmark import create_wallhaven
+
+        class Response:
+            status_code = 200
+            headers = {'ETag': '"1"'}
+            encoding = 'utf-8'
+
+            def __init__(self, chunks):
+                self.chunks = chunks
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def iter_content(self, *args, **kwargs):
+                for chunk in self.chunks:
+                    if isinstance(chunk, Exception):
+                        raise chunk
+                    yield chunk
+
+        class Server:
+            url = 'http://127.0.0.1:1'
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            wh = create_wallhaven(Server, cache_dir)
+            url = Server.url + '/wallpaper/1'
+            # 读取到一半连接断开
+            wh._get = lambda *args, **kwargs: Response(['<html><body>', requests.ConnectionError('reset')])
+            with self.assertRaises(requests.ConnectionError):
+                wh.get_picture_info('1')
+            self.assertIsNone(wh.http_cache.get(url))
+            # 完整读取但没有原图地址
+            wh._get = lambda *args, **kwargs: Response(['<html><body>', '</body></html>'])
+            self.assertIsNone(wh.get_picture_info('1'))
+            self.assertIsNone(wh.http_cache.get(url))
+            self.assertEqual(wh.http_cache.stats()['size'], 0)
+            wh.http_cache.close()
+            wh.picture_store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
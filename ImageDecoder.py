@@ -0,0 +1,62 @@
+import os
+import threading
+from concurrent import futures
+from PyQt5 import QtCore, QtGui
+
+
+def decode_image(data, size=None, aspect_mode=QtCore.Qt.KeepAspectRatio,
+                 transform=QtCore.Qt.SmoothTransformation):
+    '''
+    把原始字节解码成QImage，size不为空时缩放到目标大小
+    图片比目标大时通过QImageReader.setScaledSize直接解码成目标大小，不生成原尺寸的图片
+    （JPEG在解码时就按比例缩小）
+    QImage可以在任意线程中使用
+    '''
+    buffer = QtCore.QBuffer()
+    buffer.setData(data)
+    buffer.open(QtCore.QIODevice.ReadOnly)
+    reader = QtGui.QImageReader(buffer)
+    original = reader.size()
+    if size is not None and original.isValid():
+        scaled = original.scaled(size, aspect_mode)
+        if scaled.width() < original.width():
+            reader.setScaledSize(scaled)
+            # JPEG插件中quality不低于50时使用平滑缩放
+            reader.setQuality(100 if transform == QtCore.Qt.SmoothTransformation else 0)
+            size = None
+    image = reader.read()
+    if size is not None and not image.isNull():
+        image = image.scaled(size, aspect_mode, transform)
+    return image
+
+
+class ImageDecoder:
+    '''
+    ImageDecoder
+    图片解码线程池
+    在工作线程中把缩略图和大图解码并缩放成可直接绘制的QImage，GUI线程只负责转换成QPixmap
+    '''
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, max_thread=None):
+        self._executor = futures.ThreadPoolExecutor(max_thread or os.cpu_count() or 2,
+                                                    thread_name_prefix='ImageDecoder')
+
+    @classmethod
+    def shared(cls):
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def decode(self, data, size=None, aspect_mode=QtCore.Qt.KeepAspectRatio,
+               transform=QtCore.Qt.SmoothTransformation):
+        return self._executor.submit(decode_image, data, size, aspect_mode, transform)
+
+    def submit(self, fn, *args):
+        return self._executor.submit(fn, *args)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait)
@@ -0,0 +1,373 @@
+import os
+import re
+import sys
+import sqlite3
+import logging
+import pathlib
+import threading
+import unittest
+import tempfile
+from collections import namedtuple
+from PictureStore import PictureStore
+from PerceptualHash import image_hash
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+log = logging.getLogger('LibraryIndexLog')
+log.setLevel(logging.INFO)
+console_handler = logging.StreamHandler(sys.stdout)
+formatter = logging.Formatter('%(asctime)s %(levelname)-4s: %(message)s')
+console_handler.setFormatter(formatter)
+log.addHandler(console_handler)
+
+LibraryEntry = namedtuple('LibraryEntry', 'id path size mtime resolution alt dhash ahash')
+
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.gif')
+WALLHAVEN_NAME = re.compile(r'wallhaven-(\w+)\.\w+$', re.I)
+
+
+def image_size(path):
+    '''只读取文件头得到(宽, 高)，无法识别时返回None；没有Pillow时才导入Qt，批量下载不需要PyQt'''
+    if Image is not None:
+        try:
+            with Image.open(path) as image:
+                return image.size
+        except OSError:
+            return None
+    from PyQt5 import QtGui
+    size = QtGui.QImageReader(path).size()
+    return (size.width(), size.height()) if size.isValid() else None
+
+
+class LibraryIndex:
+    '''
+    LibraryIndex
+    本地壁纸库索引
+    记录下载目录中每个图片文件的id、大小、修改时间、分辨率、alt和感知哈希，保存在SQLite中
+    扫描时目录的修改时间没有变化就不再列出目录内容，文件的大小和修改时间没有变化就不再读取文件，
+    所以已经建立索引的大目录重新扫描只需要很少的stat调用
+    '''
+
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, root, path=None, picture_store=None):
+        if path is None:
+            path = pathlib.Path.cwd().joinpath('cache', 'library.db')
+        os.makedirs(str(pathlib.Path(path).parent), exist_ok=True)
+        self.root = os.path.abspath(root)
+        self.path = str(path)
+        self.picture_store = picture_store if picture_store is not None else PictureStore.shared()
+        self._lock = threading.Lock()
+        self._scan_lock = threading.Lock()
+        # {文件路径: (size, mtime)}，{id: 文件路径}，{目录: (mtime, [子目录])}
+        self._files = {}
+        self._ids = {}
+        self._dirs = {}
+        # 反向索引，{文件路径: id}，{目录: {文件路径}}，与上面两个字典一起更新，扫描时不必遍历所有文件
+        self._paths = {}
+        self._dir_files = {}
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                           'path TEXT PRIMARY KEY, root TEXT, id TEXT, size INTEGER, mtime INTEGER, '
+                           'width INTEGER, height INTEGER, alt TEXT, dhash TEXT, ahash TEXT)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS files_root_id ON files (root, id)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, root TEXT, mtime INTEGER, '
+                           'subdirs TEXT)')
+        self._conn.commit()
+        for file, id, size, mtime in self._conn.execute('SELECT path, id, size, mtime FROM files WHERE root = ?',
+                                                        (self.root,)):
+            self._put_file(file, size, mtime, id)
+        for dir, mtime, subdirs in self._conn.execute('SELECT path, mtime, subdirs FROM dirs WHERE root = ?',
+                                                      (self.root,)):
+            self._dirs[dir] = (mtime, subdirs.split('\n') if subdirs else [])
+
+    def _put_file(self, file, size, mtime, id):
+        '''调用者持有self._lock（或在初始化中）'''
+        self._files[file] = (size, mtime)
+        self._dir_files.setdefault(os.path.dirname(file), set()).add(file)
+        old = self._paths.get(file)
+        if old and old != id and self._ids.get(old) == file:
+            del self._ids[old]
+        if id:
+            self._ids[id] = file
+            self._paths[file] = id
+        else:
+            self._paths.pop(file, None)
+
+    def _drop_file(self, file):
+        '''调用者持有self._lock'''
+        self._files.pop(file, None)
+        files = self._dir_files.get(os.path.dirname(file))
+        if files is not None:
+            files.discard(file)
+            if not files:
+                del self._dir_files[os.path.dirname(file)]
+        id = self._paths.pop(file, None)
+        if id and self._ids.get(id) == file:
+            del self._ids[id]
+
+    @classmethod
+    def shared(cls, root):
+        key = str(pathlib.Path(root).resolve())
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(root)
+            return cls._shared[key]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._files)
+
+    def scan(self, full=False):
+        '''
+        增量扫描，返回{'added', 'updated', 'removed', 'skipped_dirs'}
+        full为True时忽略目录的修改时间，用于发现原地修改的文件
+        '''
+        result = {'added': 0, 'updated': 0, 'removed': 0, 'skipped_dirs': 0}
+        with self._scan_lock:
+            seen_dirs = set()
+            stack = [self.root]
+            while stack:
+                dir = stack.pop()
+                try:
+                    mtime = os.stat(dir).st_mtime_ns
+                except OSError:
+                    continue
+                seen_dirs.add(dir)
+                known = self._dirs.get(dir)
+                if not full and known is not None and known[0] == mtime:
+                    # 目录中没有文件增删或改名
+                    result['skipped_dirs'] += 1
+                    stack.extend(known[1])
+                    continue
+                subdirs = self._scan_dir(dir, result)
+                self._set_dir(dir, mtime, subdirs)
+                stack.extend(subdirs)
+            for dir in [dir for dir in self._dirs if dir not in seen_dirs]:
+                result['removed'] += self._remove_dir(dir)
+        if result['added'] or result['updated'] or result['removed']:
+            log.info('library {}: {added} added, {updated} updated, {removed} removed'.format(self.root, **result))
+        return result
+
+    def _scan_dir(self, dir, result):
+        subdirs = []
+        present = set()
+        try:
+            entries = list(os.scandir(dir))
+        except OSError:
+            entries = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                    continue
+                if not entry.name.lower().endswith(IMAGE_SUFFIXES):
+                    continue
+                stat = entry.stat()
+            except OSError:
+                continue
+            present.add(entry.path)
+            with self._lock:
+                known = self._files.get(entry.path)
+            if known == (stat.st_size, stat.st_mtime_ns):
+                continue
+            self._index_file(entry.path, stat, commit=False)
+            result['updated' if known else 'added'] += 1
+        with self._lock:
+            removed = [file for file in self._dir_files.get(dir, ()) if file not in present]
+        for file in removed:
+            self._remove_file(file, commit=False)
+        result['removed'] += len(removed)
+        # 整个目录只提交一次，首次扫描大目录时避免每个文件都写一次磁盘
+        with self._lock:
+            self._conn.commit()
+        return subdirs
+
+    def add_file(self, file, id=None, resolution=None, hashes=None, analyze=True):
+        '''
+        下载完成后直接登记文件，不必等待下一次扫描
+        resolution和hashes已经由后处理得到时直接使用；analyze为False时不读取文件计算哈希
+        '''
+        file = os.path.abspath(file)
+        return self._index_file(file, os.stat(file), id, resolution=resolution, hashes=hashes, analyze=analyze)
+
+    def _index_file(self, file, stat, id=None, commit=True, resolution=None, hashes=None, analyze=True):
+        if id is None:
+            match = WALLHAVEN_NAME.match(os.path.basename(file))
+            id = match.group(1) if match else None
+        if id is None:
+            with self._lock:
+                id = self._paths.get(file)
+        if resolution is None:
+            resolution = image_size(file)
+        if hashes is None and analyze:
+            try:
+                hashes = image_hash(file)
+            except (OSError, ValueError):
+                pass
+        dhash, ahash = hashes if hashes else (None, None)
+        info = self.picture_store.get(id) if id else None
+        entry = LibraryEntry(id, file, stat.st_size, stat.st_mtime_ns, resolution, info.alt if info else None,
+                             dhash, ahash)
+        width, height = resolution if resolution else (None, None)
+        with self._lock:
+            self._put_file(file, stat.st_size, stat.st_mtime_ns, id)
+            self._conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                               (file, self.root, id, stat.st_size, stat.st_mtime_ns, width, height, entry.alt,
+                                None if dhash is None else '{:016x}'.format(dhash),
+                                None if ahash is None else '{:016x}'.format(ahash)))
+            if commit:
+                self._conn.commit()
+        return entry
+
+    def _remove_file(self, file, commit=True):
+        with self._lock:
+            self._drop_file(file)
+            self._conn.execute('DELETE FROM files WHERE path = ?', (file,))
+            if commit:
+                self._conn.commit()
+
+    def _set_dir(self, dir, mtime, subdirs):
+        with self._lock:
+            self._dirs[dir] = (mtime, subdirs)
+            self._conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)',
+                               (dir, self.root, mtime, '\n'.join(subdirs)))
+            self._conn.commit()
+
+    def _remove_dir(self, dir):
+        with self._lock:
+            files = list(self._dir_files.get(dir, ()))
+            self._dirs.pop(dir, None)
+            self._conn.execute('DELETE FROM dirs WHERE path = ?', (dir,))
+            self._conn.commit()
+        for file in files:
+            self._remove_file(file, commit=False)
+        with self._lock:
+            self._conn.commit()
+        return len(files)
+
+    def has(self, id):
+        '''是否已经有这张壁纸，文件被删除但还没有重新扫描时返回False'''
+        with self._lock:
+            file = self._ids.get(str(id))
+        return file is not None and os.path.exists(file)
+
+    def get(self, id):
+        with self._lock:
+            row = self._conn.execute('SELECT id, path, size, mtime, width, height, alt, dhash, ahash FROM files '
+                                     'WHERE root = ? AND id = ?', (self.root, str(id))).fetchone()
+        return self._entry(row) if row else None
+
+    def entries(self, offset=0, limit=-1):
+        '''按修改时间从新到旧分页列出本地壁纸'''
+        with self._lock:
+            rows = self._conn.execute('SELECT id, path, size, mtime, width, height, alt, dhash, ahash FROM files '
+                                      'WHERE root = ? ORDER BY mtime DESC LIMIT ? OFFSET ?',
+                                      (self.root, limit, offset)).fetchall()
+        return [self._entry(row) for row in rows]
+
+    def hashes(self):
+        '''返回[(id, path, (dhash, ahash))]，用于填充感知哈希索引'''
+        with self._lock:
+            rows = self._conn.execute('SELECT id, path, dhash, ahash FROM files '
+                                      'WHERE root = ? AND id IS NOT NULL AND dhash IS NOT NULL',
+                                      (self.root,)).fetchall()
+        return [(id, file, (int(d, 16), int(a, 16))) for id, file, d, a in rows]
+
+    def directories(self):
+        with self._lock:
+            return list(self._dirs)
+
+    @staticmethod
+    def _entry(row):
+        id, file, size, mtime, width, height, alt, dhash, ahash = row
+        return LibraryEntry(id, file, size, mtime, (width, height) if width else None, alt,
+                            int(dhash, 16) if dhash else None, int(ahash, 16) if ahash else None)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class LibraryIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.dir.name, 'wallpapers')
+        os.makedirs(self.root)
+        self.store = PictureStore(os.path.join(self.dir.name, 'picture.db'))
+        self.db = os.path.join(self.dir.name, 'library.db')
+
+    def tearDown(self):
+        self.store.close()
+        self.dir.cleanup()
+
+    def write(self, name, width=90, height=60):
+        from PyQt5 import QtGui
+        path = os.path.join(self.root, name)
+        image = QtGui.QImage(width, height, QtGui.QImage.Format_RGB32)
+        image.fill(QtGui.QColor(width % 256, height % 256, 128))
+        image.save(path, 'PNG')
+        return path
+
+    def test_scan(self):
+        self.store.put('abc', 'url', 'General 90x60 mountains')
+        self.write('wallhaven-abc.png')
+        self.write('other.png', 30, 20)
+        open(os.path.join(self.root, 'wallhaven-def.jpg.part'), 'wb').close()
+        library = LibraryIndex(self.root, self.db, self.store)
+        self.assertEqual(library.scan()['added'], 2)
+        entry = library.get('abc')
+        self.assertEqual(entry.resolution, (90, 60))
+        self.assertEqual(entry.alt, 'General 90x60 mountains')
+        self.assertIsNotNone(entry.dhash)
+        self.assertTrue(library.has('abc'))
+        self.assertFalse(library.has('def'))
+        self.assertEqual(len(library.hashes()), 1)
+
+    def test_incremental(self):
+        library = LibraryIndex(self.root, self.db, self.store)
+        self.write('wallhaven-abc.png')
+        library.scan()
+        self.assertEqual(library.scan()['skipped_dirs'], 1)
+        os.remove(os.path.join(self.root, 'wallhaven-abc.png'))
+        os.makedirs(os.path.join(self.root, 'sub'))
+        self.write(os.path.join('sub', 'wallhaven-def.png'))
+        result = LibraryIndex(self.root, self.db, self.store).scan()
+        self.assertEqual((result['added'], result['removed']), (1, 1))
+        library = LibraryIndex(self.root, self.db, self.store)
+        self.assertEqual([entry.id for entry in library.entries()], ['def'])
+        self.assertEqual(library.scan()['skipped_dirs'], 2)
+
+    def test_add_file(self):
+        library = LibraryIndex(self.root, self.db, self.store)
+        library.add_file(self.write('renamed.png'), 'xyz')
+        self.assertTrue(library.has('xyz'))
+        self.assertEqual(library.scan()['added'], 0)
+
+    def test_remove_dir_and_keep_id(self):
+        library = LibraryIndex(self.root, self.db, self.store)
+        sub = os.path.join(self.root, 'sub')
+        os.makedirs(sub)
+        renamed = library.add_file(self.write(os.path.join('sub', 'renamed.png')), 'xyz').path
+        self.write('wallhaven-abc.png')
+        library.scan()
+        # 文件被修改后重新读取，仍然保留下载时登记的id
+        self.write(os.path.join('sub', 'renamed.png'), 30, 20)
+        self.assertEqual(library.scan(full=True)['updated'], 1)
+        self.assertEqual(library.get('xyz').path, renamed)
+        for name in os.listdir(sub):
+            os.remove(os.path.join(sub, name))
+        os.rmdir(sub)
+        self.assertEqual(library.scan()['removed'], 1)
+        self.assertFalse(library.has('xyz'))
+        self.assertTrue(library.has('abc'))
+        self.assertEqual(len(library), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import sys
+import logging
+from concurrent import futures
+from PyQt5 import QtCore
+
+log = logging.getLogger('LibraryWatcherLog')
+log.setLevel(logging.INFO)
+console_handler = logging.StreamHandler(sys.stdout)
+formatter = logging.Formatter('%(asctime)s %(levelname)-4s: %(message)s')
+console_handler.setFormatter(formatter)
+log.addHandler(console_handler)
+
+
+class LibraryWatcher(QtCore.QObject):
+    '''
+    LibraryWatcher
+    本地壁纸库监视器
+    用QFileSystemWatcher监视下载目录，目录变化后稍等片刻在后台线程中增量扫描
+    '''
+
+    library_changed_signal = QtCore.pyqtSignal(dict)
+
+    def __init__(self, library, delay=500, parent=None):
+        super().__init__(parent)
+        self.library = library
+        self.watcher = QtCore.QFileSystemWatcher(self)
+        self.watcher.directoryChanged.connect(self.directory_changed_slot)
+        # 下载时会连续产生多次变化，合并成一次扫描
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(delay)
+        self.timer.timeout.connect(self.scan)
+        self.executor = futures.ThreadPoolExecutor(1)
+        self.library_changed_signal.connect(self.library_changed_slot)
+        if os.path.isdir(library.root):
+            self.watcher.addPath(library.root)
+
+    def start(self):
+        self.scan()
+
+    @QtCore.pyqtSlot(str)
+    def directory_changed_slot(self, path):
+        self.timer.start()
+
+    @QtCore.pyqtSlot()
+    def scan(self):
+        self.executor.submit(self._scan).add_done_callback(self._scan_done)
+
+    def _scan(self):
+        return self.library.scan()
+
+    def _scan_done(self, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            log.error('scan library {} failed: {}'.format(self.library.root, e))
+            return
+        # 信号可以在工作线程中发出，由Qt排队送到主线程
+        self.library_changed_signal.emit(result)
+
+    @QtCore.pyqtSlot(dict)
+    def library_changed_slot(self, result):
+        watched = set(self.watcher.directories())
+        dirs = [dir for dir in self.library.directories() if dir not in watched]
+        if dirs:
+            self.watcher.addPaths(dirs)
+
+    def stop(self):
+        self.timer.stop()
+        self.executor.shutdown(wait=False)
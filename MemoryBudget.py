@@ -0,0 +1,128 @@
+import threading
+import unittest
+from collections import OrderedDict
+
+
+class MemoryBudget:
+    '''
+    MemoryBudget
+    全局内存预算
+    缩略图缓存、预览数据和解码后的图片在这里登记占用的字节数，总量超过上限时
+    按最久未使用的顺序调用各自的释放回调；没有释放回调的项目只计入总量，不会被释放
+    '''
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, limit=256 * 1024 * 1024):
+        self.limit = limit
+        self.used = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def set_limit(self, limit):
+        with self._lock:
+            self.limit = limit
+            evicted = self._collect()
+        self._evict(evicted)
+
+    def charge(self, owner, key, size, evict=None):
+        '''
+        登记(owner, key)占用size字节，重复登记时更新大小
+        超出预算时释放其他项目，evict(key)在释放时被调用
+        '''
+        with self._lock:
+            old = self._items.pop((owner, key), None)
+            if old is not None:
+                self.used -= old[0]
+            self._items[(owner, key)] = (size, evict)
+            self.used += size
+            evicted = self._collect(exclude=(owner, key))
+        self._evict(evicted)
+
+    def touch(self, owner, key):
+        with self._lock:
+            if (owner, key) in self._items:
+                self._items.move_to_end((owner, key))
+
+    def release(self, owner, key):
+        with self._lock:
+            item = self._items.pop((owner, key), None)
+            if item is not None:
+                self.used -= item[0]
+
+    def _collect(self, exclude=None):
+        evicted = []
+        for item_key in list(self._items):
+            if self.used <= self.limit:
+                break
+            size, evict = self._items[item_key]
+            if evict is None or item_key == exclude:
+                continue
+            del self._items[item_key]
+            self.used -= size
+            self.evictions += 1
+            evicted.append((evict, item_key[1]))
+        return evicted
+
+    @staticmethod
+    def _evict(evicted):
+        # 在锁外回调，回调中可以再调用release
+        for evict, key in evicted:
+            evict(key)
+
+    def stats(self):
+        with self._lock:
+            owners = {}
+            for (owner, key), (size, evict) in self._items.items():
+                owners[owner] = owners.get(owner, 0) + size
+            return {'limit': self.limit,
+                    'used': self.used,
+                    'count': len(self._items),
+                    'evictions': self.evictions,
+                    'owners': owners}
+
+
+class MemoryBudgetTest(unittest.TestCase):
+
+    def test_evict_lru(self):
+        budget = MemoryBudget(100)
+        evicted = []
+        budget.charge('thumb', 'a', 40, evicted.append)
+        budget.charge('thumb', 'b', 40, evicted.append)
+        budget.touch('thumb', 'a')
+        budget.charge('preview', 'buffer', 40, evicted.append)
+        self.assertEqual(evicted, ['b'])
+        self.assertEqual(budget.used, 80)
+
+    def test_pinned(self):
+        budget = MemoryBudget(100)
+        evicted = []
+        budget.charge('preview', 'image', 90)
+        budget.charge('thumb', 'a', 20, evicted.append)
+        self.assertEqual(budget.used, 110)
+        budget.charge('thumb', 'b', 20, evicted.append)
+        self.assertEqual(evicted, ['a'])
+        budget.release('preview', 'image')
+        self.assertEqual(budget.used, 20)
+
+    def test_set_limit(self):
+        budget = MemoryBudget(100)
+        evicted = []
+        for key in 'abc':
+            budget.charge('thumb', key, 30, evicted.append)
+        budget.set_limit(40)
+        self.assertEqual(evicted, ['a', 'b'])
+        self.assertEqual(budget.stats()['owners'], {'thumb': 30})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+import json
+import time
+import threading
+import unittest
+from collections import namedtuple, deque, defaultdict
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+RequestRecord = namedtuple('RequestRecord', 'operation url status bytes connect ttfb duration')
+
+_local = threading.local()
+
+
+def _add_connect_time(seconds):
+    _local.connect_time = getattr(_local, 'connect_time', 0.0) + seconds
+
+
+class TimedHTTPConnection(HTTPConnection):
+
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        _add_connect_time(time.perf_counter() - start)
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        _add_connect_time(time.perf_counter() - start)
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    '''新建连接时记录建立连接（含TLS握手）的耗时，复用的连接耗时为0'''
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool,
+                                                   'https': TimedHTTPSConnectionPool}
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(int(round(q / 100.0 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+class NetStats:
+    '''
+    NetStats
+    网络请求统计
+    记录每个请求的建立连接耗时、首字节耗时、字节数、总耗时和状态码，按操作类型汇总成分位数
+    同时汇总各个缓存的命中率，可以导出为JSON
+    '''
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, max_records=10000):
+        self._records = deque(maxlen=max_records)
+        self._caches = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @staticmethod
+    def install(session):
+        '''给session挂载可以统计建立连接耗时的适配器'''
+        for prefix in ('http://', 'https://'):
+            if not isinstance(session.get_adapter(prefix), TimedHTTPAdapter):
+                session.mount(prefix, TimedHTTPAdapter())
+
+    def register_cache(self, name, cache):
+        '''cache需要提供stats()方法，返回包含hit_ratio的字典'''
+        with self._lock:
+            self._caches[name] = cache
+
+    def record(self, operation, url, status, size, connect, ttfb, duration):
+        with self._lock:
+            self._records.append(RequestRecord(operation, url, status, size, connect, ttfb, duration))
+
+    def request(self, session, method, url, operation, **kwargs):
+        '''
+        通过session发送请求并记录
+        stream=True时在内容读取完毕（或响应关闭）后才记录字节数和总耗时
+        '''
+        _local.connect_time = 0.0
+        start = time.perf_counter()
+        try:
+            rsp = session.request(method, url, **kwargs)
+        except Exception:
+            self.record(operation, url, 0, 0, _local.connect_time, None, time.perf_counter() - start)
+            raise
+        connect = _local.connect_time
+        # requests在收到响应头后返回，stream=False时内容已经读取完毕
+        ttfb = rsp.elapsed.total_seconds()
+        if not kwargs.get('stream'):
+            self.record(operation, url, rsp.status_code, len(rsp.content), connect, ttfb,
+                        time.perf_counter() - start)
+            return rsp
+        iter_content = rsp.iter_content
+        recorded = []
+
+        def finish():
+            if not recorded:
+                recorded.append(True)
+                size = rsp.raw.tell() if hasattr(rsp.raw, 'tell') else 0
+                self.record(operation, url, rsp.status_code, size, connect, ttfb, time.perf_counter() - start)
+
+        def timed_iter_content(*args, **kw):
+            try:
+                yield from iter_content(*args, **kw)
+            finally:
+                finish()
+
+        close = rsp.close
+
+        def timed_close():
+            finish()
+            close()
+        rsp.iter_content = timed_iter_content
+        rsp.close = timed_close
+        return rsp
+
+    def records(self):
+        with self._lock:
+            return list(self._records)
+
+    def summary(self):
+        groups = defaultdict(list)
+        for record in self.records():
+            groups[record.operation].append(record)
+        operations = {}
+        for operation, records in groups.items():
+            item = {'count': len(records),
+                    'errors': sum(1 for r in records if r.status == 0 or r.status >= 400),
+                    'bytes': sum(r.bytes for r in records),
+                    'new_connections': sum(1 for r in records if r.connect)}
+            for field in ('connect', 'ttfb', 'duration'):
+                values = [getattr(r, field) for r in records if getattr(r, field) is not None]
+                for q in (50, 90, 99):
+                    item['{}_p{}'.format(field, q)] = percentile(values, q)
+            operations[operation] = item
+        with self._lock:
+            caches = dict(self._caches)
+        return {'operations': operations,
+                'caches': {name: cache.stats() for name, cache in caches.items()}}
+
+    def to_json(self):
+        return json.dumps(self.summary(), indent=2)
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            f.write(self.to_json())
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+
+class NetStatsTest(unittest.TestCase):
+
+    def test_percentile(self):
+        self.assertEqual(percentile([3, 1, 2], 50), 2)
+        self.assertEqual(percentile(list(range(101)), 90), 90)
+        self.assertIsNone(percentile([], 50))
+
+    def test_summary(self):
+        stats = NetStats()
+        stats.record('thumb', 'a', 200, 100, 0.01, 0.02, 0.03)
+        stats.record('thumb', 'b', 503, 10, 0.0, 0.01, 0.01)
+        stats.record('origin', 'c', 206, 1000, 0.0, 0.05, 0.5)
+        summary = stats.summary()
+        self.assertEqual(summary['operations']['thumb']['count'], 2)
+        self.assertEqual(summary['operations']['thumb']['errors'], 1)
+        self.assertEqual(summary['operations']['thumb']['new_connections'], 1)
+        self.assertEqual(summary['operations']['origin']['duration_p50'], 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
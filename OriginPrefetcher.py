@@ -0,0 +1,177 @@
+import os
+import pathlib
+import threading
+import unittest
+import tempfile
+from FetchScheduler import FetchScheduler, Priority
+from ThumbnailCache import ThumbnailCache
+from Transport import TransportConfig
+
+
+def origin_cache(path=None, max_size=256 * 1024 * 1024):
+    '''保存原图开头部分的磁盘缓存，PictureLoader和OriginPrefetcher共用'''
+    if path is None:
+        path = pathlib.Path.cwd().joinpath('cache', 'origin')
+    return ThumbnailCache.shared(path, max_size)
+
+
+def origin_key(id):
+    return 'wallhaven-{}'.format(id)
+
+
+class OriginPrefetcher:
+    '''
+    OriginPrefetcher
+    原图推测预取
+    为可能马上要预览的壁纸（鼠标停留的缩略图、正在预览的壁纸的前后两张）预先下载原图开头的prefix_size字节，
+    足够大图预览立即显示出渐进的画面
+    任务以最低的SPECULATIVE优先级提交，原因不再成立时（鼠标移开、预览关闭）立即取消，
+    正在下载的任务在下一个数据块时退出
+    '''
+
+    def __init__(self, wh, scheduler=None, cache=None, prefix_size=2 * 1024 * 1024):
+        self.wh = wh
+        self.scheduler = scheduler if scheduler is not None else FetchScheduler.shared()
+        self.cache = cache if cache is not None else origin_cache()
+        self.prefix_size = prefix_size
+        self.wh.stats.register_cache('origin_prefix', self.cache)
+        self.fetched = 0
+        self.cancelled = 0
+        self._chunk_size = 64 * 1024
+        self._lock = threading.Lock()
+        # 原因 -> id列表，例如'hover'、'neighbour'
+        self._wanted = {}
+        self._futures = {}
+
+    def set_wanted(self, reason, ids):
+        '''设置某个原因下想要预取的id，不再被任何原因需要的预取会被取消'''
+        ids = [str(id) for id in ids]
+        with self._lock:
+            self._wanted[reason] = ids
+            wanted = self._wanted_ids()
+            dropped = [id for id in self._futures if id not in wanted]
+            for id in dropped:
+                self._futures.pop(id)
+            new = [id for id in ids if id not in self._futures and origin_key(id) not in self.cache]
+            for id in new:
+                self._futures[id] = None
+        for id in dropped:
+            self.scheduler.cancel(self._group(id))
+            with self._lock:
+                self.cancelled += 1
+        for id in new:
+            future = self.scheduler.submit(self._group(id), self._prefetch, id, priority=Priority.SPECULATIVE)
+            with self._lock:
+                if id in self._futures:
+                    self._futures[id] = future
+            future.add_done_callback(lambda f, id=id: self._done(id, f))
+
+    def cancel(self, reason=None):
+        '''取消某个原因（为空时取消全部）的预取'''
+        if reason is None:
+            with self._lock:
+                reasons = list(self._wanted)
+        else:
+            reasons = [reason]
+        for reason in reasons:
+            self.set_wanted(reason, [])
+
+    def _wanted_ids(self):
+        return {id for ids in self._wanted.values() for id in ids}
+
+    def is_wanted(self, id):
+        with self._lock:
+            return id in self._futures
+
+    @staticmethod
+    def _group(id):
+        return 'origin-prefetch', id
+
+    def _done(self, id, future):
+        with self._lock:
+            if self._futures.get(id) is future:
+                self._futures.pop(id)
+
+    def _prefetch(self, id):
+        if not self.is_wanted(id) or origin_key(id) in self.cache:
+            return
+        data_iter, size = self.wh.get_origin_data(id, 0, self.prefix_size, 'speculative')
+        data = bytearray()
+        try:
+            for block in data_iter:
+                # 不再需要时直接退出，关闭响应，连接还给可见缩略图使用
+                if not self.is_wanted(id):
+                    return
+                data += block
+        finally:
+            data_iter.close()
+        self.cache.put(origin_key(id), bytes(data[:self.prefix_size]))
+        with self._lock:
+            self.fetched += 1
+
+    def stats(self):
+        with self._lock:
+            return {'fetched': self.fetched,
+                    'cancelled': self.cancelled,
+                    'pending': len(self._futures),
+                    'cache': self.cache.stats()}
+
+
+class OriginPrefetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        from FakeServer import FakeWallHavenServer
+        from Benchmark import create_wallhaven
+        self.server = FakeWallHavenServer(origin_size=1024 * 1024).start()
+        self.dir = tempfile.TemporaryDirectory()
+        self.wh = create_wallhaven(self.server, self.dir.name)
+        self.scheduler = FetchScheduler(2)
+        self.prefetcher = OriginPrefetcher(self.wh, self.scheduler, ThumbnailCache(os.path.join(self.dir.name, 'o')),
+                                           prefix_size=256 * 1024)
+
+    def tearDown(self):
+        self.scheduler.shutdown()
+        self.wh.picture_store.close()
+        self.server.stop()
+        self.dir.cleanup()
+
+    def wait_idle(self):
+        while self.prefetcher.stats()['pending']:
+            threading.Event().wait(0.01)
+
+    def test_prefetch_prefix(self):
+        self.prefetcher.set_wanted('hover', ['1001'])
+        self.wait_idle()
+        self.assertEqual(self.prefetcher.cache.get(origin_key('1001')), self.server.origin[:256 * 1024])
+        self.assertEqual(self.wh.picture_store.get('1001').content_length, 1024 * 1024)
+
+    def test_release_connection(self):
+        # 只有一个连接，提前退出的预取没有关闭响应时下一个请求会一直等待
+        self.wh.set_transport(TransportConfig(pool_maxsize=1, pool_block=True))
+        self.wh.get_picture_info('1001')
+        self.prefetcher.prefix_size = 1024 * 1024
+        checks = []
+        # 读到第二个数据块时不再需要
+        self.prefetcher.is_wanted = lambda id: checks.append(id) or len(checks) < 3
+        self.prefetcher._prefetch('1001')
+        thread = threading.Thread(target=self.wh.get_preview_data, args=('1002',), daemon=True)
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertNotIn(origin_key('1001'), self.prefetcher.cache)
+
+    def test_cancel(self):
+        gate = threading.Event()
+        for i in range(2):
+            self.scheduler.submit('block', gate.wait, priority=Priority.VISIBLE)
+        self.prefetcher.set_wanted('neighbour', ['1001', '1002'])
+        self.prefetcher.set_wanted('neighbour', ['1002'])
+        gate.set()
+        self.wait_idle()
+        self.assertNotIn(origin_key('1001'), self.prefetcher.cache)
+        self.assertIn(origin_key('1002'), self.prefetcher.cache)
+        self.assertEqual(self.prefetcher.stats()['cancelled'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,224 @@
+import time
+import itertools
+import threading
+import unittest
+from collections import OrderedDict, deque
+from FetchScheduler import FetchScheduler, Priority
+
+
+class PagePrefetcher:
+    '''
+    PagePrefetcher
+    翻页预取
+    浏览第N页时在后台拉取N+1页的列表和缩略图，缩略图写入磁盘缓存
+    无限滚动时第N-1页总是在第N页之前加载过，不再预取
+    任务以PREFETCH优先级提交到全局调度器，同时执行的任务数不超过max_thread
+    同一分类再次翻页时，尚未完成的旧预取任务会被丢弃
+    限速时不在调度器的线程中等待，而是推迟提交下一个任务，工作线程留给可见页的加载
+    '''
+
+    def __init__(self, wh, scheduler=None, max_thread=2, max_bytes_per_second=0, max_age=300, max_pages=16):
+        self.wh = wh
+        self.scheduler = scheduler if scheduler is not None else FetchScheduler.shared()
+        self.max_thread = max_thread
+        self.max_bytes_per_second = max_bytes_per_second
+        self.max_age = max_age
+        self.max_pages = max_pages
+        self._lock = threading.Lock()
+        # 每个分类一个代数，翻页后旧代数的任务直接退出
+        self._generation = {}
+        # (category, page) -> (时间, id列表)
+        self._listings = OrderedDict()
+        self._queue = deque()
+        self._inflight = 0
+        # 已提交到调度器的任务，shutdown时用来找出被取消的任务
+        self._tasks = {}
+        self._counter = itertools.count()
+        self._next_send_time = 0.0
+        self._timer = None
+
+    def listing(self, category, page):
+        '''返回预取到的列表，没有或已过期时返回None'''
+        with self._lock:
+            item = self._listings.get((category, page))
+        if item is None or time.time() - item[0] > self.max_age:
+            return None
+        return item[1]
+
+    def prefetch_next(self, category, page):
+        with self._lock:
+            generation = self._generation.get(category, 0) + 1
+            self._generation[category] = generation
+        self._enqueue(generation, category, self._prefetch_listing, page + 1)
+
+    def cancel(self, category):
+        with self._lock:
+            self._generation[category] = self._generation.get(category, 0) + 1
+
+    def is_idle(self):
+        with self._lock:
+            return self._inflight == 0 and not self._queue
+
+    def _is_stale(self, generation, category):
+        with self._lock:
+            return self._generation.get(category) != generation
+
+    def _enqueue(self, generation, category, fn, *args):
+        with self._lock:
+            self._queue.append((generation, category, fn, args))
+            self._pump()
+
+    def _pump(self):
+        # 调用时必须持有self._lock
+        while self._inflight < self.max_thread and self._queue:
+            wait = self._next_send_time - time.monotonic()
+            if wait > 0:
+                # 超过带宽限制，到时间后再提交
+                if self._timer is None:
+                    self._timer = threading.Timer(wait, self._resume)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+            item = self._queue.popleft()
+            generation, category = item[:2]
+            if self._generation.get(category) != generation:
+                continue
+            self._inflight += 1
+            token = next(self._counter)
+            self._tasks[token] = self.scheduler.submit(self, self._run, token, item, priority=Priority.PREFETCH)
+
+    def _resume(self):
+        with self._lock:
+            self._timer = None
+            self._pump()
+
+    def _run(self, token, item):
+        generation, category, fn, args = item
+        try:
+            if not self._is_stale(generation, category):
+                fn(generation, category, *args)
+        finally:
+            with self._lock:
+                self._tasks.pop(token, None)
+                self._inflight -= 1
+                self._pump()
+
+    def _prefetch_listing(self, generation, category, page):
+        ids = self.listing(category, page)
+        if ids is None:
+            ids = list(self.wh.get_category_picture(category, page))
+            with self._lock:
+                self._listings[(category, page)] = (time.time(), ids)
+                self._listings.move_to_end((category, page))
+                while len(self._listings) > self.max_pages:
+                    self._listings.popitem(last=False)
+        for id in ids:
+            if 'th-{}.jpg'.format(id) not in self.wh.thumb_cache:
+                self._enqueue(generation, category, self._prefetch_thumb, id)
+
+    def _prefetch_thumb(self, generation, category, id):
+        if 'th-{}.jpg'.format(id) in self.wh.thumb_cache:
+            return
+        self._throttle(len(self.wh.get_preview_data(id)))
+
+    def _throttle(self, size):
+        '''简单的令牌桶，限制预取占用的带宽；只推迟下一个任务的提交，不在这里等待'''
+        if not self.max_bytes_per_second:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._next_send_time = max(self._next_send_time, now) + size / self.max_bytes_per_second
+
+    def shutdown(self):
+        with self._lock:
+            for category in self._generation:
+                self._generation[category] += 1
+            self._queue.clear()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        self.scheduler.cancel(self)
+        # 被取消的任务不会运行，在这里减去
+        with self._lock:
+            for token, future in list(self._tasks.items()):
+                if future.cancelled():
+                    del self._tasks[token]
+                    self._inflight -= 1
+
+
+class _FakeWallHaven:
+
+    def __init__(self):
+        self.thumb_cache = set()
+        self.fetched = []
+
+    def get_category_picture(self, category, page=1):
+        return iter([str(page * 10 + i) for i in range(3)])
+
+    def get_preview_data(self, id):
+        self.fetched.append(id)
+        self.thumb_cache.add('th-{}.jpg'.format(id))
+        return b'x' * 10
+
+
+class PagePrefetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = FetchScheduler(2)
+        self.wh = _FakeWallHaven()
+        self.prefetcher = PagePrefetcher(self.wh, self.scheduler, max_thread=1)
+
+    def tearDown(self):
+        self.scheduler.shutdown()
+
+    def wait_idle(self):
+        deadline = time.monotonic() + 5
+        while not self.prefetcher.is_idle() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_prefetch_next(self):
+        self.prefetcher.prefetch_next('latest', 2)
+        self.wait_idle()
+        self.assertEqual(self.prefetcher.listing('latest', 3), ['30', '31', '32'])
+        self.assertIsNone(self.prefetcher.listing('latest', 1))
+        self.assertIsNone(self.prefetcher.listing('latest', 2))
+        self.assertEqual(sorted(self.wh.fetched), ['30', '31', '32'])
+
+    def test_drop_stale(self):
+        self.prefetcher.cancel('latest')
+        self.prefetcher._enqueue(0, 'latest', self.prefetcher._prefetch_listing, 5)
+        self.wait_idle()
+        self.assertEqual(self.wh.fetched, [])
+        self.assertIsNone(self.prefetcher.listing('latest', 5))
+
+    def test_throttle_does_not_hold_worker(self):
+        scheduler = FetchScheduler(1)
+        # 每个缩略图10字节，每秒10字节：第一个之后的缩略图要等待
+        prefetcher = PagePrefetcher(self.wh, scheduler, max_thread=1, max_bytes_per_second=10)
+        prefetcher.prefetch_next('latest', 1)
+        deadline = time.monotonic() + 5
+        while len(self.wh.fetched) < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        start = time.monotonic()
+        scheduler.submit('visible', lambda: None, priority=Priority.VISIBLE).result(5)
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertFalse(prefetcher.is_idle())
+        prefetcher.shutdown()
+        self.assertTrue(prefetcher.is_idle())
+        scheduler.shutdown()
+
+    def test_shutdown_cancelled(self):
+        scheduler = FetchScheduler(1)
+        gate = threading.Event()
+        scheduler.submit('block', gate.wait, priority=Priority.VISIBLE)
+        prefetcher = PagePrefetcher(self.wh, scheduler, max_thread=2)
+        prefetcher.prefetch_next('latest', 2)
+        self.assertFalse(prefetcher.is_idle())
+        prefetcher.shutdown()
+        self.assertTrue(prefetcher.is_idle())
+        gate.set()
+        scheduler.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,290 @@
+import os
+import pathlib
+import sqlite3
+import threading
+import unittest
+import tempfile
+import numpy as np
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# wallhaven的小缩略图是居中裁剪的3:2图片，原图先裁剪成同样的比例再计算，两者的哈希才可比较
+THUMB_ASPECT = 3 / 2
+
+
+def _crop_box(width, height, aspect):
+    if not aspect or not width or not height:
+        return 0, 0, width, height
+    if width / height > aspect:
+        crop_width = int(round(height * aspect))
+        left = (width - crop_width) // 2
+        return left, 0, left + crop_width, height
+    crop_height = int(round(width / aspect))
+    top = (height - crop_height) // 2
+    return 0, top, width, top + crop_height
+
+
+def _gray_pillow(source, size, aspect):
+    with Image.open(source) as image:
+        # JPEG在解码时直接缩小，大图也只需要很少的内存和时间
+        image.draft('L', (size[0] * 8, size[1] * 8))
+        image = image.convert('L')
+        image = image.crop(_crop_box(image.width, image.height, aspect))
+        return np.asarray(image.resize(size, Image.BILINEAR), dtype=np.float32)
+
+
+def _gray_qt(source, size, aspect):
+    from PyQt5 import QtCore, QtGui
+    reader = QtGui.QImageReader(source) if isinstance(source, str) else None
+    if reader is None:
+        buffer = QtCore.QBuffer()
+        buffer.setData(source.getvalue())
+        buffer.open(QtCore.QIODevice.ReadOnly)
+        reader = QtGui.QImageReader(buffer)
+    image = reader.read()
+    if image.isNull():
+        raise ValueError('cannot decode image')
+    left, top, right, bottom = _crop_box(image.width(), image.height(), aspect)
+    image = image.copy(left, top, right - left, bottom - top)
+    image = image.scaled(size[0], size[1], QtCore.Qt.IgnoreAspectRatio, QtCore.Qt.SmoothTransformation)
+    image = image.convertToFormat(QtGui.QImage.Format_Grayscale8)
+    pointer = image.constBits()
+    pointer.setsize(image.bytesPerLine() * image.height())
+    pixels = np.frombuffer(pointer, np.uint8).reshape(image.height(), image.bytesPerLine())
+    return pixels[:, :image.width()].astype(np.float32)
+
+
+def gray_pixels(data_or_path, size, aspect=THUMB_ASPECT):
+    '''
+    把图片（字节或文件路径）解码成size=(宽, 高)的灰度数组
+    有Pillow时使用Pillow，否则使用Qt
+    '''
+    import io
+    source = data_or_path if isinstance(data_or_path, str) else io.BytesIO(data_or_path)
+    if Image is not None:
+        return _gray_pillow(source, size, aspect)
+    return _gray_qt(source, size, aspect)
+
+
+def _pack(bits):
+    '''把最后两维的布尔数组按行优先打包成64位整数'''
+    bits = bits.reshape(bits.shape[:-2] + (-1,))
+    packed = np.packbits(bits, axis=-1)
+    return packed.view('>u8')[..., 0]
+
+
+def dhash(pixels):
+    '''差异哈希，pixels形状为(..., 8, 9)，比较每行相邻像素'''
+    return _pack(pixels[..., :, 1:] > pixels[..., :, :-1])
+
+
+def ahash(pixels):
+    '''均值哈希，pixels形状为(..., 8, 8)'''
+    return _pack(pixels > pixels.mean(axis=(-2, -1), keepdims=True))
+
+
+def image_hash(data_or_path, aspect=THUMB_ASPECT):
+    '''返回(dhash, ahash)'''
+    pixels = gray_pixels(data_or_path, (9, 8), aspect)
+    return int(dhash(pixels)), int(ahash(pixels[:, :8]))
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class BKTree:
+    '''
+    BKTree
+    按汉明距离组织的BK树
+    查询与给定哈希距离不超过radius的所有项目，只需要访问很少的节点
+    '''
+
+    def __init__(self):
+        # 节点为[hash, items, {distance: child}]
+        self._root = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, hash, item):
+        self._size += 1
+        if self._root is None:
+            self._root = [hash, [item], {}]
+            return
+        node = self._root
+        while True:
+            distance = hamming(hash, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [hash, [item], {}]
+                return
+            node = child
+
+    def search(self, hash, radius):
+        '''返回[(distance, hash, item)]，按距离排序'''
+        result = []
+        nodes = [self._root] if self._root is not None else []
+        while nodes:
+            node = nodes.pop()
+            distance = hamming(hash, node[0])
+            if distance <= radius:
+                result.extend((distance, node[0], item) for item in node[1])
+            for child_distance, child in node[2].items():
+                if distance - radius <= child_distance <= distance + radius:
+                    nodes.append(child)
+        result.sort(key=lambda r: r[0])
+        return result
+
+
+class HashIndex:
+    '''
+    HashIndex
+    感知哈希索引
+    保存已下载壁纸的(dhash, ahash)，dhash放入BK树，查询时用ahash再确认一次
+    哈希来自缩略图（与原图裁剪成相同比例后计算的哈希可以互相比较），持久化到SQLite
+    '''
+
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, path=None, radius=8):
+        if path is None:
+            path = pathlib.Path.cwd().joinpath('cache', 'phash.db')
+        os.makedirs(str(pathlib.Path(path).parent), exist_ok=True)
+        self.path = str(path)
+        self.radius = radius
+        self._tree = BKTree()
+        self._hashes = {}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS hashes (id TEXT PRIMARY KEY, path TEXT, dhash TEXT, ahash TEXT)')
+        self._conn.commit()
+        for id, file, d, a in self._conn.execute('SELECT id, path, dhash, ahash FROM hashes'):
+            self._insert(id, file, int(d, 16), int(a, 16))
+
+    @classmethod
+    def shared(cls, path=None):
+        key = str(pathlib.Path(path).resolve()) if path else None
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(path)
+            return cls._shared[key]
+
+    def _insert(self, id, path, d, a):
+        if id not in self._hashes:
+            self._tree.add(d, id)
+        self._hashes[id] = (path, d, a)
+
+    def __contains__(self, id):
+        with self._lock:
+            return str(id) in self._hashes
+
+    def __len__(self):
+        with self._lock:
+            return len(self._hashes)
+
+    def add(self, id, hashes, path=None):
+        id = str(id)
+        d, a = hashes
+        with self._lock:
+            old = self._hashes.get(id)
+            if old is not None and old[1] != d:
+                # BK树不支持删除，哈希变化时重建
+                self._hashes.pop(id)
+                self._rebuild()
+            self._insert(id, path, d, a)
+            self._conn.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)',
+                               (id, path, '{:016x}'.format(d), '{:016x}'.format(a)))
+            self._conn.commit()
+
+    def _rebuild(self):
+        self._tree = BKTree()
+        for id, (path, d, a) in self._hashes.items():
+            self._tree.add(d, id)
+
+    def find(self, hashes, radius=None, exclude=None):
+        '''返回相似的已有壁纸[(distance, id, path)]，按距离排序'''
+        radius = self.radius if radius is None else radius
+        d, a = hashes
+        result = []
+        with self._lock:
+            for distance, _, id in self._tree.search(d, radius):
+                path, _, other_a = self._hashes[id]
+                if id != exclude and hamming(a, other_a) <= radius:
+                    result.append((distance, id, path))
+        return result
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def duplicate_of(wh, index, id, radius=None):
+    '''
+    用缩略图检查id是否与索引中已有的壁纸相似，返回(最相似的id, 哈希)，没有时id为None
+    缩略图来自WallHaven的缩略图缓存，通常不需要网络请求；缩略图无法解码时返回(None, None)
+    '''
+    data = wh.get_preview_data(id)
+    try:
+        hashes = image_hash(data)
+    except (OSError, ValueError):
+        return None, None
+    matches = index.find(hashes, radius, exclude=str(id))
+    return (matches[0][1] if matches else None), hashes
+
+
+class PerceptualHashTest(unittest.TestCase):
+
+    def image(self, width, height, seed=0, noise=0):
+        random = np.random.RandomState(seed)
+        # 平滑的随机图案，缩放后仍然保留结构
+        small = random.randint(0, 256, (6, 9)).astype(np.float32)
+        pixels = np.kron(small, np.ones((height // 6 + 1, width // 9 + 1)))[:height, :width]
+        if noise:
+            pixels += np.random.RandomState(seed + 100).normal(0, noise, pixels.shape)
+        return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+    def encode(self, image, format='JPEG'):
+        import io
+        buffer = io.BytesIO()
+        image.save(buffer, format)
+        return buffer.getvalue()
+
+    def test_hash_similar(self):
+        if Image is None:
+            self.skipTest('Pillow is not installed')
+        a = image_hash(self.encode(self.image(900, 600)))
+        b = image_hash(self.encode(self.image(300, 200, noise=8)))
+        c = image_hash(self.encode(self.image(900, 600, seed=1)))
+        self.assertLessEqual(hamming(a[0], b[0]), 8)
+        self.assertGreater(hamming(a[0], c[0]), 8)
+
+    def test_bk_tree(self):
+        tree = BKTree()
+        hashes = np.random.RandomState(0).randint(0, 2 ** 62, 500, dtype=np.int64).tolist()
+        for i, h in enumerate(hashes):
+            tree.add(h, i)
+        target = hashes[10] ^ 0b101
+        expect = sorted(i for i, h in enumerate(hashes) if hamming(h, target) <= 6)
+        self.assertEqual(sorted(item for _, _, item in tree.search(target, 6)), expect)
+
+    def test_index(self):
+        with tempfile.TemporaryDirectory() as path:
+            index = HashIndex(os.path.join(path, 'phash.db'))
+            index.add('1', (0xff00ff00ff00ff00, 0x0f0f0f0f0f0f0f0f), '/tmp/wallhaven-1.jpg')
+            index.add('2', (0x00ff00ff00ff00ff, 0x0f0f0f0f0f0f0f0f))
+            self.assertEqual([id for _, id, _ in index.find((0xff00ff00ff00ff01, 0x0f0f0f0f0f0f0f0f))], ['1'])
+            index.close()
+            self.assertEqual(len(HashIndex(index.path)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,23 +1,57 @@
+import threading
 from PyQt5 import QtCore, QtWidgets, QtGui
+from MemoryBudget import MemoryBudget
 
 
 class PictureCacher:
     """
     PictureCacher
     图片缓存类
-    将图片临时保存于内存中，增加加载速度
+    将解码后的缩略图临时保存于内存中，增加加载速度
+    占用计入MemoryBudget，超出预算时由预算统一释放最久未使用的图片
+    保存的是QImage，可以在工作线程中使用
     """
 
-    def __init__(self, max_size=100):
-        self.max_size = max_size
-        QtGui.QPixmapCache.setCacheLimit(max_size * 1024)
+    _shared = None
+    _shared_lock = threading.Lock()
 
-    def enqueue(self, id, pixmap):
-        return QtGui.QPixmapCache.insert(id, pixmap)
+    def __init__(self, budget=None, owner='thumbnail'):
+        self.budget = budget if budget is not None else MemoryBudget.shared()
+        self.owner = owner
+        self._images = {}
+        self._lock = threading.Lock()
 
-    def get_pixmap(self, id):
-        result = QtGui.QPixmapCache.find(id)
-        if result:
-            return result
-        else:
-            return None
+    @classmethod
+    def shared(cls):
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def enqueue(self, id, image):
+        with self._lock:
+            self._images[id] = image
+        self.budget.charge(self.owner, id, image.sizeInBytes(), self._evict)
+        return True
+
+    def get_image(self, id):
+        with self._lock:
+            image = self._images.get(id)
+        if image is not None:
+            self.budget.touch(self.owner, id)
+        return image
+
+    def _evict(self, id):
+        with self._lock:
+            self._images.pop(id, None)
+
+    def clear(self):
+        with self._lock:
+            ids = list(self._images)
+            self._images.clear()
+        for id in ids:
+            self.budget.release(self.owner, id)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._images)
@@ -0,0 +1,135 @@
+import os
+import time
+import sqlite3
+import pathlib
+import threading
+import unittest
+import tempfile
+from collections import namedtuple
+
+PictureInfo = namedtuple('PictureInfo', 'id origin_url alt resolution content_length')
+
+
+class PictureStore:
+    '''
+    PictureStore
+    壁纸元数据缓存
+    以壁纸id为键保存原图地址、alt、分辨率和文件大小，内存中缓存一份并持久化到SQLite
+    超过ttl秒的记录视为过期
+    '''
+
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, path=None, ttl=7 * 24 * 3600):
+        if path is None:
+            path = pathlib.Path.cwd().joinpath('cache', 'picture.db')
+        os.makedirs(str(pathlib.Path(path).parent), exist_ok=True)
+        self.path = str(path)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._memory = {}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS pictures ('
+                           'id TEXT PRIMARY KEY, origin_url TEXT, alt TEXT, width INTEGER, height INTEGER, '
+                           'content_length INTEGER, updated REAL)')
+        self._conn.commit()
+
+    @classmethod
+    def shared(cls, path=None, ttl=7 * 24 * 3600):
+        key = str(pathlib.Path(path).resolve()) if path else None
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(path, ttl)
+            return cls._shared[key]
+
+    def get(self, id):
+        id = str(id)
+        with self._lock:
+            row = self._memory.get(id)
+            if row is None:
+                row = self._conn.execute('SELECT origin_url, alt, width, height, content_length, updated '
+                                         'FROM pictures WHERE id = ?', (id,)).fetchone()
+                if row is not None:
+                    self._memory[id] = row
+            if row is None or time.time() - row[5] > self.ttl:
+                self.misses += 1
+                return None
+            self.hits += 1
+        origin_url, alt, width, height, content_length, _ = row
+        resolution = (width, height) if width else None
+        return PictureInfo(id, origin_url, alt, resolution, content_length)
+
+    def put(self, id, origin_url, alt, resolution=None, content_length=None):
+        id = str(id)
+        width, height = resolution if resolution else (None, None)
+        row = (origin_url, alt, width, height, content_length, time.time())
+        with self._lock:
+            self._memory[id] = row
+            self._conn.execute('INSERT OR REPLACE INTO pictures VALUES (?, ?, ?, ?, ?, ?, ?)', (id,) + row)
+            self._conn.commit()
+
+    def set_content_length(self, id, content_length):
+        id = str(id)
+        with self._lock:
+            row = self._memory.get(id)
+            if row is not None:
+                self._memory[id] = row[:4] + (content_length,) + row[5:]
+            self._conn.execute('UPDATE pictures SET content_length = ? WHERE id = ?', (content_length, id))
+            self._conn.commit()
+
+    def alts(self):
+        '''返回所有记录的[(id, alt)]，包括已经过期的记录'''
+        with self._lock:
+            return self._conn.execute('SELECT id, alt FROM pictures WHERE alt IS NOT NULL').fetchall()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_ratio': self.hits / total if total else 0.0,
+                    'count': len(self._memory)}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class PictureStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'picture.db')
+        self.store = PictureStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        self.dir.cleanup()
+
+    def test_put_and_get(self):
+        self.assertIsNone(self.store.get(632744))
+        self.store.put(632744, 'https://wallpapers.wallhaven.cc/wallpapers/full/wallhaven-632744.jpg',
+                       'General 4096x2304 landscape', (4096, 2304))
+        self.store.set_content_length(632744, 1024)
+        info = self.store.get('632744')
+        self.assertEqual(info.resolution, (4096, 2304))
+        self.assertEqual(info.content_length, 1024)
+        self.assertEqual(self.store.stats()['hits'], 1)
+
+    def test_persistent(self):
+        self.store.put('1', 'url', 'alt')
+        store = PictureStore(self.path)
+        self.assertEqual(store.get('1').origin_url, 'url')
+        store.close()
+
+    def test_ttl(self):
+        self.store.ttl = -1
+        self.store.put('1', 'url', 'alt')
+        self.assertIsNone(self.store.get('1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
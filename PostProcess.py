@@ -0,0 +1,379 @@
+import os
+import sys
+import math
+import time
+import logging
+import pathlib
+import threading
+import unittest
+import tempfile
+import multiprocessing
+from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
+from collections import namedtuple
+from PerceptualHash import image_hash
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+log = logging.getLogger('PostProcessLog')
+log.setLevel(logging.INFO)
+console_handler = logging.StreamHandler(sys.stdout)
+formatter = logging.Formatter('%(asctime)s %(levelname)-4s: %(message)s')
+console_handler.setFormatter(formatter)
+log.addHandler(console_handler)
+
+# (id, 文件路径, 文件大小, (宽, 高), (dhash, ahash), [适配屏幕的壁纸路径], 错误信息, 文件是否损坏)
+# 工作进程异常退出等处理失败时只有error，damaged为False
+PostResult = namedtuple('PostResult', 'id path size resolution hashes variants error damaged')
+
+# 图片无法解码时Pillow和Qt抛出的异常
+DAMAGED_ERRORS = (OSError, ValueError, SyntaxError)
+
+STAGES = ('verify', 'variants', 'hash')
+
+
+# 以下函数在工作进程中运行，参数和返回值都很小，图片数据由工作进程自己从磁盘读取
+
+def _init_worker():
+    # 后处理不应该和界面、下载线程抢CPU
+    if hasattr(os, 'nice'):
+        try:
+            os.nice(5)
+        except OSError:
+            pass
+
+
+def _timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def verify_image(path):
+    '''完整解码一次，确认文件没有损坏，返回(宽, 高)'''
+    if Image is not None:
+        with Image.open(path) as image:
+            image.load()
+            return image.size
+    from PyQt5 import QtGui
+    reader = QtGui.QImageReader(path)
+    image = reader.read()
+    if image.isNull():
+        raise ValueError(reader.errorString())
+    return image.width(), image.height()
+
+
+def variant_path(directory, path, size):
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(directory, '{}-{}x{}.jpg'.format(name, size[0], size[1]))
+
+
+def _fill_box(width, height, size):
+    '''按屏幕比例居中裁剪后缩放到屏幕大小，返回(缩放后的宽高, 裁剪框)'''
+    scale = max(size[0] / width, size[1] / height)
+    scaled = (max(size[0], int(math.ceil(width * scale))), max(size[1], int(math.ceil(height * scale))))
+    left = (scaled[0] - size[0]) // 2
+    top = (scaled[1] - size[1]) // 2
+    return scaled, (left, top, left + size[0], top + size[1])
+
+
+def make_variants(path, sizes, directory, quality=90):
+    '''
+    为每个比原图小的屏幕尺寸生成铺满屏幕的JPEG，已经存在的不再生成，返回生成的文件路径
+    '''
+    os.makedirs(directory, exist_ok=True)
+    if Image is not None:
+        with Image.open(path) as image:
+            todo = [size for size in sizes if image.width >= size[0] and image.height >= size[1]]
+            todo = [size for size in todo if not os.path.exists(variant_path(directory, path, size))]
+            if not todo:
+                return [variant_path(directory, path, size) for size in sizes
+                        if os.path.exists(variant_path(directory, path, size))]
+            # JPEG解码时直接缩小到不小于最大屏幕的尺寸
+            image.draft('RGB', (max(size[0] for size in todo), max(size[1] for size in todo)))
+            image = image.convert('RGB')
+            for size in todo:
+                scaled, box = _fill_box(image.width, image.height, size)
+                output = variant_path(directory, path, size)
+                image.resize(scaled, Image.LANCZOS).crop(box).save(output + '.part', 'JPEG', quality=quality)
+                os.replace(output + '.part', output)
+    else:
+        from PyQt5 import QtCore, QtGui
+        image = QtGui.QImage(path)
+        if image.isNull():
+            raise ValueError('cannot decode image')
+        for size in sizes:
+            output = variant_path(directory, path, size)
+            if image.width() < size[0] or image.height() < size[1] or os.path.exists(output):
+                continue
+            scaled, box = _fill_box(image.width(), image.height(), size)
+            variant = image.scaled(scaled[0], scaled[1], QtCore.Qt.IgnoreAspectRatio,
+                                   QtCore.Qt.SmoothTransformation).copy(box[0], box[1], size[0], size[1])
+            if not variant.save(output + '.part', 'JPG', quality):
+                raise OSError('cannot write {}'.format(output))
+            os.replace(output + '.part', output)
+    return [variant_path(directory, path, size) for size in sizes
+            if os.path.exists(variant_path(directory, path, size))]
+
+
+def hash_image(path):
+    return image_hash(path)
+
+
+class PostProcessor:
+    '''
+    PostProcessor
+    下载后处理流水线
+    原图下载完成后依次校验（完整解码并得到分辨率）、生成适配屏幕的壁纸、计算感知哈希
+    这些步骤都是CPU密集的，在进程池中运行，可以用上多个核心，也不占用界面和下载线程的GIL；
+    进程之间只传递文件路径，工作进程自己从磁盘读取图片
+    每个阶段记录排队数、完成数和吞吐量，用stats()查看
+    '''
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, max_workers=None, variant_sizes=(), variant_dir=None, quality=90):
+        if variant_dir is None:
+            variant_dir = pathlib.Path.cwd().joinpath('cache', 'variants')
+        self.max_workers = max_workers or max(1, min(4, (os.cpu_count() or 2) - 1))
+        self.variant_sizes = [tuple(size) for size in variant_sizes]
+        self.variant_dir = str(variant_dir)
+        self.quality = quality
+        self._lock = threading.Lock()
+        self._executor = None
+        self._closed = False
+        self._pending = set()
+        self._stages = {stage: {'queued': 0, 'done': 0, 'failed': 0, 'bytes': 0, 'seconds': 0.0,
+                                'first': None, 'last': None}
+                        for stage in STAGES}
+
+    @classmethod
+    def shared(cls):
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def set_variant_sizes(self, sizes):
+        '''sizes为[(宽, 高)]，通常是各个屏幕的物理分辨率'''
+        with self._lock:
+            self.variant_sizes = sorted({tuple(size) for size in sizes})
+
+    def _pool(self):
+        # 第一次提交时才启动工作进程；spawn不会复制父进程中Qt和下载线程的状态
+        if self._executor is None:
+            self._executor = futures.ProcessPoolExecutor(self.max_workers, multiprocessing.get_context('spawn'),
+                                                         initializer=_init_worker)
+        return self._executor
+
+    def _submit(self, function, *args):
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('post processor is shut down')
+            try:
+                return self._pool().submit(_timed, function, *args)
+            except BrokenProcessPool:
+                # 有工作进程异常退出（例如超大图片导致内存不足）后进程池不能再用，换一个新的
+                log.warning('post process pool is broken, restarting')
+                broken, self._executor = self._executor, None
+            broken.shutdown(wait=False)
+            return self._pool().submit(_timed, function, *args)
+
+    def _run_stage(self, stage, size, function, *args):
+        '''返回Future；无法提交时返回带有该异常的Future，由调用者的回调统一处理'''
+        with self._lock:
+            item = self._stages[stage]
+            item['queued'] += 1
+            if item['first'] is None:
+                item['first'] = time.monotonic()
+        try:
+            future = self._submit(function, *args)
+        except Exception as e:
+            future = futures.Future()
+            future.set_exception(e)
+
+        def done(f):
+            with self._lock:
+                item['queued'] -= 1
+                item['last'] = time.monotonic()
+                if f.cancelled() or f.exception() is not None:
+                    item['failed'] += 1
+                else:
+                    item['done'] += 1
+                    item['bytes'] += size
+                    item['seconds'] += f.result()[1]
+
+        future.add_done_callback(done)
+        return future
+
+    def submit(self, path, id=None):
+        '''提交下载完成的文件，返回Future，结果为PostResult'''
+        path = os.path.abspath(path)
+        size = os.path.getsize(path)
+        result = futures.Future()
+        with self._lock:
+            self._pending.add(result)
+            sizes = list(self.variant_sizes)
+        result.add_done_callback(self._finished)
+        job = {'result': result, 'values': {'id': id, 'path': path, 'size': size, 'resolution': None,
+                                            'hashes': None, 'variants': [], 'error': None, 'damaged': False}}
+        self._run_stage('verify', size, verify_image, path).add_done_callback(
+            lambda f: self._verified(job, sizes, f))
+        return result
+
+    def _finished(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def _verified(self, job, sizes, future):
+        values = job['values']
+        try:
+            values['resolution'] = tuple(future.result()[0])
+        except BaseException as e:
+            # 损坏的文件或者进程池出错时不再做后续处理
+            values['error'] = 'verify: {}'.format(e)
+            values['damaged'] = isinstance(e, DAMAGED_ERRORS)
+            job['result'].set_result(PostResult(**values))
+            return
+        stages = [('hash', hash_image, (values['path'],))]
+        if sizes:
+            stages.append(('variants', make_variants, (values['path'], sizes, self.variant_dir, self.quality)))
+        job['remaining'] = len(stages)
+        job['lock'] = threading.Lock()
+        for stage, function, args in stages:
+            self._run_stage(stage, values['size'], function, *args).add_done_callback(
+                lambda f, stage=stage: self._stage_done(job, stage, f))
+
+    def _stage_done(self, job, stage, future):
+        values = job['values']
+        with job['lock']:
+            try:
+                values[stage if stage == 'variants' else 'hashes'] = future.result()[0]
+            except BaseException as e:
+                values['error'] = '{}: {}'.format(stage, e)
+            job['remaining'] -= 1
+            finished = job['remaining'] == 0
+        if finished:
+            job['result'].set_result(PostResult(**values))
+
+    def join(self, timeout=None):
+        '''等待已经提交的文件处理完成，返回是否全部完成'''
+        with self._lock:
+            pending = list(self._pending)
+        _, not_done = futures.wait(pending, timeout)
+        return not not_done
+
+    def stats(self):
+        '''{阶段: {queued, done, failed, seconds, items_per_second, mb_per_second}}'''
+        now = time.monotonic()
+        with self._lock:
+            result = {}
+            for stage, item in self._stages.items():
+                # 吞吐量按阶段第一次提交到最近一次完成（仍有排队时到现在）的时间计算
+                end = now if item['queued'] else item['last']
+                elapsed = max(end - item['first'], 1e-6) if item['first'] is not None else 0.0
+                result[stage] = {'queued': item['queued'],
+                                 'done': item['done'],
+                                 'failed': item['failed'],
+                                 'seconds': item['seconds'],
+                                 'items_per_second': item['done'] / elapsed if elapsed else 0.0,
+                                 'mb_per_second': item['bytes'] / 1024 / 1024 / elapsed if elapsed else 0.0}
+            return result
+
+    def shutdown(self, wait=True):
+        '''之后提交的文件直接得到带有error的结果'''
+        with self._lock:
+            self._closed = True
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait)
+
+
+class PostProcessTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.processor = PostProcessor(max_workers=2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.processor.shutdown()
+
+    def setUp(self):
+        if Image is None:
+            self.skipTest('Pillow is not installed')
+        self.dir = tempfile.TemporaryDirectory()
+        self.processor.variant_dir = os.path.join(self.dir.name, 'variants')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, name, width, height):
+        import numpy as np
+        pixels = np.random.RandomState(width).randint(0, 256, (height // 40 + 1, width // 40 + 1, 3))
+        image = Image.fromarray(np.kron(pixels, np.ones((40, 40, 1)))[:height, :width].astype(np.uint8))
+        path = os.path.join(self.dir.name, name)
+        image.save(path, 'JPEG')
+        return path
+
+    def test_pipeline(self):
+        self.processor.set_variant_sizes([(320, 240), (640, 360), (4000, 3000)])
+        path = self.write('wallhaven-abc.jpg', 1000, 500)
+        result = self.processor.submit(path, 'abc').result(60)
+        self.assertIsNone(result.error)
+        self.assertEqual(result.resolution, (1000, 500))
+        self.assertEqual(result.hashes, image_hash(path))
+        # 比原图大的屏幕不生成
+        self.assertEqual([os.path.basename(file) for file in result.variants],
+                         ['wallhaven-abc-320x240.jpg', 'wallhaven-abc-640x360.jpg'])
+        with Image.open(result.variants[0]) as image:
+            self.assertEqual(image.size, (320, 240))
+
+    def test_corrupt_and_stats(self):
+        self.processor.set_variant_sizes([])
+        path = self.write('wallhaven-good.jpg', 400, 300)
+        broken = os.path.join(self.dir.name, 'wallhaven-broken.jpg')
+        with open(path, 'rb') as f:
+            data = f.read()
+        with open(broken, 'wb') as f:
+            f.write(data[:len(data) // 2])
+        before = self.processor.stats()
+        results = [self.processor.submit(file) for file in (path, broken)]
+        self.assertTrue(self.processor.join(60))
+        good, bad = [future.result() for future in results]
+        self.assertIsNone(good.error)
+        self.assertTrue(bad.error.startswith('verify'))
+        self.assertTrue(bad.damaged)
+        self.assertIsNone(bad.hashes)
+        stats = self.processor.stats()
+        self.assertEqual(stats['verify']['failed'] - before['verify']['failed'], 1)
+        self.assertEqual(stats['hash']['done'] - before['hash']['done'], 1)
+        self.assertEqual(stats['verify']['queued'], 0)
+        self.assertGreater(stats['verify']['items_per_second'], 0)
+
+    def test_worker_crash(self):
+        processor = PostProcessor(max_workers=1)
+        path = self.write('wallhaven-crash.jpg', 400, 300)
+        # 工作进程直接退出，进程池损坏
+        crash = processor._run_stage('verify', 0, os._exit, 1)
+        with self.assertRaises(BrokenProcessPool):
+            crash.result(60)
+        result = processor.submit(path).result(60)
+        self.assertIsNone(result.error)
+        self.assertEqual(result.resolution, (400, 300))
+        processor.shutdown()
+        result = processor.submit(path).result(5)
+        self.assertTrue(result.error)
+        self.assertFalse(result.damaged)
+        self.assertTrue(processor.join(5))
+        stats = processor.stats()
+        self.assertEqual(stats['verify']['queued'], 0)
+        self.assertEqual(stats['verify']['failed'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,15 @@
 import logging, sys
-from concurrent import futures
+import bisect
 from PyQt5 import QtWidgets, QtCore, QtGui
 from PyQt5.QtGui import QPixmap
-from WallHaven import WallHaven, Category
-from WallHaven_aiohttp import WallhavenAiohttp
-from PreviewWindow import PreviewWindow
+from WallHaven import WallHaven, Category, INDEX_URL
 from PictureCacher import PictureCacher
-from PictureLabel import PictureLabel
+from PagePrefetcher import PagePrefetcher
+from OriginPrefetcher import OriginPrefetcher
+from FetchScheduler import FetchScheduler, Priority
+from ImageDecoder import ImageDecoder
+from MemoryBudget import MemoryBudget
+from Setting import setting, transport_config
 
 
 log = logging.getLogger('PreviewTabLog')
@@ -18,101 +21,206 @@ log.addHandler(console_handler)
 
 
 class PreviewTabs(QtWidgets.QTabWidget):
+    '''
+    PreviewTabs
+    分类标签页
+    延迟启动（lazy_startup）时只创建并加载可见的标签页，其余标签页第一次切换到时才创建，
+    预览窗口在第一次点击缩略图时才创建
+    '''
 
     update_tab_signal = QtCore.pyqtSignal(Category, int)
+    # 任一标签页的页码变化
+    page_changed_signal = QtCore.pyqtSignal(int)
 
     def __init__(self, parent=None):
         super().__init__(parent)
 
-        self.wh = WallHaven()
+        MemoryBudget.shared().set_limit(int(setting.value('memory_budget_mb', 256)) * 1024 * 1024)
+        self.lazy = setting.value('lazy_startup', True, type=bool)
+        self.wh = WallHaven(index_url=setting.value('index_url', INDEX_URL), transport=transport_config())
+        self.scheduler = FetchScheduler.shared(int(setting.value('fetch_max_thread', 6)))
+        prefetch_thread = int(setting.value('prefetch_max_thread', 2))
+        self.prefetcher = PagePrefetcher(self.wh, self.scheduler, prefetch_thread,
+                                         int(setting.value('prefetch_max_kb_per_second', 0)) * 1024) \
+            if prefetch_thread > 0 else None
+        self.async_client = self.create_async_client() if setting.value('async_thumbnails', False, type=bool) \
+            else None
+        origin_prefetch_kb = int(setting.value('origin_prefetch_kb', 0))
+        self.origin_prefetcher = OriginPrefetcher(self.wh, self.scheduler, prefix_size=origin_prefetch_kb * 1024) \
+            if origin_prefetch_kb > 0 else None
         self.setLayout(QtWidgets.QVBoxLayout(self))
         self.layout().setSpacing(1)
 
-        self.main_tab = PreviewTab(Category.MAIN, 19)
-        self.latest_tab = PreviewTab(Category.LATEST, 24)
-        self.top_tab = PreviewTab(Category.TOPLIST, 24)
-        self.random_tab = PreviewTab(Category.RANDOM, 24)
-        self.all_tabs = (self.main_tab, self.latest_tab, self.top_tab, self.random_tab)
-
-        self.preview_window = PreviewWindow()
+        self.categories = tuple(Category)
+        # 未创建的标签页为None，对应位置放一个空白控件
+        self.all_tabs = [None] * len(self.categories)
+        self.preview_window = None
 
         self.init_ui()
         self.init_all_tabs()
-        self.init_preview_window()
-        self.update_all_tabs()
+        self.currentChanged.connect(self.current_tab_changed_slot)
+        if self.lazy:
+            self.current_tab_changed_slot(self.currentIndex())
+        else:
+            for index in range(len(self.categories)):
+                self.tab(index)
+            self.get_preview_window()
+            self.current_tab_changed_slot(self.currentIndex())
+
+    def create_async_client(self):
+        '''一整页缩略图在同一个事件循环中同时请求，并发数与连接池大小一致；没有aiohttp时仍使用调度器'''
+        try:
+            from WallHaven_aiohttp import WallhavenAiohttp
+        except ImportError as e:
+            log.warning('async thumbnails disabled: {}'.format(e))
+            return None
+        return WallhavenAiohttp(self.wh.transport.pool_maxsize, self.wh.thumb_cache, self.wh.picture_store,
+                                self.wh.index_url, self.wh.stats, self.wh.transport)
 
     def init_ui(self):
         self.setSizePolicy(QtWidgets.QSizePolicy.Minimum, QtWidgets.QSizePolicy.Preferred)
 
     def init_all_tabs(self):
-        for tab, category in zip(self.all_tabs, Category):
-            assert isinstance(tab, PreviewTab)
-            tab.clicked_for_preview_signal.connect(self.preview_clicked_slot)
-            scroll_area = QtWidgets.QScrollArea()
-            tab.setParent(scroll_area)
-            scroll_area.setWidget(tab)
-            scroll_area.setAutoFillBackground(True)
-            scroll_area.setContentsMargins(0, 0, 0, 0)
-            scroll_area.setFrameStyle(QtWidgets.QFrame.NoFrame or QtWidgets.QFrame.Plain)
-            scroll_area.setMinimumWidth(tab.sizeHint().width())
-            scroll_area.setMinimumHeight(int(tab.sizeHint().height() * 6 / 10))
-            scroll_area.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
-            scroll_area.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
-            scroll_area.setSizePolicy(QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Preferred)
-            scroll_area.setWidgetResizable(True)
-            self.addTab(scroll_area, category.value)
+        for category in self.categories:
+            self.addTab(QtWidgets.QWidget(), category.value)
+
+    def tab(self, index):
+        '''返回第index个标签页，第一次调用时创建并开始加载'''
+        tab = self.all_tabs[index]
+        if tab is not None:
+            return tab
+        category = self.categories[index]
+        tab = PreviewTab(category, self.wh, self.scheduler, self.prefetcher, self.async_client)
+        tab.clicked_for_preview_signal.connect(self.preview_clicked_slot)
+        tab.hovered_signal.connect(self.hovered_slot)
+        tab.page_changed_signal.connect(self.page_changed_signal)
+        self.all_tabs[index] = tab
+        # 用真正的标签页替换空白控件，替换过程中不发出currentChanged
+        current = self.currentIndex()
+        placeholder = self.widget(index)
+        self.blockSignals(True)
+        self.removeTab(index)
+        self.insertTab(index, tab, category.value)
+        self.setCurrentIndex(current)
+        self.blockSignals(False)
+        placeholder.deleteLater()
+        tab.update_tab()
+        return tab
+
+    def current_tab(self):
+        return self.tab(self.currentIndex())
+
+    def get_preview_window(self):
+        if self.preview_window is None:
+            from PreviewWindow import PreviewWindow
+            self.preview_window = PreviewWindow()
+            self.init_preview_window()
+        return self.preview_window
 
     def init_preview_window(self):
         self.preview_window.hide()
         self.preview_window.setWindowModality(QtCore.Qt.ApplicationModal)
+        self.preview_window.closed_signal.connect(self.preview_closed_slot)
 
     def update_all_tabs(self):
         for tab in self.all_tabs:
-            tab.update_tab()
+            if tab is not None:
+                tab.update_tab()
+
+    @QtCore.pyqtSlot(int)
+    def current_tab_changed_slot(self, index):
+        self.tab(index)
+        # 可见标签页的缩略图优先，其余标签页排在预取之后
+        for i, tab in enumerate(self.all_tabs):
+            if tab is not None:
+                self.scheduler.set_priority(tab.model, Priority.VISIBLE if i == index else Priority.HIDDEN)
 
     @QtCore.pyqtSlot(str)
     def preview_clicked_slot(self, picture):
-        self.preview_window.show()
-        self.preview_window.setPixmap(QPixmap())
-        self.preview_window.load_picture(picture)
+        if self.origin_prefetcher is not None:
+            # 点击的壁纸由预览窗口自己加载，改为预取它前后的两张
+            self.origin_prefetcher.set_wanted('hover', [])
+            self.origin_prefetcher.set_wanted('neighbour', self.current_tab().model.neighbours(picture))
+        preview_window = self.get_preview_window()
+        preview_window.show()
+        preview_window.setPixmap(QPixmap())
+        preview_window.load_picture(picture)
+
+    @QtCore.pyqtSlot(str)
+    def hovered_slot(self, picture):
+        if self.origin_prefetcher is not None:
+            self.origin_prefetcher.set_wanted('hover', [picture] if picture else [])
+
+    @QtCore.pyqtSlot()
+    def preview_closed_slot(self):
+        if self.origin_prefetcher is not None:
+            self.origin_prefetcher.set_wanted('neighbour', [])
 
 
-class PreviewTab(QtWidgets.QWidget):
+class PreviewTab(QtWidgets.QListView):
+    '''
+    PreviewTab
+    缩略图网格
+    基于QListView的虚拟化网格，只绘制可见的格子，不为每张缩略图创建控件
+    滚动到底部时自动加载下一页，上一页/下一页按钮滚动到对应页的开头
+    '''
 
     update_tab_signal = QtCore.pyqtSignal(Category, int)
     clicked_for_preview_signal = QtCore.pyqtSignal(str)
+    page_changed_signal = QtCore.pyqtSignal(int)
+    # 鼠标在缩略图上停留一段时间后发出，离开时发出空字符串
+    hovered_signal = QtCore.pyqtSignal(str)
 
-    def __init__(self, category, num, parent=None):
+    def __init__(self, category, wh=None, scheduler=None, prefetcher=None, async_client=None, parent=None):
         super().__init__(parent)
-        self.num = num
-        self.page = 1
         self.category = category
-        self.updater = TabUpdater()
-        self.init_ui(num)
-
-    def init_ui(self, num):
-        self.setLayout(QtWidgets.QGridLayout())
-        self.add_label_to_tab(num)
-        self.setStyleSheet('PreviewLabel'
-                           '{background-color: blue;'
-                           'border-width: 2px;'
-                           'border-radius: 4px;'
-                           '}')
-        self.layout().setSpacing(1)
-        self.updater.updated_one_picture_signal.connect(self.update_tab_slot)
+        self.page = 1
+        self.cell_size = QtCore.QSize(300, 200)
+        self.model = PictureListModel(category, wh, scheduler, prefetcher, label_size=self.cell_size,
+                                      async_client=async_client)
+        # 滚动停下后才更新可见范围，避免滚动过程中频繁取消和提交任务
+        self.visible_timer = QtCore.QTimer(self)
+        self.visible_timer.setSingleShot(True)
+        self.visible_timer.setInterval(50)
+        self.visible_timer.timeout.connect(self.update_visible_range)
+        self.pending_page = None
+        self.hover_timer = QtCore.QTimer(self)
+        self.hover_timer.setSingleShot(True)
+        self.hover_timer.setInterval(300)
+        self.hover_timer.timeout.connect(self.hover_timeout_slot)
+        self.hovered = ''
+        self.init_ui()
 
-    def add_label_to_tab(self, num):
-        for i in range(num):
-            label = PictureLabel()
-            label.setFixedSize(300, 200)
-            label.clicked.connect(self.clicked_for_preview_slot)
-            self.layout().addWidget(label, int(i / 4), i % 4)
+    def init_ui(self):
+        self.setModel(self.model)
+        self.setItemDelegate(PictureDelegate(self.cell_size, self))
+        self.setViewMode(QtWidgets.QListView.IconMode)
+        self.setMovement(QtWidgets.QListView.Static)
+        self.setResizeMode(QtWidgets.QListView.Adjust)
+        self.setUniformItemSizes(True)
+        self.setSpacing(1)
+        self.setSelectionMode(QtWidgets.QAbstractItemView.NoSelection)
+        self.setVerticalScrollMode(QtWidgets.QAbstractItemView.ScrollPerPixel)
+        self.verticalScrollBar().setSingleStep(40)
+        self.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
+        self.setFrameStyle(QtWidgets.QFrame.NoFrame)
+        cell_width = self.cell_size.width() + 2 * self.spacing()
+        cell_height = self.cell_size.height() + 2 * self.spacing()
+        self.setMinimumWidth(4 * cell_width + self.verticalScrollBar().sizeHint().width() + 4)
+        self.setMinimumHeight(int(3.6 * cell_height))
+        self.setSizePolicy(QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Preferred)
+        self.clicked.connect(self.clicked_for_preview_slot)
+        self.setMouseTracking(True)
+        self.entered.connect(self.entered_slot)
+        self.viewportEntered.connect(lambda: self.set_hovered(''))
+        self.verticalScrollBar().valueChanged.connect(lambda value: self.visible_timer.start())
+        self.model.rowsInserted.connect(self.rows_inserted_slot)
 
     def update_tab(self, page=1):
-        self.updater.stop_update()
-        for i in range(self.num):
-            self.layout().itemAt(i).widget().clear_picture()
-        self.updater.acquire_update_tab(self.category, page)
+        self.pending_page = page if page > 1 else None
+        self.page = 1
+        self.model.reset_pictures()
+        self.model.fetchMore(QtCore.QModelIndex())
 
     def current_page(self):
         return self.page
@@ -120,106 +228,364 @@ class PreviewTab(QtWidgets.QWidget):
     def update_next_page(self):
         if self.category == Category.MAIN:
             return
-        self.page += 1
-        self.update_tab(self.page)
+        self.scroll_to_page(self.page + 1)
 
     def update_previous_page(self):
         if self.category == Category.MAIN:
             return
         if self.page == 1:
             return
-        self.page -= 1
-        self.update_tab(self.page)
-
-    @QtCore.pyqtSlot(str, int, QPixmap)
-    def update_tab_slot(self, picture, count, pixmap):
-        label = self.layout().itemAt(count).widget()
-        label.set_picture(picture, pixmap)
-
-    @QtCore.pyqtSlot(str)
-    def clicked_for_preview_slot(self, picture):
-        self.clicked_for_preview_signal.emit(picture)
-
-
-class TabUpdater(QtCore.QObject):
-
-    update_tab_signal = QtCore.pyqtSignal(Category, int)
+        self.scroll_to_page(self.page - 1)
+
+    def scroll_to_page(self, page):
+        row = self.model.first_row_of_page(page)
+        if row is None:
+            # 还没有加载到该页时先加载，加载完成后再滚动
+            self.pending_page = page
+            if self.model.canFetchMore(QtCore.QModelIndex()):
+                self.model.fetchMore(QtCore.QModelIndex())
+            return
+        self.pending_page = None
+        self.scrollTo(self.model.index(row), QtWidgets.QAbstractItemView.PositionAtTop)
+        self.set_page(page)
+
+    def set_page(self, page):
+        if page != self.page:
+            self.page = page
+            self.page_changed_signal.emit(page)
+
+    @QtCore.pyqtSlot()
+    def update_visible_range(self):
+        if not self.model.rowCount():
+            return
+        viewport = self.viewport().rect()
+        cell = self.visualRect(self.model.index(0))
+        columns = max(viewport.width() // (cell.width() + self.spacing()), 1)
+        first_row = self.row_at(viewport.top(), 1)
+        last_row = self.row_at(viewport.bottom(), -1)
+        first_row = first_row if first_row is not None else 0
+        # 最后一行可能不满，取该行第一格再加上列数
+        last_row = min(last_row + columns - 1, self.model.rowCount() - 1) if last_row is not None \
+            else self.model.rowCount() - 1
+        self.model.set_visible_range(first_row, max(first_row, last_row))
+        if self.pending_page is None:
+            self.set_page(self.model.page_of_row(first_row))
+
+    def row_at(self, y, step):
+        '''y处（落在格子间隙时向step方向移动）第一列格子的行号'''
+        for i in range(self.cell_size.height() // 2):
+            index = self.indexAt(QtCore.QPoint(self.spacing() + 1, y + i * step))
+            if index.isValid():
+                return index.row()
+        return None
+
+    @QtCore.pyqtSlot(QtCore.QModelIndex, int, int)
+    def rows_inserted_slot(self, parent, first, last):
+        if self.pending_page is not None:
+            self.scroll_to_page(self.pending_page)
+        self.visible_timer.start()
+
+    @QtCore.pyqtSlot(QtCore.QModelIndex)
+    def entered_slot(self, index):
+        self.hovered = index.data(QtCore.Qt.UserRole) or ''
+        self.hover_timer.start()
+
+    @QtCore.pyqtSlot()
+    def hover_timeout_slot(self):
+        self.hovered_signal.emit(self.hovered)
+
+    def set_hovered(self, picture):
+        self.hover_timer.stop()
+        if picture != self.hovered:
+            self.hovered = picture
+            self.hovered_signal.emit(picture)
+
+    def leaveEvent(self, e):
+        super().leaveEvent(e)
+        self.set_hovered('')
+
+    def resizeEvent(self, e):
+        super().resizeEvent(e)
+        self.visible_timer.start()
+
+    @QtCore.pyqtSlot(QtCore.QModelIndex)
+    def clicked_for_preview_slot(self, index):
+        picture = index.data(QtCore.Qt.UserRole)
+        if picture:
+            self.clicked_for_preview_signal.emit(picture)
+
+
+class PictureDelegate(QtWidgets.QStyledItemDelegate):
+
+    def __init__(self, size, parent=None):
+        super().__init__(parent)
+        self.size = size
+        self.background = QtGui.QColor(40, 40, 40)
 
-    updated_one_picture_signal = QtCore.pyqtSignal(str, int, QPixmap)
+    def sizeHint(self, option, index):
+        return self.size
 
-    def __init__(self, wh=WallHaven()):
-        super().__init__()
-        self.cache = PictureCacher()
-        self.pixmap = QtGui.QPixmap()
-        self.is_running = False
+    def paint(self, painter, option, index):
+        painter.fillRect(option.rect, self.background)
+        pixmap = index.data(QtCore.Qt.DecorationRole)
+        if pixmap is None or pixmap.isNull():
+            return
+        rect = QtCore.QRect(QtCore.QPoint(0, 0), pixmap.size().boundedTo(option.rect.size()))
+        rect.moveCenter(option.rect.center())
+        painter.drawPixmap(rect, pixmap, QtCore.QRect(QtCore.QPoint(0, 0), rect.size()))
+
+
+class PictureListModel(QtCore.QAbstractListModel):
+    '''
+    PictureListModel
+    缩略图列表模型
+    视图滚动到底部时通过fetchMore按页加载列表，只为可见及前后各一页的行加载缩略图，
+    离开这个范围的QPixmap立即释放，解码后的QImage交给受内存预算限制的PictureCacher
+    不论已经加载了多少页，内存中的QPixmap数量都保持不变
+    传入async_client（WallhavenAiohttp）时缩略图不经过调度器，整批在事件循环中同时请求
+    '''
+
+    listing_loaded_signal = QtCore.pyqtSignal(int, int, object)
+    picture_loaded_signal = QtCore.pyqtSignal(int, str, QtGui.QImage)
+
+    def __init__(self, category, wh=None, scheduler=None, prefetcher=None, decoder=None, cache=None,
+                 label_size=QtCore.QSize(300, 200), margin=24, async_client=None, parent=None):
+        super().__init__(parent)
+        self.category = category
+        self.wh = wh if wh is not None else WallHaven()
+        self.scheduler = scheduler if scheduler is not None else FetchScheduler.shared()
+        self.prefetcher = prefetcher
+        self.async_client = async_client
+        self.decoder = decoder if decoder is not None else ImageDecoder.shared()
+        self.cache = cache if cache is not None else PictureCacher.shared()
+        self.label_size = label_size
+        self.margin = margin
         self.mutex = QtCore.QMutex()
-        self.thread = QtCore.QThread()
-        self.update_tab_signal.connect(self.update_tab_slot)
-        # self.thread.finished.connect(self.deleteLater)
-        self.moveToThread(self.thread)
-        self.thread.start()
-        self.wh = wh
-
-    def __del__(self):
-        self.thread.quit()
-        self.thread.wait()
-
-    @QtCore.pyqtSlot(Category, int)
-    def update_tab_slot(self, category: Category, page: int=1):
-        if category == Category.MAIN:
-            picture_iter = self.wh.get_main_web_pictures()
-        else:
-            picture_iter = self.wh.get_category_picture(category, page)
-        count = 0
-        log.info('updater restart')
-        # pic_list = [pic for pic in picture_iter if not self.cache.get_pixmap(pic)]
-        with futures.ThreadPoolExecutor(3) as executor:
-            to_do_map = {}
-            for pic in picture_iter:
-                future = executor.submit(self.wh.get_preview_data, pic)
-                to_do_map[future] = pic
-            for future in futures.as_completed(to_do_map):
-                self.pixmap.loadFromData(future.result())
-                self.updated_one_picture_signal.emit(to_do_map[future], count, self.pixmap)
-                log.debug('update tab:{} picture:{}'.format(category.value, to_do_map[future]))
-                count += 1
-
-    def update_tab_slot_old(self, category, page=1):
-        if category == Category.MAIN:
-            picture_iter = self.wh.get_main_web_pictures()
-        else:
-            picture_iter = self.wh.get_category_picture(category, page)
-        count = 0
-        log.info('updater restart')
-        for pic in picture_iter:
-            self.mutex.lock()
-            if not self.is_running:
-                self.mutex.unlock()
-                break
-            self.mutex.unlock()
-            pixmap = self.cache.get_pixmap(pic)
-            if pixmap:
-                log.debug('load from cache, id:' + pic)
-                self.pixmap = pixmap
-            else:
-
-                self.pixmap.loadFromData(self.wh.get_preview_data(pic))
-                self.cache.enqueue(pic, self.pixmap.copy())
-                log.debug('update tab:{} picture:{}'.format(category.value, pic))
-            self.updated_one_picture_signal.emit(pic, count, self.pixmap)
-            count += 1
-        log.info('updater stop')
+        # 每次重置递增，旧的结果直接丢弃
+        self.generation = 0
+        self.ids = []
+        self.rows = {}
+        self.page_rows = []
+        self.pixmaps = {}
+        self.loading = {}
+        self.visible = (0, -1)
+        self.fetching = False
+        self.listing_future = None
+        self.exhausted = False
+        self.listing_loaded_signal.connect(self.listing_loaded_slot)
+        self.picture_loaded_signal.connect(self.picture_loaded_slot)
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.ids)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.ids):
+            return None
+        id = self.ids[index.row()]
+        if role == QtCore.Qt.DecorationRole:
+            return self.pixmaps.get(id)
+        if role in (QtCore.Qt.UserRole, QtCore.Qt.ToolTipRole):
+            return id
+        return None
+
+    def canFetchMore(self, parent):
+        return not parent.isValid() and not self.fetching and not self.exhausted
+
+    def fetchMore(self, parent):
+        if not self.canFetchMore(parent):
+            return
+        self.fetching = True
+        self.listing_future = self.submit(self.load_listing, self._generation(), len(self.page_rows) + 1)
 
-    def stop_update(self):
+    def _generation(self):
         self.mutex.lock()
-        self.is_running = False
+        generation = self.generation
         self.mutex.unlock()
-        self.thread.quit()
-        self.thread.wait()
+        return generation
 
-    def acquire_update_tab(self, category, page=1):
-        self.thread.start()
+    def _is_stale(self, generation):
+        return generation != self._generation()
+
+    def reset_pictures(self):
         self.mutex.lock()
-        self.is_running = True
+        self.generation += 1
         self.mutex.unlock()
-        self.update_tab_signal.emit(category, page)
+        self.scheduler.cancel(self)
+        for future in self.loading.values():
+            future.cancel()
+        self.beginResetModel()
+        self.ids = []
+        self.rows = {}
+        self.page_rows = []
+        self.pixmaps = {}
+        self.loading = {}
+        self.visible = (0, -1)
+        self.fetching = False
+        self.exhausted = False
+        self.endResetModel()
+
+    def first_row_of_page(self, page):
+        if 1 <= page <= len(self.page_rows):
+            return self.page_rows[page - 1]
+        return None
+
+    def neighbours(self, picture):
+        row = self.rows.get(picture)
+        if row is None:
+            return []
+        return [self.ids[r] for r in (row + 1, row - 1) if 0 <= r < len(self.ids)]
+
+    def page_of_row(self, row):
+        return max(bisect.bisect_right(self.page_rows, row), 1)
+
+    def load_listing(self, generation, page):
+        picture_iter = None
+        if self.category == Category.MAIN:
+            picture_iter = self.wh.get_main_web_pictures()
+        elif self.prefetcher is not None:
+            picture_iter = self.prefetcher.listing(self.category, page)
+        if picture_iter is None:
+            picture_iter = self.wh.get_category_picture(self.category, page)
+        pictures = []
+        try:
+            for pic in picture_iter:
+                if self._is_stale(generation):
+                    return
+                pictures.append(pic)
+        except Exception:
+            # 加载失败时允许视图再次调用fetchMore
+            self.listing_loaded_signal.emit(generation, page, None)
+            raise
+        self.listing_loaded_signal.emit(generation, page, pictures)
+
+    @QtCore.pyqtSlot(int, int, object)
+    def listing_loaded_slot(self, generation, page, pictures):
+        if self._is_stale(generation):
+            return
+        self.fetching = False
+        if pictures is None:
+            return
+        log.info('tab {} page {}: {} pictures'.format(self.category.value, page, len(pictures)))
+        if self.category == Category.MAIN or not pictures:
+            self.exhausted = True
+        if pictures:
+            # 整页都重复时也记录页码，保持页码与服务器的页一致
+            self.page_rows.append(len(self.ids))
+        # 最新列表翻页时会有重复，只保留第一次出现的
+        pictures = [pic for pic in dict.fromkeys(pictures) if pic not in self.rows]
+        if pictures:
+            first = len(self.ids)
+            self.beginInsertRows(QtCore.QModelIndex(), first, first + len(pictures) - 1)
+            for pic in pictures:
+                self.rows[pic] = len(self.ids)
+                self.ids.append(pic)
+            self.endInsertRows()
+        # 当前页加载完后再预取下一页，避免与可见页争抢带宽
+        if self.category != Category.MAIN and self.prefetcher is not None:
+            self.prefetcher.prefetch_next(self.category, page)
+        if not pictures and not self.exhausted:
+            # 整页都是已经出现过的壁纸，没有新增行，视图不会再请求，直接加载下一页
+            self.fetchMore(QtCore.QModelIndex())
+
+    def set_visible_range(self, first, last):
+        '''视图可见的行，加载其前后各margin行的缩略图，释放范围外的QPixmap'''
+        self.visible = (first, last)
+        start, end = max(first - self.margin, 0), min(last + self.margin, len(self.ids) - 1)
+        for id in [id for id in self.pixmaps if not start <= self.rows[id] <= end]:
+            del self.pixmaps[id]
+        # 重新排队：先可见行，再附近的行
+        self.scheduler.cancel(self)
+        if self.async_client is not None:
+            # 事件循环中的请求没有排队先后，只取消离开范围的，范围内的继续进行
+            for id, future in self.loading.items():
+                if not start <= self.rows[id] <= end:
+                    future.cancel()
+        self.loading = {id: future for id, future in self.loading.items() if not future.cancelled()}
+        if self.fetching and self.listing_future.cancelled():
+            self.fetching = False
+            self.fetchMore(QtCore.QModelIndex())
+        generation = self._generation()
+        rows = list(range(first, last + 1)) + list(range(last + 1, end + 1)) + list(range(first - 1, start - 1, -1))
+        missing = []
+        for row in rows:
+            id = self.ids[row]
+            if id in self.pixmaps or id in self.loading:
+                continue
+            image = self.cache.get_image(id)
+            if image is not None:
+                self.set_pixmap(id, QPixmap.fromImage(image))
+                continue
+            if self.async_client is not None:
+                missing.append(id)
+            else:
+                self.loading[id] = self.submit(self.load_picture, generation, id)
+        if missing:
+            for id, future in self.async_client.fetch_previews(missing).items():
+                self.loading[id] = future
+                future.add_done_callback(lambda f, id=id: self.preview_fetched(generation, id, f))
+
+    def is_near_visible(self, row):
+        first, last = self.visible
+        return first - self.margin <= row <= last + self.margin
+
+    def load_picture(self, generation, id):
+        if self._is_stale(generation):
+            return
+        try:
+            data = self.wh.get_preview_data(id)
+        except Exception:
+            # 用空图片通知界面线程移出loading，之后滚动到这里时会重新加载
+            self.picture_loaded_signal.emit(generation, id, QtGui.QImage())
+            raise
+        if self._is_stale(generation):
+            return
+        self.decode_preview(generation, id, data)
+
+    def preview_fetched(self, generation, id, future):
+        # 在事件循环的线程中调用
+        if future.cancelled() or self._is_stale(generation):
+            return
+        if future.exception() is not None:
+            log.error('load picture {} failed: {}'.format(id, future.exception()))
+            self.picture_loaded_signal.emit(generation, id, QtGui.QImage())
+            return
+        self.decode_preview(generation, id, future.result())
+
+    def decode_preview(self, generation, id, data):
+        future = self.decoder.decode(data, self.label_size)
+        future.add_done_callback(lambda f: self.picture_decoded(generation, id, f))
+
+    def picture_decoded(self, generation, id, future):
+        try:
+            image = future.result()
+        except Exception as e:
+            log.error('decode picture {} failed: {}'.format(id, e))
+            image = QtGui.QImage()
+        if not image.isNull():
+            self.cache.enqueue(id, image)
+        self.picture_loaded_signal.emit(generation, id, image)
+
+    @QtCore.pyqtSlot(int, str, QtGui.QImage)
+    def picture_loaded_slot(self, generation, id, image):
+        if self._is_stale(generation):
+            return
+        self.loading.pop(id, None)
+        row = self.rows.get(id)
+        if row is None or not self.is_near_visible(row) or image.isNull():
+            return
+        self.set_pixmap(id, QPixmap.fromImage(image))
+        log.debug('update tab:{} picture:{}'.format(self.category.value, id))
+
+    def set_pixmap(self, id, pixmap):
+        self.pixmaps[id] = pixmap
+        index = self.index(self.rows[id])
+        self.dataChanged.emit(index, index, [QtCore.Qt.DecorationRole])
+
+    def submit(self, fn, *args):
+        future = self.scheduler.submit(self, fn, *args)
+        future.add_done_callback(self._log_error)
+        return future
+
+    def _log_error(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            log.error('update tab failed: {}'.format(future.exception()))
@@ -1,11 +1,17 @@
 import sys, os
-import io
+import time
 import logging
 import pathlib
-from WallHaven import WallHaven
+from WallHaven import WallHaven, INDEX_URL
 from PyQt5 import QtWidgets, QtCore, QtGui
 from WallHaven import WallHavenPicture
-from Setting import setting
+from Setting import setting, transport_config, download_path
+from ImageDecoder import ImageDecoder, decode_image
+from MemoryBudget import MemoryBudget
+from OriginPrefetcher import origin_cache, origin_key
+from PerceptualHash import HashIndex, duplicate_of
+from LibraryIndex import LibraryIndex
+from PostProcess import PostProcessor
 
 log = logging.getLogger('PreviewWindowLog')
 log.setLevel(logging.DEBUG)
@@ -15,11 +21,21 @@ console_handler.setFormatter(formatter)
 log.addHandler(console_handler)
 
 
+def screen_sizes():
+    '''各个屏幕的物理分辨率[(宽, 高)]'''
+    sizes = []
+    for screen in QtWidgets.QApplication.screens():
+        ratio = screen.devicePixelRatio()
+        sizes.append((int(screen.size().width() * ratio), int(screen.size().height() * ratio)))
+    return sizes
+
+
 class PreviewWindow(QtWidgets.QLabel):
 
     stop_loader_signal = QtCore.pyqtSignal()
     load_picture_signal = QtCore.pyqtSignal(str)
     download_picture_signal = QtCore.pyqtSignal(str)
+    closed_signal = QtCore.pyqtSignal()
 
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -85,6 +101,7 @@ class PreviewWindow(QtWidgets.QLabel):
     def init_picture_loader(self):
         self.loader.load_part_complete_signal.connect(self.load_picture_slot)
         self.load_picture_signal.connect(self.loader.load_picture)
+        self.loader.duplicate_found_signal.connect(self.duplicate_found_slot)
 
     def init_download_button(self):
         self.download_button.setText('下载壁纸')
@@ -120,9 +137,9 @@ class PreviewWindow(QtWidgets.QLabel):
             move += 3
             QtCore.QThread.sleep(20)
 
-    @QtCore.pyqtSlot(QtGui.QPixmap, str, int, float)
-    def load_picture_slot(self, pixmap, resolution, size=0, progress=0):
-        self.setPixmap(pixmap)
+    @QtCore.pyqtSlot(QtGui.QImage, str, int, float)
+    def load_picture_slot(self, image, resolution, size=0, progress=0):
+        self.setPixmap(QtGui.QPixmap.fromImage(image))
         self.update_info(self.picture, resolution, size, progress)
 
     @QtCore.pyqtSlot()
@@ -130,11 +147,19 @@ class PreviewWindow(QtWidgets.QLabel):
         self.hide()
         self.reset_info_label()
         self.loader.stop_loader()
+        self.closed_signal.emit()
 
     @QtCore.pyqtSlot()
     def download_picture_slot(self):
         log.info('download picture:' + self.picture)
-        self.download_picture_signal.emit(setting.value('download_path'))
+        self.download_picture_signal.emit(download_path())
+
+    @QtCore.pyqtSlot(str, str, bool)
+    def duplicate_found_slot(self, id, match, skipped):
+        if id != self.picture:
+            return
+        self.info_label.setText('ID:{:^8} 与已下载的{}相似{}'.format(id, match, '，未下载' if skipped else ''))
+        self.info_label.resize(self.info_label.sizeHint())
 
     @QtCore.pyqtSlot(str)
     def download_complete_slot(self, path):
@@ -153,18 +178,33 @@ class PreviewWindow(QtWidgets.QLabel):
 
 class PictureLoader(QtCore.QObject):
 
-    load_part_complete_signal = QtCore.pyqtSignal(QtGui.QPixmap, str, int, float)
+    load_part_complete_signal = QtCore.pyqtSignal(QtGui.QImage, str, int, float)
     download_complete_signal = QtCore.pyqtSignal(str)
+    # (id, 相似的已下载壁纸id, 是否跳过下载)
+    duplicate_found_signal = QtCore.pyqtSignal(str, str, bool)
 
     def __init__(self):
         super().__init__()
-        self.wh = WallHaven()
+        self.wh = WallHaven(index_url=setting.value('index_url', INDEX_URL), transport=transport_config())
+        self.wh.download_adaptive = setting.value('download_adaptive', True, type=bool)
         self.mutex = QtCore.QMutex()
         self.is_running = False
         self.is_complete = False
         self.preview_windows_size = QtCore.QSize(1600, 900)
         self.picture = None
-        self.pixmap = QtGui.QPixmap(self.preview_windows_size)
+        self.picture_data = QtCore.QByteArray()
+        self.decoder = ImageDecoder.shared()
+        self.budget = MemoryBudget.shared()
+        self.origin_cache = origin_cache()
+        self.loading = False
+        self.load_id = 0
+        self.frame = 0
+        self.emitted_frame = 0
+        self.max_redraw_per_second = int(setting.value('preview_redraw_per_second', 4))
+        # 在界面线程中创建，这里才能读取屏幕信息
+        self.post_processor = PostProcessor.shared()
+        if setting.value('screen_variants', True, type=bool):
+            self.post_processor.set_variant_sizes(screen_sizes())
         self.loader_thread = QtCore.QThread()
         self.thread().finished.connect(self.deleteLater)
         self.moveToThread(self.loader_thread)
@@ -179,48 +219,147 @@ class PictureLoader(QtCore.QObject):
         self.mutex.lock()
         self.is_complete = False
         self.is_running = True
+        self.loading = True
+        self.load_id += 1
         self.mutex.unlock()
         self.picture = picture
         data_picture = self.wh.create_picture(picture)
-        data_iter, total_size = self.wh.get_origin_data(data_picture)
+        # 推测预取到的原图开头部分直接使用，只请求剩余部分
+        prefix = self.origin_cache.get(origin_key(picture)) or b''
+        info = self.wh.picture_store.get(picture)
+        total_size = info.content_length if info is not None else None
+        if prefix and total_size is not None and len(prefix) >= total_size:
+            data_iter = iter(())
+        else:
+            data_iter, total_size = self.wh.get_origin_data(data_picture, len(prefix))
         resolution = 'X'.join([str(s) for s in data_picture.resolution])
-        self.load_part_complete_signal.emit(QtGui.QPixmap(), resolution, total_size, 0)
-        print('debug')
-        picture_data = io.BufferedRandom(io.BytesIO(bytearray(total_size)))
+        self.load_part_complete_signal.emit(QtGui.QImage(), resolution, total_size, 0)
+        self.picture_data = QtCore.QByteArray(prefix)
+        # 加载过程中预览数据不能释放，只计入预算
+        self.budget.charge('preview', 'buffer', total_size)
         log.debug('resolution:%s' % resolution)
-        log.debug('load picture {}, size {:.2f}KB'.format(picture, total_size / 1024))
-        data_size = 0
-        for block in data_iter:
-            picture_data.write(block)
-            data_size += len(block)
-            if self.is_stopped():
-                break
-            progress = 100.0 * data_size / total_size
-            log.debug('load picture {} in {:.1f}%'.format(picture, progress))
-            if progress == 100.0:
-                self.is_complete = True
-            picture_data.seek(0)
-            self.pixmap.loadFromData(picture_data.read())
-            picture_data.seek(data_size)
-            pixmap = self.pixmap.scaled(self.preview_windows_size, QtCore.Qt.KeepAspectRatioByExpanding,
-                                             QtCore.Qt.SmoothTransformation)
-            self.load_part_complete_signal.emit(pixmap, resolution, total_size, progress)
+        log.debug('load picture {}, size {:.2f}KB, cached prefix {:.2f}KB'.format(
+            picture, total_size / 1024, len(prefix) / 1024))
+        data_size = len(prefix)
+        last_redraw = 0.0
+        pending = None
+        if prefix and data_size < total_size:
+            last_redraw = time.monotonic()
+            pending = self.submit_frame(resolution, total_size, 100.0 * data_size / total_size,
+                                        QtCore.Qt.FastTransformation)
+        try:
+            for block in data_iter:
+                self.picture_data.append(block)
+                data_size += len(block)
+                if self.is_stopped():
+                    break
+                progress = 100.0 * data_size / total_size
+                log.debug('load picture {} in {:.1f}%'.format(picture, progress))
+                if progress == 100.0:
+                    self.is_complete = True
+                    break
+                # 按时间限制重绘次数，上一帧还在解码时跳过，避免每个数据块都重新解码整张图片
+                now = time.monotonic()
+                if now - last_redraw < 1.0 / self.max_redraw_per_second:
+                    continue
+                if pending is not None and not pending.done():
+                    continue
+                last_redraw = now
+                pending = self.submit_frame(resolution, total_size, progress, QtCore.Qt.FastTransformation)
+        finally:
+            # 停止加载时关闭响应，把连接还给连接池
+            if hasattr(data_iter, 'close'):
+                data_iter.close()
+        if data_size >= total_size:
+            self.is_complete = True
+        if self.is_complete:
+            # 下载完成后只做一次高质量缩放
+            self.submit_frame(resolution, total_size, 100.0, QtCore.Qt.SmoothTransformation)
+        self.mutex.lock()
+        self.loading = False
+        self.mutex.unlock()
+        # 加载结束后保留的数据只用于保存原图，超出预算时可以释放
+        self.budget.charge('preview', 'buffer', self.picture_data.size(), self.release_picture_data)
         log.debug('stop load picture')
 
+    def submit_frame(self, resolution, total_size, progress, transform):
+        self.mutex.lock()
+        self.frame += 1
+        frame = self.frame
+        load_id = self.load_id
+        self.mutex.unlock()
+        # 解码线程拿到的是当前数据的一份副本，加载线程可以继续追加数据
+        future = self.decoder.submit(self.decode_frame, self.picture_data.data(), transform)
+        future.add_done_callback(
+            lambda f: self.frame_decoded(load_id, frame, resolution, total_size, progress, f))
+        return future
+
+    def decode_frame(self, data, transform):
+        # 直接解码成窗口大小，不生成原尺寸的图片
+        return decode_image(data, self.preview_windows_size, QtCore.Qt.KeepAspectRatioByExpanding, transform)
+
+    def frame_decoded(self, load_id, frame, resolution, total_size, progress, future):
+        image = future.result()
+        self.mutex.lock()
+        stale = load_id != self.load_id or frame < self.emitted_frame
+        if not stale:
+            self.emitted_frame = frame
+        self.mutex.unlock()
+        if not stale and not image.isNull():
+            self.budget.charge('preview', 'image', image.sizeInBytes())
+            self.load_part_complete_signal.emit(image, resolution, total_size, progress)
+
+    def release_picture_data(self, key):
+        self.mutex.lock()
+        if not self.loading:
+            self.picture_data = QtCore.QByteArray()
+        self.mutex.unlock()
+
     @QtCore.pyqtSlot(str)
     def download_picture(self, path):
         origin_url, _ = self.wh.get_picture_info(self.picture)
         filename = origin_url[origin_url.rfind('/') + 1:]
-        path = str(pathlib.PurePath.joinpath(pathlib.PurePath(path), filename))
-        log.info('start download picture, path:' + path)
-
-        if self.is_complete:
-            self.pixmap.save(path)
-        else:
-            self.wh.download_picture(self.picture, path)
-        self.download_complete_signal.emit(path)
+        file_path = str(pathlib.PurePath.joinpath(pathlib.PurePath(path), filename))
+        log.info('start download picture, path:' + file_path)
+        picture = self.picture
+        library = LibraryIndex.shared(path)
+        entry = library.get(picture)
+        if entry is not None and os.path.exists(entry.path):
+            log.info('{} is already in library'.format(picture))
+            self.download_complete_signal.emit(entry.path)
+            return
+        policy = setting.value('duplicate_policy', 'flag')
+        hashes = None
+        if policy != 'off':
+            index = HashIndex.shared()
+            match, hashes = duplicate_of(self.wh, index, picture, int(setting.value('duplicate_radius', index.radius)))
+            if match is not None:
+                log.info('{} looks like downloaded {}'.format(picture, match))
+                self.duplicate_found_signal.emit(picture, match, policy == 'skip')
+                if policy == 'skip':
+                    return
+
+        # 预览时已经读到的原始数据直接写入文件，未读完的部分由分段下载补齐
+        file_path = self.wh.download_picture(picture, path, prefix=self.picture_data.data())
+        # 先登记文件，校验、生成屏幕壁纸和计算哈希交给后处理进程
+        library.add_file(file_path, picture, analyze=False)
+        if hashes is not None:
+            HashIndex.shared().add(picture, hashes, file_path)
+        self.post_processor.submit(file_path, picture).add_done_callback(
+            lambda future: self.post_processed(library, future))
+        self.download_complete_signal.emit(file_path)
         log.info('finish download')
 
+    def post_processed(self, library, future):
+        result = future.result()
+        if result.damaged:
+            log.warning('{} is damaged, {}'.format(result.path, result.error))
+            return
+        if result.error:
+            log.error('post process {} failed, {}'.format(result.path, result.error))
+        library.add_file(result.path, result.id, result.resolution, result.hashes, analyze=False)
+        log.info('post processed {}, {} screen variants'.format(result.id, len(result.variants)))
+
     def is_stopped(self):
         self.mutex.lock()
         status = not self.is_running
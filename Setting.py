@@ -1,6 +1,8 @@
 import os, platform, pathlib
 from PyQt5 import QtCore, QtWidgets, QtGui
 from pathlib import Path
+from Transport import TransportConfig
+from MemoryBudget import MemoryBudget
 
 QtCore.QCoreApplication.setOrganizationName('moonwalker')
 QtCore.QCoreApplication.setOrganizationDomain('moonwalker.me')
@@ -9,6 +11,26 @@ QtCore.QCoreApplication.setApplicationName('WallHeaven')
 setting = QtCore.QSettings(str(pathlib.Path.cwd().joinpath('setting.ini')), QtCore.QSettings.IniFormat)
 
 
+def transport_config():
+    '''根据设置生成WallHaven使用的TransportConfig'''
+    default = TransportConfig()
+    return default._replace(pool_maxsize=int(setting.value('pool_maxsize', default.pool_maxsize)),
+                            keep_alive=setting.value('keep_alive', default.keep_alive, type=bool),
+                            connect_timeout=float(setting.value('connect_timeout', default.connect_timeout)),
+                            read_timeout=float(setting.value('read_timeout', default.read_timeout)),
+                            retries=int(setting.value('retries', default.retries)))
+
+
+def download_path():
+    '''壁纸下载目录，没有设置时使用 ~/Pictures/WallHaven，目录不存在时创建'''
+    path = setting.value('download_path')
+    if not path:
+        path = str(Path(pathlib.PurePath(pathlib.Path.home(), 'Pictures', 'WallHaven')))
+        setting.setValue('download_path', path)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
 class SettingDialog(QtWidgets.QDialog):
 
     def __init__(self, parent=None):
@@ -19,14 +41,33 @@ class SettingDialog(QtWidgets.QDialog):
         self.download_setting_tab = QtWidgets.QWidget()
         self.change_download_path_button = QtWidgets.QPushButton()
         self.download_path_edit = QtWidgets.QLineEdit()
-        if not setting.value('download_path'):
-            self.download_path = str(Path(pathlib.PurePath(pathlib.Path.home(), 'Pictures', 'WallHaven')))
-            setting.setValue('download_path', self.download_path)
-        else:
-            self.download_path = setting.value('download_path')
+        self.duplicate_policy_combo = QtWidgets.QComboBox()
+        self.screen_variants_check = QtWidgets.QCheckBox()
+        self.download_path = download_path()
         self.init_file_setting_tab()
 
+        self.network_setting_tab = QtWidgets.QWidget()
+        self.fetch_thread_spin = QtWidgets.QSpinBox()
+        self.prefetch_thread_spin = QtWidgets.QSpinBox()
+        self.prefetch_speed_spin = QtWidgets.QSpinBox()
+        self.async_thumbnails_check = QtWidgets.QCheckBox()
+        self.pool_size_spin = QtWidgets.QSpinBox()
+        self.keep_alive_check = QtWidgets.QCheckBox()
+        self.connect_timeout_spin = QtWidgets.QDoubleSpinBox()
+        self.read_timeout_spin = QtWidgets.QDoubleSpinBox()
+        self.retries_spin = QtWidgets.QSpinBox()
+        self.download_adaptive_check = QtWidgets.QCheckBox()
+        self.init_network_setting_tab()
+
+        self.cache_setting_tab = QtWidgets.QWidget()
+        self.memory_budget_spin = QtWidgets.QSpinBox()
+        self.origin_prefetch_spin = QtWidgets.QSpinBox()
+        self.lazy_startup_check = QtWidgets.QCheckBox()
+        self.init_cache_setting_tab()
+
         self.setting_tabs.addTab(self.download_setting_tab, '下载设置')
+        self.setting_tabs.addTab(self.network_setting_tab, '网络设置')
+        self.setting_tabs.addTab(self.cache_setting_tab, '缓存设置')
         self.setLayout(QtWidgets.QVBoxLayout(self))
         self.layout().addWidget(self.setting_tabs)
         self.init_dialog()
@@ -37,8 +78,6 @@ class SettingDialog(QtWidgets.QDialog):
         self.hide()
 
     def init_file_setting_tab(self):
-        if not os.path.exists(self.download_path):
-            os.makedirs(self.download_path)
         self.download_setting_tab.setLayout(QtWidgets.QVBoxLayout())
         download_path_setting = QtWidgets.QHBoxLayout()
         label = QtWidgets.QLabel('壁纸下载路径:')
@@ -50,6 +89,102 @@ class SettingDialog(QtWidgets.QDialog):
         download_path_setting.addWidget(self.download_path_edit)
         download_path_setting.addWidget(self.change_download_path_button)
         self.download_setting_tab.layout().addLayout(download_path_setting)
+        duplicate_setting = QtWidgets.QHBoxLayout()
+        for text, policy in (('不检查', 'off'), ('提示', 'flag'), ('提示并跳过下载', 'skip')):
+            self.duplicate_policy_combo.addItem(text, policy)
+        self.duplicate_policy_combo.setCurrentIndex(
+            max(self.duplicate_policy_combo.findData(setting.value('duplicate_policy', 'flag')), 0))
+        self.duplicate_policy_combo.currentIndexChanged.connect(
+            lambda index: setting.setValue('duplicate_policy', self.duplicate_policy_combo.itemData(index)))
+        duplicate_setting.addWidget(QtWidgets.QLabel('与已下载壁纸相似时:'))
+        duplicate_setting.addWidget(self.duplicate_policy_combo)
+        duplicate_setting.addStretch()
+        self.download_setting_tab.layout().addLayout(duplicate_setting)
+        self.screen_variants_check.setText('下载后为每个屏幕生成铺满屏幕的壁纸（保存在cache/variants）')
+        self.screen_variants_check.setChecked(setting.value('screen_variants', True, type=bool))
+        self.screen_variants_check.toggled.connect(lambda checked: setting.setValue('screen_variants', checked))
+        self.download_setting_tab.layout().addWidget(self.screen_variants_check)
+
+    def init_network_setting_tab(self):
+        layout = QtWidgets.QFormLayout()
+        self.network_setting_tab.setLayout(layout)
+        self.fetch_thread_spin.setRange(1, 32)
+        self.fetch_thread_spin.setValue(int(setting.value('fetch_max_thread', 6)))
+        self.fetch_thread_spin.valueChanged.connect(
+            lambda value: setting.setValue('fetch_max_thread', value))
+        self.prefetch_thread_spin.setRange(0, 8)
+        self.prefetch_thread_spin.setValue(int(setting.value('prefetch_max_thread', 2)))
+        self.prefetch_thread_spin.valueChanged.connect(
+            lambda value: setting.setValue('prefetch_max_thread', value))
+        self.prefetch_speed_spin.setRange(0, 100 * 1024)
+        self.prefetch_speed_spin.setSuffix(' KB/s')
+        self.prefetch_speed_spin.setSpecialValueText('不限制')
+        self.prefetch_speed_spin.setValue(int(setting.value('prefetch_max_kb_per_second', 0)))
+        self.prefetch_speed_spin.valueChanged.connect(
+            lambda value: setting.setValue('prefetch_max_kb_per_second', value))
+        layout.addRow('缩略图线程数:', self.fetch_thread_spin)
+        layout.addRow('预取线程数:', self.prefetch_thread_spin)
+        layout.addRow('预取限速:', self.prefetch_speed_spin)
+        self.async_thumbnails_check.setText('在一个事件循环中同时请求整页缩略图（需要aiohttp，重新启动后生效）')
+        self.async_thumbnails_check.setChecked(setting.value('async_thumbnails', False, type=bool))
+        self.async_thumbnails_check.toggled.connect(lambda checked: setting.setValue('async_thumbnails', checked))
+        layout.addRow('', self.async_thumbnails_check)
+        self.init_transport_setting(layout)
+
+    def init_transport_setting(self, layout):
+        config = transport_config()
+        self.pool_size_spin.setRange(1, 64)
+        self.pool_size_spin.setValue(config.pool_maxsize)
+        self.pool_size_spin.valueChanged.connect(lambda value: setting.setValue('pool_maxsize', value))
+        self.keep_alive_check.setText('保持连接（keep-alive）')
+        self.keep_alive_check.setChecked(config.keep_alive)
+        self.keep_alive_check.toggled.connect(lambda checked: setting.setValue('keep_alive', checked))
+        for spin, key, value in ((self.connect_timeout_spin, 'connect_timeout', config.connect_timeout),
+                                 (self.read_timeout_spin, 'read_timeout', config.read_timeout)):
+            spin.setRange(0, 300)
+            spin.setSuffix(' 秒')
+            spin.setSpecialValueText('不限制')
+            spin.setValue(value)
+            spin.valueChanged.connect(lambda value, key=key: setting.setValue(key, value))
+        self.retries_spin.setRange(0, 10)
+        self.retries_spin.setValue(config.retries)
+        self.retries_spin.valueChanged.connect(lambda value: setting.setValue('retries', value))
+        layout.addRow('每个主机连接数:', self.pool_size_spin)
+        layout.addRow('', self.keep_alive_check)
+        layout.addRow('连接超时:', self.connect_timeout_spin)
+        layout.addRow('读取超时:', self.read_timeout_spin)
+        layout.addRow('失败重试次数:', self.retries_spin)
+        self.download_adaptive_check.setText('根据网速自动调整原图分段数和分段大小')
+        self.download_adaptive_check.setChecked(setting.value('download_adaptive', True, type=bool))
+        self.download_adaptive_check.toggled.connect(lambda checked: setting.setValue('download_adaptive', checked))
+        layout.addRow('', self.download_adaptive_check)
+        layout.addRow(QtWidgets.QLabel('连接设置在重新启动后生效'))
+
+    def init_cache_setting_tab(self):
+        layout = QtWidgets.QFormLayout()
+        self.cache_setting_tab.setLayout(layout)
+        self.memory_budget_spin.setRange(32, 8192)
+        self.memory_budget_spin.setSingleStep(32)
+        self.memory_budget_spin.setSuffix(' MB')
+        self.memory_budget_spin.setValue(int(setting.value('memory_budget_mb', 256)))
+        self.memory_budget_spin.valueChanged.connect(self.change_memory_budget_slot)
+        layout.addRow('内存上限（缩略图、预览数据和解码图片）:', self.memory_budget_spin)
+        self.origin_prefetch_spin.setRange(0, 32 * 1024)
+        self.origin_prefetch_spin.setSingleStep(512)
+        self.origin_prefetch_spin.setSuffix(' KB')
+        self.origin_prefetch_spin.setSpecialValueText('不预取')
+        self.origin_prefetch_spin.setValue(int(setting.value('origin_prefetch_kb', 0)))
+        self.origin_prefetch_spin.valueChanged.connect(lambda value: setting.setValue('origin_prefetch_kb', value))
+        layout.addRow('预取可能预览的原图开头（重新启动后生效）:', self.origin_prefetch_spin)
+        self.lazy_startup_check.setText('只加载可见的标签页，其余标签页和预览窗口在第一次使用时创建（重新启动后生效）')
+        self.lazy_startup_check.setChecked(setting.value('lazy_startup', True, type=bool))
+        self.lazy_startup_check.toggled.connect(lambda checked: setting.setValue('lazy_startup', checked))
+        layout.addRow('', self.lazy_startup_check)
+
+    @QtCore.pyqtSlot(int)
+    def change_memory_budget_slot(self, value):
+        setting.setValue('memory_budget_mb', value)
+        MemoryBudget.shared().set_limit(value * 1024 * 1024)
 
     @QtCore.pyqtSlot()
     def change_download_path_slot(self):
@@ -0,0 +1,150 @@
+import threading
+import unittest
+
+
+class _Call:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    '''
+    SingleFlight
+    合并同时进行的相同请求
+    同一个key同时只有一个调用真正执行，其余调用等待它完成后得到同样的结果（或同样的异常）；
+    完成后key被移除，之后的调用会重新执行（结果的缓存由ThumbnailCache、PictureStore等负责）
+    '''
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        # 真正执行的次数和合并到其他调用的次数
+        self.leaders = 0
+        self.joined = 0
+
+    @classmethod
+    def shared(cls):
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def do(self, key, function, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                call.waiters += 1
+                self.joined += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = function(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def in_flight(self):
+        with self._lock:
+            return list(self._calls)
+
+    def stats(self):
+        with self._lock:
+            total = self.leaders + self.joined
+            return {'hits': self.joined,
+                    'misses': self.leaders,
+                    'hit_ratio': self.joined / total if total else 0.0,
+                    'in_flight': len(self._calls)}
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def run_threads(self, target, count=8):
+        results = [None] * count
+        barrier = threading.Barrier(count)
+
+        def run(i):
+            barrier.wait()
+            try:
+                results[i] = target()
+            except Exception as e:
+                results[i] = e
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_share_result_and_error(self):
+        flight = SingleFlight()
+        calls = []
+
+        def slow(value):
+            calls.append(value)
+            # 等所有线程都进入后再返回
+            while flight.stats()['hits'] < 7:
+                threading.Event().wait(0.01)
+            if value == 'error':
+                raise ValueError(value)
+            return [value]
+
+        results = self.run_threads(lambda: flight.do('a', slow, 'a'))
+        self.assertEqual(calls, ['a'])
+        self.assertTrue(all(result is results[0] for result in results))
+        self.assertEqual(flight.do('a', lambda: 'again'), 'again')
+        flight = SingleFlight()
+        results = self.run_threads(lambda: flight.do('b', slow, 'error'))
+        self.assertEqual(calls, ['a', 'error'])
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+        self.assertEqual(flight.in_flight(), [])
+
+    def test_wallhaven(self):
+        # WallHaven导入本模块，在这里再导入以避免循环导入
+        import tempfile
+        from FakeServer import FakeWallHavenServer
+        from Benchmark import create_wallhaven
+        with FakeWallHavenServer(latency=0.05, origin_size=256 * 1024) as server, \
+                tempfile.TemporaryDirectory() as cache_dir:
+            wh = create_wallhaven(server, cache_dir)
+            wh.single_flight = SingleFlight()
+            wh.download_adaptive = False
+            # 先单独下载另一张同样大小的壁纸，得到一次下载的请求数
+            wh.download_picture('1002', cache_dir)
+            origin_requests = server.requests['origin']
+            thumbs = self.run_threads(lambda: wh.get_preview_data('1001'))
+            infos = self.run_threads(lambda: wh.get_picture_info('1001'))
+            paths = self.run_threads(lambda: wh.download_picture('1001', cache_dir))
+            self.assertEqual(server.requests['thumb'], 1)
+            self.assertEqual(server.requests['info'], 2)
+            self.assertEqual(len(set(thumbs)), 1)
+            self.assertEqual(len(set(infos)), 1)
+            self.assertEqual(len(set(paths)), 1)
+            with open(paths[0], 'rb') as f:
+                self.assertEqual(f.read(), server.origin)
+            self.assertEqual(server.requests['origin'], origin_requests * 2)
+            wh.http_cache.close()
+            wh.picture_store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
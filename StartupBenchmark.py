@@ -0,0 +1,103 @@
+import time
+
+# 在导入其他模块之前记录时间，导入耗时也计入启动时间
+START = time.perf_counter()
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import threading
+import subprocess
+
+
+def probe(timeout=30.0):
+    '''
+    在子进程中运行：启动MainGui，输出从导入到各阶段的耗时（秒）
+    '''
+    from PyQt5 import QtWidgets, QtCore
+    import mainGui
+    marks = {'import': time.perf_counter() - START}
+
+    class FirstPaint(QtCore.QObject):
+
+        def eventFilter(self, obj, event):
+            if event.type() == QtCore.QEvent.Paint and 'first_paint' not in marks:
+                marks['first_paint'] = time.perf_counter() - START
+                marks['threads_at_first_paint'] = threading.active_count()
+            return False
+
+    app = QtWidgets.QApplication(sys.argv)
+    first_paint = FirstPaint()
+    app.installEventFilter(first_paint)
+    gui = mainGui.MainGui()
+    marks['constructed'] = time.perf_counter() - START
+
+    def thumbnail_loaded(*args):
+        if 'first_thumbnail' not in marks:
+            marks['first_thumbnail'] = time.perf_counter() - START
+            QtCore.QTimer.singleShot(0, app.quit)
+
+    gui.preview_tabs.current_tab().model.dataChanged.connect(thumbnail_loaded)
+    QtCore.QTimer.singleShot(int(timeout * 1000), app.quit)
+    app.exec_()
+    marks['threads'] = threading.active_count()
+    print(json.dumps(marks))
+    # 不等待后台线程，直接退出
+    os._exit(0)
+
+
+def thumbnail_png():
+    from PyQt5 import QtCore, QtGui
+    image = QtGui.QImage(300, 200, QtGui.QImage.Format_RGB32)
+    image.fill(QtGui.QColor(80, 120, 160))
+    buffer = QtCore.QBuffer()
+    buffer.open(QtCore.QIODevice.WriteOnly)
+    image.save(buffer, 'PNG')
+    return bytes(buffer.data())
+
+
+def bench_startup(server, runs=3, modes=('eager', 'lazy'), timeout=30.0):
+    '''
+    每次在新的进程和空的工作目录（冷缓存）中启动界面，返回各模式每次运行的耗时
+    '''
+    repo = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ)
+    env.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [repo, env.get('PYTHONPATH')]))
+    results = {}
+    for mode in modes:
+        results[mode] = []
+        for i in range(runs):
+            with tempfile.TemporaryDirectory() as cwd:
+                with open(os.path.join(cwd, 'setting.ini'), 'w') as f:
+                    f.write('[General]\nindex_url={}\nlazy_startup={}\ndownload_path={}\n'.format(
+                        server.url, 'true' if mode == 'lazy' else 'false', os.path.join(cwd, 'download')))
+                output = subprocess.run([sys.executable, os.path.abspath(__file__), '--probe', '--timeout',
+                                         str(timeout)], cwd=cwd, env=env, stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL, universal_newlines=True).stdout
+                # 最后一行是结果，前面是程序的日志
+                results[mode].append(json.loads(output.strip().splitlines()[-1]))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='启动耗时测试：从导入到首次绘制和首张缩略图')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.02, help='模拟服务器每个请求的延迟（秒）')
+    parser.add_argument('--modes', default='eager,lazy')
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--probe', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.probe:
+        probe(args.timeout)
+        return
+    from FakeServer import FakeWallHavenServer
+    with FakeWallHavenServer(latency=args.latency, thumbnail=thumbnail_png()) as server:
+        results = bench_startup(server, args.runs, args.modes.split(','), args.timeout)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,60 @@
+from PyQt5 import QtWidgets, QtCore
+from NetStats import NetStats
+from MemoryBudget import MemoryBudget
+
+
+class StatsOverlay(QtWidgets.QLabel):
+    '''
+    StatsOverlay
+    网络统计浮层
+    按操作类型显示请求数、流量和耗时分位数，各缓存命中率以及内存预算占用，每秒刷新一次
+    '''
+
+    def __init__(self, parent=None, stats=None):
+        super().__init__(parent)
+        self.stats = stats if stats is not None else NetStats.shared()
+        self.timer = QtCore.QTimer(self)
+        self.timer.setInterval(1000)
+        self.timer.timeout.connect(self.refresh)
+        self.setStyleSheet('color: white;'
+                           'background-color: rgba(0, 0, 0, 160);'
+                           'border-radius: 4px;'
+                           'font-family: monospace;'
+                           'padding: 6px')
+        self.setAttribute(QtCore.Qt.WA_TransparentForMouseEvents)
+        self.hide()
+
+    def toggle(self):
+        if self.isVisible():
+            self.timer.stop()
+            self.hide()
+        else:
+            self.refresh()
+            self.timer.start()
+            self.show()
+            self.raise_()
+
+    @staticmethod
+    def _ms(value):
+        return '{:7.1f}'.format(value * 1000) if value is not None else '    N/A'
+
+    @QtCore.pyqtSlot()
+    def refresh(self):
+        summary = self.stats.summary()
+        lines = ['{:<11}{:>6}{:>6}{:>10}{:>8}{:>8}{:>8}'.format('operation', 'count', 'error', 'KB',
+                                                                 'ttfb50', 'dur50', 'dur90')]
+        for operation, item in sorted(summary['operations'].items()):
+            lines.append('{:<11}{:>6}{:>6}{:>10.1f}{:>8}{:>8}{:>8}'.format(
+                operation, item['count'], item['errors'], item['bytes'] / 1024,
+                self._ms(item['ttfb_p50']), self._ms(item['duration_p50']), self._ms(item['duration_p90'])))
+        for name, cache in sorted(summary['caches'].items()):
+            lines.append('cache {:<12} hit {:>5.1f}%  ({} / {})'.format(
+                name, cache['hit_ratio'] * 100, cache['hits'], cache['hits'] + cache['misses']))
+        memory = MemoryBudget.shared().stats()
+        lines.append('memory {:.1f} / {:.0f} MB  ({})'.format(
+            memory['used'] / 1024 / 1024, memory['limit'] / 1024 / 1024,
+            ', '.join('{} {:.1f}MB'.format(owner, size / 1024 / 1024)
+                      for owner, size in sorted(memory['owners'].items()))))
+        self.setText('\n'.join(lines))
+        self.adjustSize()
+        self.move(10, self.parent().height() - self.height() - 10 if self.parent() else 10)
@@ -0,0 +1,236 @@
+import os
+import re
+import math
+import sqlite3
+import pathlib
+import threading
+import unittest
+import tempfile
+import numpy as np
+
+_RESOLUTION_PATTEN = re.compile(r'\d+x\d+')
+
+
+def tokenize(alt):
+    '''把alt拆成小写的标签，去掉分辨率和重复的标签'''
+    tags = []
+    for token in alt.lower().split():
+        token = token.strip(',.;:')
+        if token and not _RESOLUTION_PATTEN.fullmatch(token) and token not in tags:
+            tags.append(token)
+    return tags
+
+
+def parse_query(text):
+    '''
+    'landscape clouds | mountains' -> [['landscape', 'clouds'], ['mountains']]
+    空格分隔的标签取交集，'|'或or分隔的子句取并集
+    '''
+    clauses = []
+    for clause in re.split(r'\||\bor\b', text.lower()):
+        tags = tokenize(clause)
+        if tags:
+            clauses.append(tags)
+    return clauses
+
+
+class TagIndex:
+    '''
+    TagIndex
+    标签倒排索引
+    用alt中的标签建立 标签 -> 壁纸 的倒排表，保存在内存中，同时持久化到SQLite
+    查询时用numpy按倒排表累加命中次数和idf得分，结果按命中标签的idf之和排序（标签越少的壁纸越靠前）
+    '''
+
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, path=None):
+        if path is None:
+            path = pathlib.Path.cwd().joinpath('cache', 'tags.db')
+        os.makedirs(str(pathlib.Path(path).parent), exist_ok=True)
+        self.path = str(path)
+        # 壁纸id换成连续的序号，倒排表中只保存整数
+        self._ids = []
+        self._numbers = {}
+        self._tags = []
+        self._postings = {}
+        # 倒排表的numpy数组缓存，标签的倒排表变化时丢弃；每个壁纸标签数的平方根
+        self._arrays = {}
+        self._norms = np.ones(1024)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS tags (id TEXT PRIMARY KEY, tags TEXT)')
+        self._conn.commit()
+        # 第一次使用时才把倒排表读入内存，不拖慢启动
+        self._loaded = False
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        for id, tags in self._conn.execute('SELECT id, tags FROM tags'):
+            self._insert(id, tags.split(' ') if tags else [])
+
+    @classmethod
+    def shared(cls, path=None):
+        key = str(pathlib.Path(path).resolve()) if path else None
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(path)
+            return cls._shared[key]
+
+    def __len__(self):
+        with self._lock:
+            self._load()
+            return len(self._numbers)
+
+    def __contains__(self, id):
+        with self._lock:
+            self._load()
+            return str(id) in self._numbers
+
+    def is_empty(self):
+        '''不读入倒排表，直接查询数据库'''
+        with self._lock:
+            return self._conn.execute('SELECT 1 FROM tags LIMIT 1').fetchone() is None
+
+    def _insert(self, id, tags):
+        number = self._numbers.get(id)
+        if number is None:
+            number = len(self._ids)
+            self._numbers[id] = number
+            self._ids.append(id)
+            self._tags.append(())
+            if number >= len(self._norms):
+                self._norms = np.concatenate((self._norms, np.ones(len(self._norms))))
+        for tag in self._tags[number]:
+            self._postings[tag].discard(number)
+            self._arrays.pop(tag, None)
+        self._tags[number] = tuple(tags)
+        self._norms[number] = math.sqrt(max(len(tags), 1))
+        for tag in tags:
+            self._postings.setdefault(tag, set()).add(number)
+            self._arrays.pop(tag, None)
+
+    def _array(self, tag):
+        array = self._arrays.get(tag)
+        if array is None:
+            array = np.fromiter(self._postings.get(tag, ()), dtype=np.int64)
+            self._arrays[tag] = array
+        return array
+
+    def add(self, id, alt):
+        return self.add_many([(id, alt)])
+
+    def add_many(self, items):
+        '''items为[(id, alt)]，标签没有变化的壁纸不会重新写入'''
+        rows = []
+        with self._lock:
+            self._load()
+            for id, alt in items:
+                if not alt:
+                    continue
+                id, tags = str(id), tokenize(alt)
+                number = self._numbers.get(id)
+                if number is not None and self._tags[number] == tuple(tags):
+                    continue
+                self._insert(id, tags)
+                rows.append((id, ' '.join(tags)))
+            if rows:
+                self._conn.executemany('INSERT OR REPLACE INTO tags VALUES (?, ?)', rows)
+                self._conn.commit()
+        return len(rows)
+
+    def tags(self, id):
+        with self._lock:
+            self._load()
+            number = self._numbers.get(str(id))
+            return list(self._tags[number]) if number is not None else []
+
+    def count(self, tag):
+        with self._lock:
+            self._load()
+            return len(self._postings.get(tag.lower(), ()))
+
+    def _idf(self, tag):
+        return math.log(1 + len(self._numbers) / (1 + len(self._postings.get(tag, ()))))
+
+    def search(self, query, limit=50):
+        '''
+        query为查询字符串或parse_query的结果，返回[(score, id)]，按score从高到低排序
+        '''
+        clauses = parse_query(query) if isinstance(query, str) else query
+        with self._lock:
+            self._load()
+            size = len(self._ids)
+            matched = np.zeros(size, dtype=bool)
+            for tags in clauses:
+                # 子句中的标签都命中才算匹配
+                hits = np.zeros(size, dtype=np.int32)
+                for tag in tags:
+                    hits[self._array(tag)] += 1
+                matched |= hits == len(tags)
+            scores = np.zeros(size)
+            for tag in {tag for tags in clauses for tag in tags}:
+                scores[self._array(tag)] += self._idf(tag)
+            scores /= self._norms[:size]
+            numbers = np.flatnonzero(matched)
+            if limit and len(numbers) > limit:
+                numbers = numbers[np.argpartition(-scores[numbers], limit)[:limit]]
+            numbers = numbers[np.argsort(-scores[numbers], kind='stable')]
+            return [(float(scores[number]), self._ids[number]) for number in numbers]
+
+    def stats(self):
+        with self._lock:
+            self._load()
+            return {'pictures': len(self._numbers),
+                    'tags': len(self._postings),
+                    'postings': sum(len(posting) for posting in self._postings.values())}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class TagIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.index = TagIndex(os.path.join(self.dir.name, 'tags.db'))
+        self.index.add_many([('1', 'General 4096x2304 landscape mountains clouds'),
+                             ('2', 'General 1920x1080 landscape sea clouds sunset'),
+                             ('3', 'Anime 1920x1080 anime girls clouds'),
+                             ('4', 'General 2560x1440 mountains')])
+
+    def tearDown(self):
+        self.index.close()
+        self.dir.cleanup()
+
+    def test_tokenize(self):
+        self.assertEqual(tokenize('General 4096x2304 Landscape, landscape clouds'),
+                         ['general', 'landscape', 'clouds'])
+        self.assertEqual(parse_query('landscape clouds | anime or sea'), [['landscape', 'clouds'], ['anime'], ['sea']])
+
+    def test_and(self):
+        self.assertEqual(sorted(id for _, id in self.index.search('landscape clouds')), ['1', '2'])
+        self.assertEqual(self.index.search('landscape anime'), [])
+        self.assertEqual(self.index.search('unknown'), [])
+
+    def test_or_ranked(self):
+        self.assertEqual(sorted(id for _, id in self.index.search('mountains | anime')), ['1', '3', '4'])
+        # sea比mountains少见；同样命中mountains时标签少的壁纸更相关
+        self.assertEqual([id for _, id in self.index.search('mountains or sea')], ['4', '2', '1'])
+
+    def test_update_and_persistent(self):
+        self.index.add('4', 'General 2560x1440 sea')
+        self.assertEqual([id for _, id in self.index.search('mountains')], ['1'])
+        self.assertEqual(self.index.add('4', 'General 2560x1440 sea'), 0)
+        index = TagIndex(self.index.path)
+        self.assertEqual(index.tags('4'), ['general', 'sea'])
+        self.assertEqual(len(index), 4)
+        index.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
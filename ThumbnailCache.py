@@ -0,0 +1,154 @@
+import os
+import pathlib
+import threading
+import unittest
+import tempfile
+from collections import OrderedDict
+
+
+class ThumbnailCache:
+    '''
+    ThumbnailCache
+    缩略图磁盘缓存
+    将缩略图原始字节保存在磁盘上，超过容量上限时按LRU淘汰
+    '''
+
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, path=None, max_size=64 * 1024 * 1024):
+        if path is None:
+            path = pathlib.Path.cwd().joinpath('cache', 'thumb')
+        self.path = pathlib.Path(path)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._size = 0
+        # key -> 文件大小，按最近访问顺序排列
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(str(self.path), exist_ok=True)
+        self._load_index()
+
+    @classmethod
+    def shared(cls, path=None, max_size=64 * 1024 * 1024):
+        '''同一目录只使用一个实例，避免多个WallHaven各自维护LRU顺序'''
+        key = str(pathlib.Path(path).resolve()) if path else None
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(path, max_size)
+            return cls._shared[key]
+
+    def _load_index(self):
+        entries = []
+        for entry in os.scandir(str(self.path)):
+            if not entry.is_file() or entry.name.endswith('.tmp'):
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, entry.name, stat.st_size))
+        # 访问时会更新mtime，所以按mtime排序即可恢复LRU顺序
+        for _, name, size in sorted(entries):
+            self._entries[name] = size
+            self._size += size
+        self._evict()
+
+    def _file(self, key):
+        return str(self.path.joinpath(key))
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            try:
+                with open(self._file(key), 'rb') as f:
+                    data = f.read()
+                os.utime(self._file(key))
+            except OSError:
+                self._size -= self._entries.pop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        if not data or len(data) > self.max_size:
+            return
+        tmp = self._file(key) + '.tmp'
+        with self._lock:
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, self._file(key))
+            if key in self._entries:
+                self._size -= self._entries.pop(key)
+            self._entries[key] = len(data)
+            self._size += len(data)
+            self._evict()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def _evict(self):
+        while self._size > self.max_size and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(self._file(key))
+            except OSError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            while self._entries:
+                key, _ = self._entries.popitem()
+                try:
+                    os.remove(self._file(key))
+                except OSError:
+                    pass
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_ratio': self.hits / total if total else 0.0,
+                    'count': len(self._entries),
+                    'size': self._size,
+                    'max_size': self.max_size}
+
+
+class ThumbnailCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.cache = ThumbnailCache(self.dir.name, max_size=10)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_hit_and_miss(self):
+        self.assertIsNone(self.cache.get('th-1.jpg'))
+        self.cache.put('th-1.jpg', b'1234')
+        self.assertEqual(self.cache.get('th-1.jpg'), b'1234')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_lru_eviction(self):
+        self.cache.put('a', b'1234')
+        self.cache.put('b', b'1234')
+        self.cache.get('a')
+        self.cache.put('c', b'1234')
+        self.assertIn('a', self.cache)
+        self.assertNotIn('b', self.cache)
+        self.assertLessEqual(self.cache.stats()['size'], 10)
+
+    def test_reload_from_disk(self):
+        self.cache.put('a', b'1234')
+        cache = ThumbnailCache(self.dir.name, max_size=10)
+        self.assertEqual(cache.get('a'), b'1234')
+
+
+if __name__ == '__main__':
+    unittest.main()
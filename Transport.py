@@ -0,0 +1,101 @@
+import socket
+import unittest
+from collections import namedtuple
+from urllib3.util.retry import Retry
+from urllib3.connection import HTTPConnection
+from NetStats import NetStats, TimedHTTPAdapter
+
+TransportConfig = namedtuple('TransportConfig', 'pool_connections pool_maxsize pool_block keep_alive '
+                                                'connect_timeout read_timeout retries backoff_factor')
+# pool_connections为缓存连接池的主机数，pool_maxsize为每个主机保持的连接数
+TransportConfig.__new__.__defaults__ = (10, 16, False, True, 5.0, 30.0, 3, 0.5)
+
+RETRY_STATUS = (500, 502, 503, 504)
+
+
+def timeout(config):
+    '''requests使用的(connect, read)超时，0表示不限制'''
+    return config.connect_timeout or None, config.read_timeout or None
+
+
+def create_retry(config):
+    '''连接失败、连接被重置和5xx时按指数退避重试，只重试GET和HEAD'''
+    return Retry(total=config.retries, connect=config.retries, read=config.retries, status=config.retries,
+                 backoff_factor=config.backoff_factor, status_forcelist=RETRY_STATUS,
+                 allowed_methods=frozenset(('GET', 'HEAD')), raise_on_status=False)
+
+
+def socket_options(config):
+    options = list(HTTPConnection.default_socket_options)
+    if config.keep_alive:
+        options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60))
+    return options
+
+
+class TransportAdapter(TimedHTTPAdapter):
+    '''
+    TransportAdapter
+    可配置的连接池适配器
+    按TransportConfig设置每个主机的连接数、重试策略和TCP keep-alive
+    '''
+
+    def __init__(self, config=None):
+        self.transport = config if config is not None else TransportConfig()
+        super().__init__(pool_connections=self.transport.pool_connections,
+                         pool_maxsize=self.transport.pool_maxsize, max_retries=create_retry(self.transport),
+                         pool_block=self.transport.pool_block)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        pool_kwargs.setdefault('socket_options', socket_options(self.transport))
+        super().init_poolmanager(connections, maxsize, block, **pool_kwargs)
+
+
+def configure_session(session, config):
+    '''给session挂载按config配置的适配器，已有的连接会被关闭'''
+    for prefix in ('http://', 'https://'):
+        old = session.adapters.get(prefix)
+        session.mount(prefix, TransportAdapter(config))
+        if old is not None:
+            old.close()
+    session.headers['Connection'] = 'keep-alive' if config.keep_alive else 'close'
+    return session
+
+
+class TransportTest(unittest.TestCase):
+
+    def setUp(self):
+        import requests
+        self.session = requests.session()
+        self.stats = NetStats()
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_reuse_connection(self):
+        from FakeServer import FakeWallHavenServer
+        configure_session(self.session, TransportConfig(pool_maxsize=2, backoff_factor=0))
+        with FakeWallHavenServer() as server:
+            for i in range(10):
+                rsp = self.stats.request(self.session, 'GET', server.url + '/wallpaper/1', 'info')
+                self.assertEqual(rsp.status_code, 200)
+        self.assertEqual(self.stats.summary()['operations']['info']['new_connections'], 1)
+
+    def test_retry(self):
+        from FakeServer import FakeWallHavenServer
+        configure_session(self.session, TransportConfig(retries=2, backoff_factor=0))
+        with FakeWallHavenServer(error_rate=1.0) as server:
+            rsp = self.session.get(server.url + '/wallpaper/1', timeout=timeout(TransportConfig()))
+            self.assertEqual(rsp.status_code, 503)
+            self.assertEqual(server.requests['info'], 3)
+
+    def test_no_keep_alive(self):
+        configure_session(self.session, TransportConfig(keep_alive=False))
+        self.assertEqual(self.session.headers['Connection'], 'close')
+        configure_session(self.session, TransportConfig())
+        self.assertEqual(self.session.headers['Connection'], 'keep-alive')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,23 +1,47 @@
 import re
+import sys
+import logging
 import unittest
 import os
 import io
-from concurrent import futures
+import tempfile
 import threading
+from urllib.parse import urljoin, urlparse
 import requests
 from enum import Enum
 from collections import namedtuple
+from ThumbnailCache import ThumbnailCache
+from Downloader import SegmentedDownloader
+from DownloadTuner import TuningStore
+from PictureStore import PictureStore
+from HttpCache import HttpCache, PAGE_FRESHNESS
+from NetStats import NetStats
+from SingleFlight import SingleFlight
+from Transport import TransportConfig, configure_session, timeout
+from WallHavenParser import parse_main, parse_listing, parse_picture_info, parse_resolution
 
 WallHavenPicture = namedtuple('WallHavenPicture', 'id resolution alt origin_url')
 
+INDEX_URL = 'https://alpha.wallhaven.cc'
+
+log = logging.getLogger('WallHavenLog')
+log.setLevel(logging.INFO)
+console_handler = logging.StreamHandler(sys.stdout)
+formatter = logging.Formatter('%(asctime)s %(levelname)-4s: %(message)s')
+console_handler.setFormatter(formatter)
+log.addHandler(console_handler)
+
 
 class WallHaven:
     '''
     WallHaven.cc
     用于爬取wallhaven壁纸
+    缩略图、壁纸页面和原图下载通过SingleFlight合并，多个线程（或多个WallHaven对象）
+    同时请求同一个资源时只有一次网络传输
     '''
 
-    def __init__(self):
+    def __init__(self, thumb_cache=None, picture_store=None, index_url=INDEX_URL, stats=None,
+                 transport=None, tuning_store=None, tag_index=None, http_cache=None, single_flight=None):
         self.categories = {'latest': '/latest',
                            'toplist': '/toplist',
                            'random': '/random'}
@@ -26,120 +50,317 @@ class WallHaven:
                                                    ' (KHTML, like Gecko) Chrome/65.0.3325.181 Safari/537.36'})
         self._download_max_thread = 4
         self._download_part_size = 512 * 1024
-        self.index_url = 'https://alpha.wallhaven.cc'
+        # 自适应模式下以上两个值只作为没有历史记录时的初始值
+        self.download_adaptive = True
+        self.tuning_store = tuning_store if tuning_store is not None else TuningStore.shared()
+        self.index_url = index_url
+        self.full_url = 'https://wallpapers.wallhaven.cc/wallpapers/full/'
+        self.thumb_cache = thumb_cache if thumb_cache is not None else ThumbnailCache.shared()
+        self.picture_store = picture_store if picture_store is not None else PictureStore.shared()
+        # 标签索引（依赖numpy）第一次使用时才创建
+        self._tag_index = tag_index
+        self._tag_index_ready = False
+        self._tag_index_lock = threading.Lock()
+        self._download_slots_lock = threading.Lock()
+        self.http_cache = http_cache if http_cache is not None else HttpCache.shared()
+        # 可以按页面类型修改，见HttpCache.PAGE_FRESHNESS
+        self.page_freshness = dict(PAGE_FRESHNESS)
+        self.single_flight = single_flight if single_flight is not None else SingleFlight.shared()
+        self.stats = stats if stats is not None else NetStats.shared()
+        self.set_transport(transport if transport is not None else TransportConfig())
+        self.stats.register_cache('thumb', self.thumb_cache)
+        self.stats.register_cache('picture_info', self.picture_store)
+        self.stats.register_cache('http', self.http_cache)
+        self.stats.register_cache('single_flight', self.single_flight)
 
     def __del__(self):
         self._session.close()
 
+    @property
+    def tag_index(self):
+        with self._tag_index_lock:
+            if not self._tag_index_ready:
+                if self._tag_index is None:
+                    from TagIndex import TagIndex
+                    self._tag_index = TagIndex.shared()
+                if self._tag_index.is_empty():
+                    # 第一次使用标签索引时，把已经缓存的壁纸信息加入索引
+                    self._tag_index.add_many(self.picture_store.alts())
+                self._tag_index_ready = True
+            return self._tag_index
+
+    def set_transport(self, config):
+        '''
+        修改连接池大小、keep-alive、超时和重试设置，已建立的连接会被关闭
+        '''
+        self.transport = config
+        configure_session(self._session, config)
+        # 按主机限制同时进行的原图分段请求数，多个下载共用，合计不超过连接池大小
+        self._download_slots = {}
+
+    def _get(self, url, operation, **kwargs):
+        kwargs.setdefault('timeout', timeout(self.transport))
+        return self.stats.request(self._session, 'GET', url, operation, **kwargs)
+
+    @staticmethod
+    def _iter_text(rsp, chunk_size=16 * 1024):
+        if rsp.encoding is None:
+            rsp.encoding = 'utf-8'
+        return rsp.iter_content(chunk_size, decode_unicode=True)
+
+    def _get_page(self, url, operation, page_type, partial=False):
+        '''
+        边接收边输出页面文本，按page_type的新鲜期使用HttpCache
+        新鲜的缓存直接输出；过期的缓存发送条件请求，304时输出缓存的文本
+        partial为True时，调用者提前停止读取（关闭生成器）也保存已读到的部分，用于只解析页面开头的壁纸页面；
+        读取过程中出错时不保存
+        Transport重试后仍然是429、5xx等状态时抛出HTTPError，不把错误页面当作空列表解析
+        '''
+        max_age = self.page_freshness.get(page_type)
+        if max_age is None:
+            with self._get(url, operation, stream=True) as rsp:
+                self._check_status(rsp)
+                yield from self._iter_text(rsp)
+            return
+        entry, fresh = self.http_cache.lookup(url, max_age)
+        if fresh:
+            yield entry.text
+            return
+        with self._get(url, operation, stream=True, headers=HttpCache.conditional_headers(entry)) as rsp:
+            if rsp.status_code == 304 and entry is not None:
+                self.http_cache.refresh(url)
+                yield entry.text
+                return
+            self._check_status(rsp)
+            chunks = []
+            try:
+                for text in self._iter_text(rsp):
+                    chunks.append(text)
+                    yield text
+            except GeneratorExit:
+                if partial:
+                    self._store_page(url, rsp, chunks)
+                raise
+            self._store_page(url, rsp, chunks)
+
+    @staticmethod
+    def _check_status(rsp):
+        if rsp.status_code not in (200, 206):
+            raise requests.HTTPError('{} {} for url: {}'.format(rsp.status_code, rsp.reason, rsp.url), response=rsp)
+
+    def _store_page(self, url, rsp, chunks):
+        if rsp.status_code == 200 and 'no-store' not in rsp.headers.get('Cache-Control', ''):
+            self.http_cache.put(url, ''.join(chunks), rsp.headers.get('ETag'), rsp.headers.get('Last-Modified'))
+
     def get_main_web_pictures(self):
-        data = self._session.get(self.index_url).text
-        patten = re.compile(r'<img src="//.*?th-(\d*?)\.\S{3}"')
-        for match in patten.finditer(data):
-            yield match.group(1)
+        yield from parse_main(self._get_page(self.index_url, 'listing', 'main'))
 
     def get_category_picture(self, category, page=1):
+        for entry in self.get_category_entries(category, page):
+            yield entry.id
+
+    def get_category_entries(self, category, page=1):
+        """
+        边接收边解析列表页，输出带分辨率等信息的ListingEntry
+        """
         assert isinstance(category, Category)
         url = self.index_url + self.categories[category.value] + '?page=' + str(page)
-        data = self._session.get(url).text
-        patten = re.compile(r'data-wallpaper-id="(\d*?)"')
-        for match in patten.finditer(data):
-            yield match.group(1)
+        yield from parse_listing(self._get_page(url, 'listing', category.value))
+
+    def create_picture_from_entry(self, entry):
+        """
+        根据列表页信息构造WallHavenPicture，不请求壁纸页面，alt为None
+        """
+        info = self.picture_store.get(entry.id)
+        if info is not None:
+            return WallHavenPicture(entry.id, info.resolution or entry.resolution, info.alt, info.origin_url)
+        origin_url = '{}wallhaven-{}.{}'.format(self.full_url, entry.id, entry.extension)
+        return WallHavenPicture(entry.id, entry.resolution, None, origin_url)
 
     def get_preview_data(self, id):
-        url = "https://alpha.wallhaven.cc/wallpapers/thumb/small/th-{}.jpg".format(id)
-        return self._session.get(url).content
+        key = 'th-{}.jpg'.format(id)
+        data = self.thumb_cache.get(key)
+        if data is not None:
+            return data
+        url = self.index_url + '/wallpapers/thumb/small/' + key
+        return self.single_flight.do(('thumb', url), self._fetch_preview_data, key, url)
+
+    def _fetch_preview_data(self, key, url):
+        # 等待进入的过程中可能已经有别的请求完成
+        data = self.thumb_cache.get(key)
+        if data is not None:
+            return data
+        rsp = self._get(url, 'thumb')
+        data = rsp.content
+        if rsp.status_code == 200:
+            self.thumb_cache.put(key, data)
+        return data
 
     def get_picture_info(self, id):
-        page_url = 'https://alpha.wallhaven.cc/wallpaper'
+        info = self.picture_store.get(id)
+        if info is not None:
+            return info.origin_url, info.alt
+        page_url = self.index_url + '/wallpaper'
         url = '{}/{}'.format(page_url, id)
-        rsp = self._session.get(url)
-        data = rsp.text
-        patten = re.compile(r'<img id="wallpaper" src="(.*?)" alt="(.*?)"')
+        return self.single_flight.do(('info', url), self._fetch_picture_info, id, url)
+
+    def _fetch_picture_info(self, id, url):
+        info = self.picture_store.get(id)
+        if info is not None:
+            return info.origin_url, info.alt
+        page = self._get_page(url, 'info', 'wallpaper', partial=True)
         try:
-            origin_url = 'https:' + patten.search(data).group(1)
-            alt = patten.search(data).group(2)
-        except AttributeError as e:
-            print('error when get picture info of id:{}, respond code {}, reason {}'.format(
-                id, rsp.status_code, rsp.reason))
+            info = parse_picture_info(page)
+        except Exception:
+            page.close()
+            self.http_cache.delete(url)
+            raise
+        # 解析到原图地址后停止读取，关闭时保存已读到的部分
+        page.close()
+        if info is None:
+            # 没有解析出原图地址的页面不能缓存，否则新鲜期内一直失败
+            self.http_cache.delete(url)
+            log.warning('no origin url in wallpaper page of id:{}'.format(id))
         else:
+            origin_url, alt = urljoin(url, info[0]), info[1]
+            self.picture_store.put(id, origin_url, alt, parse_resolution(alt))
+            self.tag_index.add(id, alt)
             return origin_url, alt
 
-    def get_origin_data(self, id_or_pic):
+    def search_tags(self, query, limit=50):
+        '''
+        在见过的壁纸中按标签查找，不需要网络请求
+        query中空格分隔的标签取交集，'|'分隔的子句取并集，返回按相关度排序的id
+        '''
+        return [id for score, id in self.tag_index.search(query, limit)]
+
+    def _origin_url(self, id_or_pic):
         if isinstance(id_or_pic, WallHavenPicture):
-            origin_url = id_or_pic.origin_url
-        else:
-            origin_url, alt = self.get_picture_info(id_or_pic)
-        rsp = self._session.get(origin_url, stream=True)
-        return rsp.iter_content(1024 * 256), int(rsp.headers['Content-Length'])
+            return id_or_pic.origin_url
+        origin_url, alt = self.get_picture_info(id_or_pic)
+        return origin_url
+
+    def get_origin_data(self, id_or_pic, offset=0, length=None, operation='origin'):
+        """
+        返回原图数据块的迭代器和原图的总大小
+        offset或length不为默认值时通过Range请求只读取这一段
+        没有读完就不再需要时调用迭代器的close()，关闭响应并把连接还给连接池
+        """
+        origin_url = self._origin_url(id_or_pic)
+        headers = {}
+        if offset or length is not None:
+            headers['Range'] = 'bytes={}-{}'.format(offset, '' if length is None else offset + length - 1)
+        rsp = self._get(origin_url, operation, stream=True, headers=headers)
+        try:
+            if rsp.status_code == 206:
+                size = int(rsp.headers['Content-Range'].rsplit('/', 1)[1])
+                data_iter = rsp.iter_content(1024 * 256)
+            else:
+                size = int(rsp.headers['Content-Length'])
+                data_iter = self._slice(rsp.iter_content(1024 * 256), offset, length)
+        except BaseException:
+            rsp.close()
+            raise
+        self.picture_store.set_content_length(self._picture_id(id_or_pic), size)
+        return self._closing(rsp, data_iter), size
+
+    @staticmethod
+    def _closing(rsp, data_iter):
+        with rsp:
+            yield from data_iter
+
+    @staticmethod
+    def _slice(data_iter, offset, length):
+        # 服务器不支持Range时返回了整个文件，丢弃范围外的部分
+        position = 0
+        end = None if length is None else offset + length
+        for block in data_iter:
+            block_start = position
+            position += len(block)
+            if position <= offset:
+                continue
+            block = block[max(offset - block_start, 0):]
+            if end is not None and position >= end:
+                yield block[:len(block) - (position - end)]
+                return
+            yield block
 
     def create_picture(self, id):
         origin_url, alt = self.get_picture_info(id)
-        resolution = tuple([int(s) for s in alt.split()[1].split('x')])
+        resolution = parse_resolution(alt)
         return WallHavenPicture(id, resolution, alt, origin_url)
 
-    def download_picture(self, id_or_pic, path):
-        if isinstance(id_or_pic, WallHavenPicture):
-            origin_url = id_or_pic.origin_url
-        else:
-            origin_url, alt = self.get_picture_info(id_or_pic)
+    def _host_slots(self, host):
+        with self._download_slots_lock:
+            slots = self._download_slots.get(host)
+            if slots is None:
+                slots = self._download_slots[host] = threading.BoundedSemaphore(self.transport.pool_maxsize)
+            return slots
+
+    def _downloader(self, tuner=None, host=None):
+        # 分段数不超过每个主机保持的连接数，避免多出来的连接用完即关；同时进行的多个下载也共用这个上限
+        max_thread = min(self._download_max_thread, self.transport.pool_maxsize)
+        return SegmentedDownloader(self._session, max_thread, self._download_part_size,
+                                   stats=self.stats, timeout=timeout(self.transport), tuner=tuner,
+                                   slots=self._host_slots(host) if host else None)
+
+    @staticmethod
+    def _picture_id(id_or_pic):
+        return id_or_pic.id if isinstance(id_or_pic, WallHavenPicture) else id_or_pic
+
+    def download_picture(self, id_or_pic, path, progress=None, prefix=None):
+        """
+        分段下载原图到path目录，返回文件路径
+        prefix为已经取得的原图开头部分（例如预览时读到的数据），只下载剩余部分
+        同时下载到同一个文件的调用只下载一次，后来的调用等待并得到同样的路径（不会收到progress回调）
+        """
+        origin_url = self._origin_url(id_or_pic)
         file_name = origin_url[origin_url.rfind('/') + 1:]
         path = os.path.join(path, file_name)
-        size = 0
-        with open(path, 'wb') as f:
-            block_iter, total_size = self.get_origin_data(id_or_pic)
-            for block in block_iter:
-                f.write(block)
-                size += len(block)
-                print("Download Picture {} {:.2f}%".format(path, 100.0 * size / total_size))
-
-    def get_picture_data(self, id_or_pic):
-        if isinstance(id_or_pic, WallHavenPicture):
-            origin_url = id_or_pic.origin_url
-        else:
-            origin_url, alt = self.get_picture_info(id_or_pic)
-        rsp = self._session.head(origin_url)
-        size = int(rsp.headers['Content-Length'])
-        buff = io.BufferedRandom(io.BytesIO(bytearray(size)))
-        # 每块分配256KB
-        fus = []
-        block_count = int(size / self._download_part_size)
-        last_size = size % self._download_part_size
-        if last_size > 0:
-            block_count += 1
-        with futures.ThreadPoolExecutor(self._download_max_thread) as executor:
-            size_count = 0
-            for i in range(block_count):
-                fus.append(executor.submit(self._download_part, origin_url, size_count, self._download_part_size))
-                size_count += self._download_part_size
-            fus.append(executor.submit(self._download_part, origin_url, size_count, last_size))
-        for future in futures.as_completed(fus):
-            data, start, size = future.result()
-            # print('finish block start at %d, size %d' % (start, size))
-            buff.seek(start)
-            buff.write(data)
-        buff.seek(0)
-        print('done')
-        return buff
+        return self.single_flight.do(('origin', os.path.abspath(path)), self._download_origin,
+                                     id_or_pic, origin_url, path, progress, prefix)
+
+    def _download_origin(self, id_or_pic, origin_url, path, progress, prefix):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        id = self._picture_id(id_or_pic)
+        info = self.picture_store.get(id)
+        size = info.content_length if info is not None else None
+        tuner = None
+        host = urlparse(origin_url).netloc
+        if self.download_adaptive:
+            tuner = self.tuning_store.create_tuner(host, self._download_max_thread, self._download_part_size,
+                                                   self.transport.pool_maxsize)
+        downloader = self._downloader(tuner, host)
+        if prefix:
+            if size is None:
+                size = downloader.content_length(origin_url)
+                self.picture_store.set_content_length(id, size)
+            downloader.seed(origin_url, path, size, prefix)
+        path = downloader.download(origin_url, path, progress, size)
+        if tuner is not None:
+            self.tuning_store.put(host, tuner)
+        if size is None:
+            self.picture_store.set_content_length(id, os.path.getsize(path))
+        return path
+
+    def get_picture_data(self, id_or_pic, path=None):
+        """
+        分段下载原图到path目录（默认为临时目录），返回只读文件对象
+        """
+        if path is None:
+            path = tempfile.gettempdir()
+        return open(self.download_picture(id_or_pic, path), 'rb')
 
     def get_picture_data_block(self, id_or_pic):
-        if isinstance(id_or_pic, WallHavenPicture):
-            origin_url = id_or_pic.origin_url
-        else:
-            origin_url, alt = self.get_picture_info(id_or_pic)
-        rsp = self._session.get(origin_url)
+        origin_url = self._origin_url(id_or_pic)
+        rsp = self._get(origin_url, 'origin')
         size = int(rsp.headers['Content-Length'])
         buff = io.BytesIO(bytearray(size))
-        data = self._session.get(origin_url).content
+        data = rsp.content
         buff.write(data)
-        print('done')
+        log.debug('downloaded {} bytes of {}'.format(len(data), origin_url))
         return buff
 
-    def _download_part(self, url, start: int, size: int):
-        headers = {'Range': 'bytes=%d-%d' % (start, start + size)}
-        data = self._session.get(url, headers=headers).content
-        # print('start from %d write %d byte' % (start, size))
-        return data, start, size
-
 
 class Category(Enum):
     MAIN = 'main'
@@ -193,5 +414,42 @@ class PictureTest(unittest.TestCase):
             f.write(arr.read())
 
 
+class LocalListingTest(unittest.TestCase):
+
+    def test_error_status(self):
+        # Benchmark导入本模块，在这里再导入以避免循环导入
+        from FakeServer import FakeWallHavenServer
+        from Benchmark import create_wallhaven
+        with FakeWallHavenServer(error_rate=1.0) as server, tempfile.TemporaryDirectory() as cache_dir:
+            wh = create_wallhaven(server, cache_dir, transport=TransportConfig(retries=0))
+            with self.assertRaises(requests.HTTPError):
+                list(wh.get_category_picture(Category.LATEST, 2))
+            with self.assertRaises(requests.HTTPError):
+                list(wh.get_main_web_pictures())
+            # 不缓存的页面类型
+            with self.assertRaises(requests.HTTPError):
+                list(wh.get_category_picture(Category.RANDOM, 1))
+            # 错误页面没有被缓存，恢复后可以正常加载
+            server.error_rate = 0.0
+            self.assertEqual(list(wh.get_category_picture(Category.LATEST, 2)), server.page_ids(2))
+            wh.http_cache.close()
+            wh.picture_store.close()
+
+
+class LocalDownloadTest(unittest.TestCase):
+
+    def test_download_to_missing_folder(self):
+        # Benchmark导入本模块，在这里再导入以避免循环导入
+        from FakeServer import FakeWallHavenServer
+        from Benchmark import create_wallhaven
+        with FakeWallHavenServer(origin_size=64 * 1024) as server, tempfile.TemporaryDirectory() as cache_dir:
+            wh = create_wallhaven(server, cache_dir)
+            path = wh.download_picture('1001', os.path.join(cache_dir, 'Pictures', 'WallHaven'))
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), server.origin)
+            wh.http_cache.close()
+            wh.picture_store.close()
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,111 @@
+import re
+import unittest
+from collections import namedtuple
+
+ListingEntry = namedtuple('ListingEntry', 'id resolution purity category extension')
+
+_MAIN_THUMB_PATTEN = re.compile(r'<img src="//.*?th-(\d*?)\.\S{3}"')
+_FIGURE_PATTEN = re.compile(r'<figure\b([^>]*)>(.*?)</figure>', re.S)
+_WALLPAPER_ID_PATTEN = re.compile(r'data-wallpaper-id="(\d+)"')
+_RESOLUTION_PATTEN = re.compile(r'class="wall-res">\s*(\d+)\s*x\s*(\d+)')
+_PURITY_PATTEN = re.compile(r'\bthumb-(sfw|sketchy|nsfw)\b')
+_CATEGORY_PATTEN = re.compile(r'\bthumb-(general|anime|people)\b')
+_PNG_PATTEN = re.compile(r'<span class="png"')
+_PICTURE_INFO_PATTEN = re.compile(r'<img id="wallpaper" src="(.*?)" alt="(.*?)"')
+_ALT_RESOLUTION_PATTEN = re.compile(r'(\d+)x(\d+)')
+
+
+class StreamMatcher:
+    '''
+    StreamMatcher
+    流式匹配
+    数据分块到达时立即输出已完整出现的匹配，未匹配的尾部保留到下一块
+    '''
+
+    def __init__(self, patten, max_pending=64 * 1024, keep=16 * 1024):
+        self.patten = patten
+        self.max_pending = max_pending
+        self.keep = keep
+        self._buffer = ''
+
+    def feed(self, text):
+        self._buffer += text
+        end = 0
+        for match in self.patten.finditer(self._buffer):
+            end = match.end()
+            yield match
+        self._buffer = self._buffer[end:]
+        if len(self._buffer) > self.max_pending:
+            self._buffer = self._buffer[-self.keep:]
+
+    def iter_matches(self, chunks):
+        for chunk in chunks:
+            yield from self.feed(chunk)
+
+
+def parse_main(chunks):
+    '''首页缩略图id'''
+    for match in StreamMatcher(_MAIN_THUMB_PATTEN).iter_matches(chunks):
+        yield match.group(1)
+
+
+def parse_listing(chunks):
+    '''分类列表页，每个缩略图输出一个ListingEntry'''
+    for match in StreamMatcher(_FIGURE_PATTEN).iter_matches(chunks):
+        attrs, body = match.groups()
+        id_match = _WALLPAPER_ID_PATTEN.search(attrs)
+        if id_match is None:
+            continue
+        resolution = _RESOLUTION_PATTEN.search(body)
+        purity = _PURITY_PATTEN.search(attrs)
+        category = _CATEGORY_PATTEN.search(attrs)
+        yield ListingEntry(id_match.group(1),
+                           (int(resolution.group(1)), int(resolution.group(2))) if resolution else None,
+                           purity.group(1) if purity else None,
+                           category.group(1) if category else None,
+                           'png' if _PNG_PATTEN.search(body) else 'jpg')
+
+
+def parse_picture_info(chunks):
+    '''壁纸页面的原图地址和alt，找到后立即返回，不再读取剩余内容'''
+    for match in StreamMatcher(_PICTURE_INFO_PATTEN).iter_matches(chunks):
+        return match.group(1), match.group(2)
+    return None
+
+
+def parse_resolution(alt):
+    match = _ALT_RESOLUTION_PATTEN.search(alt)
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+
+class ParserTest(unittest.TestCase):
+
+    listing = ('<section class="thumb-listing-page"><ul>'
+               '<li><figure id="thumb-632744" class="thumb thumb-sfw thumb-general" data-wallpaper-id="632744">'
+               '<img data-src="//alpha.wallhaven.cc/wallpapers/thumb/small/th-632744.jpg">'
+               '<div class="thumb-info"><span class="wall-res">4096 x 2304</span></div></figure></li>'
+               '<li><figure id="thumb-1" class="thumb thumb-sketchy thumb-anime" data-wallpaper-id="1">'
+               '<div class="thumb-info"><span class="wall-res">1920 x 1080</span>'
+               '<span class="png"><span>PNG</span></span></div></figure></li></ul></section>')
+
+    def test_parse_listing_in_chunks(self):
+        chunks = [self.listing[i:i + 7] for i in range(0, len(self.listing), 7)]
+        entries = list(parse_listing(chunks))
+        self.assertEqual(entries, [ListingEntry('632744', (4096, 2304), 'sfw', 'general', 'jpg'),
+                                   ListingEntry('1', (1920, 1080), 'sketchy', 'anime', 'png')])
+
+    def test_parse_main(self):
+        data = '<img src="//alpha.wallhaven.cc/wallpapers/thumb/small/th-632744.jpg" /><img src="//a/th-5.png"'
+        self.assertEqual(list(parse_main([data[:30], data[30:]])), ['632744', '5'])
+
+    def test_parse_picture_info_stops_early(self):
+        def chunks():
+            yield '<img id="wallpaper" src="//wallpapers.wallhaven.cc/wallpapers/full/wallhaven-1.jpg" '
+            yield 'alt="General 1920x1080 sky"'
+            raise AssertionError('read past match')
+        self.assertEqual(parse_picture_info(chunks()),
+                         ('//wallpapers.wallhaven.cc/wallpapers/full/wallhaven-1.jpg', 'General 1920x1080 sky'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,280 @@
+import io
+import time
+import asyncio
+import unittest
+import tempfile
+import threading
+from urllib.parse import urljoin
+import aiohttp
+from WallHaven import WallHavenPicture, Category, INDEX_URL
+from ThumbnailCache import ThumbnailCache
+from PictureStore import PictureStore
+from NetStats import NetStats
+from Transport import TransportConfig
+from WallHavenParser import parse_main, parse_listing, parse_picture_info, parse_resolution
+
+
+class WallhavenAiohttp:
+    '''
+    WallHaven.cc
+    基于asyncio的wallhaven客户端，接口与WallHaven一致但均为协程
+    所有请求运行在同一个后台事件循环中，同时进行的请求数由连接池（max_connection）限制，
+    一整页缩略图可以同时请求，不需要为每个请求占用一个线程
+    与WallHaven共用缩略图缓存、壁纸信息和网络统计；磁盘缓存的读写在线程池中进行，不阻塞事件循环
+    列表页不经过HttpCache，也不合并相同的请求
+    '''
+
+    def __init__(self, max_connection=24, thumb_cache=None, picture_store=None, index_url=INDEX_URL, stats=None,
+                 transport=None):
+        self.categories = {'latest': '/latest',
+                           'toplist': '/toplist',
+                           'random': '/random'}
+        self.headers = {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36'
+                                      ' (KHTML, like Gecko) Chrome/65.0.3325.181 Safari/537.36'}
+        self.max_connection = max_connection
+        self._download_max_thread = 4
+        self._download_part_size = 512 * 1024
+        self.index_url = index_url
+        self.thumb_cache = thumb_cache if thumb_cache is not None else ThumbnailCache.shared()
+        self.picture_store = picture_store if picture_store is not None else PictureStore.shared()
+        self.stats = stats if stats is not None else NetStats.shared()
+        self.transport = transport if transport is not None else TransportConfig()
+        self._session = None
+        self._loop = None
+        self._loop_thread = None
+        self._lock = threading.Lock()
+
+    def __del__(self):
+        self.close()
+
+    async def _get_session(self):
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_connection,
+                                             force_close=not self.transport.keep_alive)
+            timeout = aiohttp.ClientTimeout(sock_connect=self.transport.connect_timeout or None,
+                                            sock_read=self.transport.read_timeout or None)
+            self._session = aiohttp.ClientSession(connector=connector, headers=self.headers, timeout=timeout)
+        return self._session
+
+    async def _request(self, method, url, operation, read=True, **kwargs):
+        '''
+        发送请求并记录到NetStats；read为True时读取全部内容，返回(响应, 内容)
+        read为False时返回的响应需要由调用者读取并release()，不记录字节数
+        '''
+        session = await self._get_session()
+        start = time.perf_counter()
+        try:
+            rsp = await session.request(method, url, **kwargs)
+        except Exception:
+            self.stats.record(operation, url, 0, 0, 0.0, None, time.perf_counter() - start)
+            raise
+        ttfb = time.perf_counter() - start
+        if not read:
+            self.stats.record(operation, url, rsp.status, 0, 0.0, ttfb, ttfb)
+            return rsp, None
+        try:
+            data = await rsp.read()
+        finally:
+            rsp.release()
+        self.stats.record(operation, url, rsp.status, len(data), 0.0, ttfb, time.perf_counter() - start)
+        return rsp, data
+
+    async def _get_text(self, url, operation='listing'):
+        rsp, data = await self._request('GET', url, operation)
+        # 与WallHaven一致，错误页面不当作空列表解析
+        rsp.raise_for_status()
+        return data.decode(rsp.get_encoding())
+
+    async def _run_blocking(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    async def get_main_web_pictures(self):
+        data = await self._get_text(self.index_url)
+        return list(parse_main([data]))
+
+    async def get_category_picture(self, category, page=1):
+        return [entry.id for entry in await self.get_category_entries(category, page)]
+
+    async def get_category_entries(self, category, page=1):
+        assert isinstance(category, Category)
+        url = self.index_url + self.categories[category.value] + '?page=' + str(page)
+        data = await self._get_text(url)
+        return list(parse_listing([data]))
+
+    async def get_preview_data(self, id):
+        key = 'th-{}.jpg'.format(id)
+        data = await self._run_blocking(self.thumb_cache.get, key)
+        if data is not None:
+            return data
+        url = self.index_url + '/wallpapers/thumb/small/' + key
+        rsp, data = await self._request('GET', url, 'thumb')
+        rsp.raise_for_status()
+        await self._run_blocking(self.thumb_cache.put, key, data)
+        return data
+
+    async def get_picture_info(self, id):
+        info = await self._run_blocking(self.picture_store.get, id)
+        if info is not None:
+            return info.origin_url, info.alt
+        page_url = self.index_url + '/wallpaper'
+        url = '{}/{}'.format(page_url, id)
+        info = parse_picture_info([await self._get_text(url, 'info')])
+        if info is None:
+            return None
+        origin_url, alt = urljoin(url, info[0]), info[1]
+        await self._run_blocking(self.picture_store.put, id, origin_url, alt, parse_resolution(alt))
+        return origin_url, alt
+
+    async def _origin_url(self, id_or_pic):
+        if isinstance(id_or_pic, WallHavenPicture):
+            return id_or_pic.origin_url
+        origin_url, alt = await self.get_picture_info(id_or_pic)
+        return origin_url
+
+    async def get_origin_data(self, id_or_pic, offset=0, length=None, operation='origin'):
+        '''
+        返回原图数据块的异步迭代器和原图的总大小，offset或length不为默认值时通过Range请求只读取这一段
+        没有读完就不再需要时调用迭代器的aclose()，释放连接
+        '''
+        origin_url = await self._origin_url(id_or_pic)
+        headers = {}
+        if offset or length is not None:
+            headers['Range'] = 'bytes={}-{}'.format(offset, '' if length is None else offset + length - 1)
+        rsp, _ = await self._request('GET', origin_url, operation, read=False, headers=headers)
+        try:
+            rsp.raise_for_status()
+            if rsp.status == 206:
+                size = int(rsp.headers['Content-Range'].rsplit('/', 1)[1])
+            elif offset or length is not None:
+                raise aiohttp.ClientPayloadError('server ignored range {}'.format(headers['Range']))
+            else:
+                size = int(rsp.headers['Content-Length'])
+        except BaseException:
+            rsp.release()
+            raise
+
+        async def chunks():
+            try:
+                async for block in rsp.content.iter_chunked(1024 * 256):
+                    yield block
+            finally:
+                rsp.release()
+        return chunks(), size
+
+    async def create_picture(self, id):
+        origin_url, alt = await self.get_picture_info(id)
+        return WallHavenPicture(id, parse_resolution(alt), alt, origin_url)
+
+    async def get_picture_data(self, id_or_pic):
+        '''分段并行下载原图到内存，返回BytesIO'''
+        origin_url = await self._origin_url(id_or_pic)
+        rsp, _ = await self._request('HEAD', origin_url, 'origin')
+        rsp.raise_for_status()
+        size = int(rsp.headers['Content-Length'])
+        buff = io.BytesIO(bytearray(size))
+        semaphore = asyncio.Semaphore(self._download_max_thread)
+        parts = [(start, min(self._download_part_size, size - start))
+                 for start in range(0, size, self._download_part_size)]
+        results = await asyncio.gather(*[self._download_part(origin_url, start, part_size, semaphore)
+                                         for start, part_size in parts])
+        for data, start in results:
+            buff.seek(start)
+            buff.write(data)
+        buff.seek(0)
+        return buff
+
+    async def _download_part(self, url, start: int, size: int, semaphore):
+        # Range的结束位置是包含在内的
+        headers = {'Range': 'bytes=%d-%d' % (start, start + size - 1)}
+        async with semaphore:
+            rsp, data = await self._request('GET', url, 'range-part', headers=headers)
+        if rsp.status != 206 and not (rsp.status == 200 and start == 0 and len(data) == size):
+            raise aiohttp.ClientResponseError(rsp.request_info, rsp.history, status=rsp.status,
+                                              message='unexpected status for range {}-{}'.format(start, start + size))
+        if len(data) != size:
+            raise aiohttp.ClientPayloadError('short read for range {}-{}: got {}'.format(start, start + size,
+                                                                                         len(data)))
+        return data, start
+
+    def run(self, coro):
+        '''
+        在后台事件循环中执行协程，返回concurrent.futures.Future
+        供Qt线程等同步代码调用；Future取消时协程也被取消
+        '''
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._loop_thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+                self._loop_thread.start()
+            return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def fetch_previews(self, ids):
+        '''一次性提交一批缩略图，按ids的顺序排队等待连接，返回 id -> future 的映射'''
+        return {id: self.run(self.get_preview_data(id)) for id in ids}
+
+    def close(self):
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        if self._session is not None:
+            asyncio.run_coroutine_threadsafe(self._session.close(), loop).result()
+            self._session = None
+        loop.call_soon_threadsafe(loop.stop)
+        self._loop_thread.join()
+        loop.close()
+
+
+class WallhavenAiohttpTest(unittest.TestCase):
+
+    def setUp(self):
+        from FakeServer import FakeWallHavenServer
+        self.server = FakeWallHavenServer(origin_size=1024 * 1024 + 17).start()
+        self.dir = tempfile.TemporaryDirectory()
+        self.stats = NetStats()
+        self.store = PictureStore(self.dir.name + '/picture.db')
+        self.client = WallhavenAiohttp(8, ThumbnailCache(self.dir.name + '/thumb'), self.store,
+                                       self.server.url, self.stats)
+
+    def tearDown(self):
+        self.client.close()
+        self.store.close()
+        self.server.stop()
+        self.dir.cleanup()
+
+    def test_listing_and_previews(self):
+        ids = self.client.run(self.client.get_category_picture(Category.LATEST, 2)).result(10)
+        self.assertEqual(ids, self.server.page_ids(2))
+        previews = self.client.fetch_previews(ids)
+        self.assertEqual(list(previews), ids)
+        self.assertTrue(all(future.result(10) == self.server.thumbnail for future in previews.values()))
+        # 第二次从磁盘缓存读取
+        for future in self.client.fetch_previews(ids).values():
+            future.result(10)
+        self.assertEqual(self.server.requests['thumb'], len(ids))
+        self.assertEqual(self.stats.summary()['operations']['thumb']['count'], len(ids))
+
+    def test_picture_data(self):
+        self.client._download_part_size = 256 * 1024
+        data = self.client.run(self.client.get_picture_data('1001')).result(10)
+        self.assertEqual(data.read(), self.server.origin)
+        self.assertEqual(self.store.get('1001').origin_url,
+                         self.server.url + '/wallpapers/full/wallhaven-1001.jpg')
+
+        async def read_range():
+            chunks, size = await self.client.get_origin_data('1001', 100, 1000)
+            return b''.join([block async for block in chunks]), size
+        self.assertEqual(self.client.run(read_range()).result(10), (self.server.origin[100:1100],
+                                                                    len(self.server.origin)))
+
+    def test_error_status(self):
+        self.server.error_rate = 1.0
+        with self.assertRaises(aiohttp.ClientResponseError):
+            self.client.run(self.client.get_category_picture(Category.LATEST, 1)).result(10)
+        with self.assertRaises(aiohttp.ClientResponseError):
+            self.client.fetch_previews(['1001'])['1001'].result(10)
+        self.assertNotIn('th-1001.jpg', self.client.thumb_cache)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,15 @@
 import sys
 import logging
+import pathlib
 import Setting
 from PyQt5 import QtWidgets, QtCore, QtGui
 from PyQt5.QtWidgets import QApplication, QWidget, QDesktopWidget
 from PyQt5.QtGui import QIcon
 from PreviewTab import PreviewTabs
+from StatsOverlay import StatsOverlay
+
+# 启动后多久开始扫描下载目录（毫秒）
+LIBRARY_SCAN_DELAY = 2000
 
 
 log = logging.getLogger('MainGUILog')
@@ -25,9 +30,13 @@ class MainGui(QWidget):
         self.previous_page_button = QtWidgets.QPushButton()
         self.next_page_button = QtWidgets.QPushButton()
         self.page_edit = QtWidgets.QLineEdit()
-        self.setting_dialog = Setting.SettingDialog(self)
+        # 设置对话框第一次打开时才创建
+        self.setting_dialog = None
         self.preview_tabs = PreviewTabs()
+        self.stats_overlay = StatsOverlay(self)
+        self.library_watcher = None
         self.init_ui()
+        self.init_shortcuts()
         self.init_preview_tabs()
         self.move_to_center()
         self.show()
@@ -53,10 +62,10 @@ class MainGui(QWidget):
         self.next_page_button.clicked.connect(self.next_page_slot)
         self.page_edit.setFixedWidth(30)
         self.page_edit.setAlignment(QtCore.Qt.AlignCenter)
-        self.page_edit.setText(str(self.preview_tabs.currentWidget().widget().current_page()))
+        self.page_edit.setText(str(self.preview_tabs.current_tab().current_page()))
 
         self.setting_button.setText('设置')
-        self.setting_button.clicked.connect(self.setting_dialog.show)
+        self.setting_button.clicked.connect(self.show_setting_dialog_slot)
 
         self.top_layout.addStretch()
         self.top_layout.addWidget(self.previous_page_button)
@@ -68,25 +77,52 @@ class MainGui(QWidget):
         self.layout().addLayout(self.top_layout)
         self.layout().addLayout(self.center_layout)
 
+    def init_shortcuts(self):
+        # F12显示网络统计，Ctrl+F12导出为JSON
+        QtWidgets.QShortcut(QtGui.QKeySequence('F12'), self, self.stats_overlay.toggle)
+        QtWidgets.QShortcut(QtGui.QKeySequence('Ctrl+F12'), self, self.dump_stats_slot)
+
+    @QtCore.pyqtSlot()
+    def dump_stats_slot(self):
+        path = str(pathlib.Path.cwd().joinpath('net_stats.json'))
+        self.stats_overlay.stats.dump(path)
+        log.info('dump network stats to ' + path)
+
     def init_preview_tabs(self):
         self.preview_tabs.currentChanged.connect(self.tab_change_slot)
+        self.preview_tabs.page_changed_signal.connect(self.tab_change_slot)
+        # 首次绘制之后再开始扫描下载目录，之后由目录变化通知触发增量扫描
+        QtCore.QTimer.singleShot(LIBRARY_SCAN_DELAY, self.start_library_watcher)
+
+    @QtCore.pyqtSlot()
+    def start_library_watcher(self):
+        from LibraryIndex import LibraryIndex
+        from LibraryWatcher import LibraryWatcher
+        self.library_watcher = LibraryWatcher(LibraryIndex.shared(Setting.download_path()), parent=self)
+        self.library_watcher.start()
+
+    @QtCore.pyqtSlot()
+    def show_setting_dialog_slot(self):
+        if self.setting_dialog is None:
+            self.setting_dialog = Setting.SettingDialog(self)
+        self.setting_dialog.show()
 
     @QtCore.pyqtSlot()
     def previous_page_slot(self):
-        current_tab = self.preview_tabs.currentWidget().widget()
+        current_tab = self.preview_tabs.current_tab()
         current_tab.update_previous_page()
         self.page_edit.setText(str(current_tab.current_page()))
 
     @QtCore.pyqtSlot()
     def next_page_slot(self):
-        current_tab = self.preview_tabs.currentWidget().widget()
+        current_tab = self.preview_tabs.current_tab()
         current_tab.update_next_page()
 
         self.page_edit.setText(str(current_tab.current_page()))
 
     @QtCore.pyqtSlot()
     def tab_change_slot(self):
-        current_tab = self.preview_tabs.currentWidget().widget()
+        current_tab = self.preview_tabs.current_tab()
         self.page_edit.setText(str(current_tab.current_page()))
 
 